@@ -25,7 +25,23 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import audit, audit_archive, settings, events, validation, leader
+    audit.init_app(app)
+    audit_archive.init_app(app)
+    settings.init_app(app)
+    events.init_app(app)
+    validation.init_app(app)
+    leader.init_app(app)
+
+    from .services import email_service, imap_pool, mail_parser, message_cache, message_store
+    email_service.init_app(app)
+    mail_parser.init_app(app)
+    imap_pool.init_app(app)
+    message_cache.init_app(app)
+    message_store.init_app(app)
+
     from . import auth
+    auth.init_app(app)
     app.register_blueprint(auth.bp)
 
     from .routes import main
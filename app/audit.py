@@ -1,13 +1,175 @@
-from flask import request, current_app
-from app.db import get_db
+"""审计日志
 
-def log_audit(username, action, details=None):
+log_audit() 只把记录放进有界的内存队列, 由后台线程批量写入 (每批一个事务),
+请求线程不再为每条记录单独提交事务、与轮询进程争抢 SQLite 写锁。
+进程退出时 (atexit) 写完队列中剩余的记录。
+
+队列满时的处理方式由 AUDIT_OVERFLOW 决定:
+- 'block': 最多等待 AUDIT_BLOCK_TIMEOUT 秒, 仍然满则在当前线程直接写入 (默认)
+- 'sync':  立即在当前线程直接写入
+- 'drop':  丢弃该记录, 计入 writer.dropped
+"""
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from flask import request, has_app_context
+from app.db import get_db, configure_connection
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+OVERFLOW = 'block'
+BLOCK_TIMEOUT = 1.0
+# 关闭后每条记录都在调用线程中同步写入 (原有行为)
+ASYNC = True
+
+INSERT = "INSERT INTO audit_logs (username, action, details, ip_address, timestamp) VALUES (?, ?, ?, ?, ?)"
+_STOP = object()
+
+
+def init_app(app):
+    global QUEUE_SIZE, BATCH_SIZE, OVERFLOW, BLOCK_TIMEOUT, ASYNC
+    QUEUE_SIZE = app.config.get('AUDIT_QUEUE_SIZE', QUEUE_SIZE)
+    BATCH_SIZE = app.config.get('AUDIT_BATCH_SIZE', BATCH_SIZE)
+    OVERFLOW = app.config.get('AUDIT_OVERFLOW', OVERFLOW)
+    BLOCK_TIMEOUT = app.config.get('AUDIT_BLOCK_TIMEOUT', BLOCK_TIMEOUT)
+    ASYNC = app.config.get('AUDIT_ASYNC', ASYNC)
+    writer.configure(app.config['DATABASE'], app.config)
+
+
+class AuditWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._stopping = False
+        self._database = None
+        self._config = {}
+        self.written = 0
+        self.dropped = 0
+
+    def configure(self, database, config):
+        self._database = database
+        self._config = config
+
+    def _connect(self):
+        conn = sqlite3.connect(self._database)
+        configure_connection(conn, self._config)
+        return conn
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+                    self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def submit(self, record):
+        if not ASYNC or self._stopping:
+            self._write_now([record])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if OVERFLOW == 'drop':
+            with self._lock:
+                self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Audit queue full, {self.dropped} records dropped so far")
+            return
+        if OVERFLOW == 'block':
+            try:
+                self._queue.put(record, timeout=BLOCK_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+        self._write_now([record])
+
+    def _insert(self, conn, records):
+        try:
+            conn.executemany(INSERT, records)
+            conn.commit()
+            with self._lock:
+                self.written += len(records)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Audit log write failed ({len(records)} records): {e}")
+
+    def _write_now(self, records):
+        # 请求或任务线程中复用当前连接, 否则 (如 atexit) 单独打开一个
+        if has_app_context():
+            self._insert(get_db(), records)
+            return
+        conn = self._connect()
+        try:
+            self._insert(conn, records)
+        finally:
+            conn.close()
+
+    def _run(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            # 上一批提交期间积压的记录合并为一个事务
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                batch = [record for record in batch if record is not _STOP]
+                stop = True
+            if batch:
+                self._insert(conn, batch)
+        conn.close()
+
+    def close(self, timeout=10):
+        """写完队列中的记录并停止后台线程; 之后的记录同步写入"""
+        if self._thread is None or self._stopping:
+            return
+        self._stopping = True
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        # 停止前一刻入队、排在 _STOP 之后的记录
+        leftover = []
+        while True:
+            try:
+                leftover.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        leftover = [record for record in leftover if record is not _STOP]
+        if leftover:
+            conn = self._connect()
+            try:
+                self._insert(conn, leftover)
+            finally:
+                conn.close()
+
+
+writer = AuditWriter()
+
+
+def log_audit(username, action, details=None, ip_address=None):
     try:
-        ip_addr = request.remote_addr if request else 'unknown'
-        db = get_db()
-        db.execute("INSERT INTO audit_logs (username, action, details, ip_address) VALUES (?, ?, ?, ?)",
-                  (username, action, details, ip_addr))
-        db.commit()
+        # 后台任务中没有请求上下文, 由调用方传入发起请求时的 IP
+        ip_addr = ip_address or (request.remote_addr if request else 'unknown')
+        # 与 audit_logs.timestamp 的默认值 CURRENT_TIMESTAMP 格式一致 (UTC)
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        writer.submit((username, action, details, ip_addr, timestamp))
     except Exception as e:
         # Avoid circular dependency or logger issues if app is not fully set up
         print(f"Audit log failed: {e}")
@@ -1,13 +1,69 @@
 import functools
+import threading
+import time
+from collections import OrderedDict
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, session, url_for
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 from app.db import get_db
+from app.settings import settings
 from app.audit import log_audit
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# 当前用户行的缓存: 每个请求 (包括首页每 5 秒的自动刷新) 都要加载一次
+USER_CACHE_TTL = 30
+USER_CACHE_SIZE = 1024
+
+
+def init_app(app):
+    global USER_CACHE_TTL, USER_CACHE_SIZE
+    USER_CACHE_TTL = app.config.get('USER_CACHE_TTL', USER_CACHE_TTL)
+    USER_CACHE_SIZE = app.config.get('USER_CACHE_SIZE', USER_CACHE_SIZE)
+
+
+class UserCache:
+    """按 id 缓存 users 行的 TTL + LRU 缓存
+
+    本进程内修改用户 (改名、改密码、删除) 后需调用 invalidate();
+    其他进程的修改最多在 USER_CACHE_TTL 秒后生效。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # user_id -> (row, expires_at)
+
+    def get(self, db, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._users.move_to_end(user_id)
+                return entry[0]
+
+        row = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        with self._lock:
+            if row is None:
+                self._users.pop(user_id, None)
+            else:
+                self._users[user_id] = (row, now + USER_CACHE_TTL)
+                self._users.move_to_end(user_id)
+                while len(self._users) > USER_CACHE_SIZE:
+                    self._users.popitem(last=False)
+        return row
+
+    def invalidate(self, user_id=None):
+        """删除单个用户的缓存, user_id 为 None 时清空"""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+
+user_cache = UserCache()
+
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
     # Only Admin or Renjie can register users in this logic? 
@@ -53,9 +109,7 @@ def load_logged_in_user():
         g.can_access_dashboard = False
     else:
         db = get_db()
-        g.user = db.execute(
-            'SELECT * FROM users WHERE id = ?', (user_id,)
-        ).fetchone()
+        g.user = user_cache.get(db, user_id)
         
         g.is_super_admin = (g.user['username'] == 'renjie') if g.user else False
         
@@ -65,9 +119,8 @@ def load_logged_in_user():
             if g.is_super_admin:
                 g.can_access_dashboard = True
             elif g.user['username'] == 'admin':
-                # Check system setting
-                row = db.execute("SELECT value FROM system_settings WHERE key='allow_admin_dashboard'").fetchone()
-                g.can_access_dashboard = (row['value'] == '1') if row else False
+                # Check system setting (settings 缓存, 切换开关后立即生效)
+                g.can_access_dashboard = settings.get(db, 'allow_admin_dashboard')
 
 @bp.route('/logout')
 def logout():
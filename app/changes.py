@@ -0,0 +1,67 @@
+"""账号变更的增量查询
+
+accounts 上的触发器 (见 migrations._change_tracking) 维护全局版本号 change_counter.version:
+新增或修改账号时写入该行的 change_version, 删除 (或更换归属人) 时写入 account_tombstones。
+同一账号可能同时出现在 changed 和 removed 中, 客户端应先删除再应用修改。
+客户端记住上次看到的版本号, 之后只取比它新的行。
+"""
+import time
+
+# 墓碑保留时长; 比最早保留的墓碑还旧的版本号无法得到准确增量, 客户端需要整页刷新
+TOMBSTONE_TTL = 24 * 3600
+# 账号列表、增量和事件只返回展示需要的列, 不包含授权码
+ACCOUNT_COLUMNS = "id, email, status, has_new_mail, push_enabled, user_id, last_mail_at, last_error"
+# 一次增量最多返回的行数, 超过时让客户端整页刷新
+MAX_CHANGES = 500
+
+
+def current_version(db):
+    return db.execute("SELECT version FROM change_counter WHERE id = 1").fetchone()[0]
+
+
+def changes_since(db, since, columns, user_id=None):
+    """返回 (version, changed_rows, removed_ids, reset)
+
+    user_id 不为 None 时只返回属于该用户的账号 (隔离模式)。
+    reset 为 True 表示增量不完整 (版本太旧或变化太多), 调用方应整页刷新。
+    """
+    version, pruned_version = db.execute(
+        "SELECT version, pruned_version FROM change_counter WHERE id = 1").fetchone()
+    if since == version:
+        return version, [], [], False
+    # 比服务器还新的版本号来自恢复/重建前的数据库, 同样无法得到增量
+    if since > version or since < pruned_version:
+        return version, [], [], True
+
+    result = fetch_changes(db, since, version, columns, user_id)
+    if result is None:
+        return version, [], [], True
+    changed, removed = result
+    return version, changed, [row['account_id'] for row in removed], False
+
+
+def fetch_changes(db, since, version, columns, user_id=None, limit=MAX_CHANGES):
+    """取 (since, version] 区间内变化的账号行和墓碑行, 变化超过 limit 行时返回 None"""
+    owner = " AND user_id = ?" if user_id is not None else ""
+    params = [since, version] + ([user_id] if user_id is not None else [])
+    changed = db.execute(
+        f"SELECT {columns}, change_version FROM accounts WHERE change_version > ? AND change_version <= ?{owner} "
+        f"ORDER BY change_version LIMIT ?", params + [limit + 1]
+    ).fetchall()
+    if len(changed) > limit:
+        return None
+
+    removed = db.execute(
+        f"SELECT account_id, user_id, change_version FROM account_tombstones "
+        f"WHERE change_version > ? AND change_version <= ?{owner} ORDER BY change_version", params
+    ).fetchall()
+    return [dict(row) for row in changed], [dict(row) for row in removed]
+
+
+def prune_tombstones(db):
+    """删除过期墓碑, 并记录被删除的最大版本号"""
+    cutoff = time.time() - TOMBSTONE_TTL
+    row = db.execute("SELECT MAX(change_version) FROM account_tombstones WHERE deleted_at < ?", (cutoff,)).fetchone()
+    if row[0] is not None:
+        db.execute("DELETE FROM account_tombstones WHERE deleted_at < ?", (cutoff,))
+        db.execute("UPDATE change_counter SET pruned_version = MAX(pruned_version, ?) WHERE id = 1", (row[0],))
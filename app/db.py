@@ -3,6 +3,11 @@ import os
 import click
 from flask import g, current_app
 from werkzeug.security import generate_password_hash
+from app import migrations
+
+# 连接参数, 可通过 app.config 覆盖
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 20000
 
 def get_db():
     if 'db' not in g:
@@ -11,8 +16,18 @@ def get_db():
             detect_types=sqlite3.PARSE_DECLTYPES
         )
         g.db.row_factory = sqlite3.Row
+        configure_connection(g.db, current_app.config)
     return g.db
 
+def configure_connection(db, config):
+    # WAL: 读 (Web 页面) 与写 (轮询进程) 互不阻塞; WAL 下 NORMAL 同步已足够安全
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    # 写锁被占用时等待而不是立即报 database is locked
+    db.execute(f"PRAGMA busy_timeout = {int(config.get('SQLITE_BUSY_TIMEOUT_MS', BUSY_TIMEOUT_MS))}")
+    # 负数表示以 KB 为单位的页缓存大小
+    db.execute(f"PRAGMA cache_size = -{int(config.get('SQLITE_CACHE_SIZE_KB', CACHE_SIZE_KB))}")
+
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
@@ -24,60 +39,17 @@ def init_db():
     # 启用外键支持
     db.execute("PRAGMA foreign_keys = ON")
 
-    # 用户表
-    db.execute('''CREATE TABLE IF NOT EXISTS users
-                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   username TEXT NOT NULL UNIQUE,
-                   password_hash TEXT NOT NULL)''')
-                  
-    # 账号表
-    db.execute('''CREATE TABLE IF NOT EXISTS accounts 
-                  (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                   email TEXT NOT NULL, 
-                   auth_code TEXT NOT NULL,
-                   user_id INTEGER,
-                   FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE SET NULL)''')
-
-    # Migration: Check if user_id column exists
-    cursor = db.execute("PRAGMA table_info(accounts)")
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'user_id' not in columns:
-        db.execute("ALTER TABLE accounts ADD COLUMN user_id INTEGER")
-    
-    # Migration: Check if status column exists
-    if 'status' not in columns:
-        db.execute("ALTER TABLE accounts ADD COLUMN status TEXT DEFAULT 'unknown'")
+    # 建表与结构变更见 app/migrations.py
+    migrations.migrate(db)
 
-    # Migration: Check if has_new_mail column exists
-    if 'has_new_mail' not in columns:
-        db.execute("ALTER TABLE accounts ADD COLUMN has_new_mail INTEGER DEFAULT 0")
-
-    # Migration: Check if last_mail_identifier column exists
-    if 'last_mail_identifier' not in columns:
-        db.execute("ALTER TABLE accounts ADD COLUMN last_mail_identifier TEXT")
-
-    # 审计日志表
-    db.execute('''CREATE TABLE IF NOT EXISTS audit_logs
-                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   username TEXT NOT NULL,
-                   action TEXT NOT NULL,
-                   details TEXT,
-                   ip_address TEXT,
-                   timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-                   
-    # 系统设置表 (用于存隔离模式开关)
-    db.execute('''CREATE TABLE IF NOT EXISTS system_settings
-                  (key TEXT PRIMARY KEY,
-                   value TEXT NOT NULL)''')
-
-    # 预置 Admin
+    # 预置 Admin (多个 worker 同时初始化新库时可能都看到用户不存在, 用 OR IGNORE 避免冲突)
     if not db.execute('SELECT id FROM users WHERE username = ?', ('admin',)).fetchone():
-        db.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)",
+        db.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
                    ('admin', generate_password_hash('admin')))
     
     # 预置 renjie
     if not db.execute('SELECT id FROM users WHERE username = ?', ('renjie',)).fetchone():
-        db.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)",
+        db.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
                    ('renjie', generate_password_hash('Weirenjie200029@')))
                    
     # 预置隔离模式 (默认关闭 '0')
@@ -87,6 +59,25 @@ def init_db():
     db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_enabled', '0')")
     db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_interval', '300')")
 
+    # 预置自适应轮询间隔的上下限 (秒), polling_interval 作为新账号的初始间隔
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_min_interval', '30')")
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_max_interval', '3600')")
+
+    # 预置轮询引擎 ('async' 为 asyncio 引擎, 'thread' 为线程池回退模式) 与并发数
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_mode', 'async')")
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('polling_concurrency', '200')")
+
+    # 预置 IDLE 推送模式 (默认关闭), 每进程连接额度, "最近活跃" 的时间窗口 (小时)
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('push_enabled', '0')")
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('push_max_connections', '100')")
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('push_recent_hours', '24')")
+
+    # 预置查看邮件时正文的最大下载字节数 (256 KB)
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('mail_body_max_bytes', '262144')")
+
+    # 预置审计日志保留天数 (0 表示不归档)
+    db.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES ('audit_retention_days', '0')")
+
     db.commit()
 
 def init_app(app):
@@ -0,0 +1,167 @@
+"""账号状态事件 (Server-Sent Events)
+
+后台线程每 FEED_INTERVAL 秒 (或被轮询线程唤醒时) 检查 change_counter.version,
+把 status / has_new_mail / 归属人发生变化的账号和被删除的账号转成事件,
+放入有界的环形缓冲区。事件 id 即该行的 change_version, 断线重连时浏览器带上
+Last-Event-ID, 从缓冲区补发之后的事件; 太旧的 id 收到 reset 事件, 需整页刷新。
+
+每个 SSE 连接在多线程服务器中一直占用一个请求线程, 因此每个进程最多同时保持
+MAX_STREAMS 个连接, 超出的客户端改用 /api/accounts/changes 轮询; 每个连接最长
+STREAM_MAX_AGE 秒后由服务器结束, 浏览器自动重连, 名额得以轮换。
+"""
+import json
+import threading
+import logging
+from collections import deque
+from app import changes
+from app.db import get_db
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 2000
+FEED_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15
+# 每个进程同时保持的 SSE 连接数上限 (gunicorn.conf.py 默认每个 worker 16 个线程)
+MAX_STREAMS = 8
+STREAM_MAX_AGE = 300
+
+
+def init_app(app):
+    global BUFFER_SIZE, FEED_INTERVAL, MAX_STREAMS, STREAM_MAX_AGE
+    BUFFER_SIZE = app.config.get('EVENT_BUFFER_SIZE', BUFFER_SIZE)
+    FEED_INTERVAL = app.config.get('EVENT_FEED_INTERVAL', FEED_INTERVAL)
+    MAX_STREAMS = app.config.get('EVENT_MAX_STREAMS', MAX_STREAMS)
+    STREAM_MAX_AGE = app.config.get('EVENT_STREAM_MAX_AGE', STREAM_MAX_AGE)
+
+
+class Event:
+    __slots__ = ('id', 'type', 'user_id', 'data', 'owner_only')
+
+    def __init__(self, event_id, event_type, user_id, data, owner_only=False):
+        self.id = event_id
+        self.type = event_type
+        self.user_id = user_id
+        self.data = data
+        # 只发给按归属人过滤的订阅者 (换归属人时原归属人的移除事件)
+        self.owner_only = owner_only
+
+    def encode(self):
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class EventHub:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events = deque()
+        self._state = {}        # account_id -> (status, has_new_mail, user_id)
+        self._thread = None
+        self._wake = threading.Event()
+        # 已处理到的版本号; 小于 floor 的 Last-Event-ID 无法补发
+        self.version = None
+        self.floor = None
+        self.streams = 0
+
+    def open_stream(self):
+        """占用一个 SSE 连接名额, 已满时返回 False"""
+        with self._cond:
+            if self.streams >= MAX_STREAMS:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._cond:
+            self.streams = max(0, self.streams - 1)
+
+    def ensure_started(self, app):
+        """第一个订阅者到来时加载当前状态并启动后台线程"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            db = get_db()
+            self.version = self.floor = changes.current_version(db)
+            self._state = {row['id']: (row['status'], row['has_new_mail'], row['user_id'])
+                           for row in db.execute("SELECT id, status, has_new_mail, user_id FROM accounts")}
+            self._thread = threading.Thread(target=self._run, args=(app,), daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """数据库刚写入了账号变化, 立即检查 (未启动时无操作)"""
+        self._wake.set()
+
+    def _run(self, app):
+        logger.info("Event feed started")
+        with app.app_context():
+            while True:
+                try:
+                    self._poll(get_db())
+                except Exception as e:
+                    logger.error(f"Event feed error: {e}")
+                self._wake.wait(FEED_INTERVAL)
+                self._wake.clear()
+
+    def _poll(self, db):
+        version = changes.current_version(db)
+        if version == self.version:
+            return
+
+        result = changes.fetch_changes(db, self.version, version, changes.ACCOUNT_COLUMNS, limit=BUFFER_SIZE)
+        if result is None:
+            # 变化太多 (如批量导入), 不逐条推送, 让所有客户端整页刷新
+            self._state = {row['id']: (row['status'], row['has_new_mail'], row['user_id'])
+                           for row in db.execute("SELECT id, status, has_new_mail, user_id FROM accounts")}
+            with self._cond:
+                self._events.clear()
+                self.version = self.floor = version
+                self._cond.notify_all()
+            return
+
+        changed, removed = result
+        events = []
+        for row in removed:
+            # 墓碑对应的账号仍存在说明只是换了归属人, 只需从原归属人的列表中移除
+            exists = db.execute("SELECT 1 FROM accounts WHERE id = ?", (row['account_id'],)).fetchone() is not None
+            if not exists:
+                self._state.pop(row['account_id'], None)
+            events.append(Event(row['change_version'], 'removed', row['user_id'], {'id': row['account_id']},
+                                owner_only=exists))
+
+        for acc in changed:
+            previous = self._state.get(acc['id'])
+            current = (acc['status'], acc['has_new_mail'], acc['user_id'])
+            self._state[acc['id']] = current
+            if previous == current:
+                continue  # 只有推送开关等其他列变化
+            data = dict(acc)
+            data['previous'] = {'status': previous[0], 'has_new_mail': previous[1]} if previous else None
+            events.append(Event(data.pop('change_version'), 'account', acc['user_id'], data))
+
+        events.sort(key=lambda event: event.id)
+        with self._cond:
+            self._events.extend(events)
+            while len(self._events) > BUFFER_SIZE:
+                self.floor = self._events.popleft().id
+            self.version = version
+            self._cond.notify_all()
+
+    def wait(self, last_id, timeout):
+        """返回 (events, cursor, reset): last_id 之后的事件; 没有则最多等待 timeout 秒"""
+        with self._cond:
+            if last_id is None:
+                last_id = self.version
+            elif last_id > self.version:
+                # 后台线程可能落后数据库一个检查周期; 先让它立即检查, 仍然落后说明游标来自
+                # 另一个 (恢复或重建的) 数据库, 让客户端整页刷新
+                self._wake.set()
+                if not self._cond.wait_for(lambda: self.version >= last_id, FEED_INTERVAL):
+                    return [], self.version, True
+            if last_id < self.floor:
+                return [], self.version, True
+            if self.version == last_id:
+                self._cond.wait(timeout)
+                if last_id < self.floor:
+                    return [], self.version, True
+            return [event for event in self._events if event.id > last_id], self.version, False
+
+
+hub = EventHub()
@@ -0,0 +1,136 @@
+"""批量导入账号 (.xlsx / .csv)
+
+逐行流式读取 (openpyxl 只读模式 / csv 模块), 不把整个表格载入内存。
+每行校验并规范化邮箱和授权码, 文件内重复和库中已存在的邮箱跳过,
+新账号按 INSERT_CHUNK 行一批 executemany 写入, 每批一个事务。
+"""
+import csv
+import os
+import re
+from app.db import get_db
+from app.audit import log_audit
+
+REQUIRED_COLUMNS = ('QQ邮箱', '授权码')
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xlsm', '.csv')
+INSERT_CHUNK = 500
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[a-z]{2,}$')
+AUTH_CODE_MAX_LENGTH = 64
+
+
+def _read_xlsx(path):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def _read_csv(path):
+    # Excel 另存的 CSV 常见 UTF-8 (带 BOM) 或 GBK, 按文件开头判断一次
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
+    try:
+        head.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # 截在多字节字符中间的不算
+        encoding = 'utf-8-sig' if e.start >= len(head) - 3 else 'gbk'
+    with open(path, newline='', encoding=encoding, errors='replace') as f:
+        yield from csv.reader(f)
+
+
+def read_rows(path, filename):
+    """按文件扩展名逐行读取, 产出单元格元组 (第一行为表头)"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"不支持的文件类型 {extension or filename}, 请上传 .xlsx 或 .csv")
+    return _read_csv(path) if extension == '.csv' else _read_xlsx(path)
+
+
+def _cell(row, index):
+    value = row[index] if index < len(row) else None
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def normalise(email_addr, auth_code):
+    """返回 (email, auth_code, error); error 不为 None 表示该行无效"""
+    email_addr = email_addr.strip().lower()
+    auth_code = auth_code.strip()
+    if not email_addr:
+        return email_addr, auth_code, '邮箱为空'
+    if not EMAIL_RE.match(email_addr):
+        return email_addr, auth_code, '邮箱格式不正确'
+    if not auth_code:
+        return email_addr, auth_code, '授权码为空'
+    if len(auth_code) > AUTH_CODE_MAX_LENGTH or any(ch.isspace() for ch in auth_code):
+        return email_addr, auth_code, '授权码格式不正确'
+    return email_addr, auth_code, None
+
+
+def _insert_batch(db, job, batch, user_id):
+    # 库中已存在的邮箱走 idx_accounts_email 索引查询
+    emails = [email_addr for _, email_addr, _ in batch]
+    existing = {row[0] for row in db.execute(
+        f"SELECT email FROM accounts WHERE email IN ({','.join('?' * len(emails))})", emails)}
+
+    rows = []
+    for row_number, email_addr, auth_code in batch:
+        if email_addr in existing:
+            job.error(row_number, email_addr, '账号已存在', skipped=True)
+        else:
+            rows.append((email_addr, auth_code, user_id))
+    if rows:
+        db.executemany("INSERT INTO accounts (email, auth_code, user_id) VALUES (?, ?, ?)", rows)
+    db.commit()
+    job.succeeded += len(rows)
+
+
+def run_import(job, path, filename, user_id, username, ip_address):
+    """jobs.start 的任务函数: 导入 path 中的账号, 结束后删除该文件"""
+    db = get_db()
+    try:
+        rows = read_rows(path, filename)
+        header_row = next(rows, None) or ()
+        header = [_cell(header_row, i) for i in range(len(header_row))]
+        if not all(column in header for column in REQUIRED_COLUMNS):
+            raise ValueError(f"Columns must include: {', '.join(REQUIRED_COLUMNS)}")
+        email_index, code_index = (header.index(column) for column in REQUIRED_COLUMNS)
+
+        seen = set()
+        batch = []
+        # 表头是第 1 行, 错误报告中的行号与表格中一致
+        for row_number, row in enumerate(rows, 2):
+            raw_email, raw_code = _cell(row, email_index), _cell(row, code_index)
+            if not raw_email and not raw_code:
+                continue
+            job.processed += 1
+            email_addr, auth_code, error = normalise(raw_email, raw_code)
+            if error:
+                job.error(row_number, raw_email, error)
+            elif email_addr in seen:
+                job.error(row_number, email_addr, '文件内重复', skipped=True)
+            else:
+                seen.add(email_addr)
+                batch.append((row_number, email_addr, auth_code))
+                if len(batch) >= INSERT_CHUNK:
+                    _insert_batch(db, job, batch, user_id)
+                    batch = []
+            job.save(db)
+
+        if batch:
+            _insert_batch(db, job, batch, user_id)
+        job.total = job.processed
+    finally:
+        os.unlink(path)
+
+    message = f"Imported {job.succeeded} accounts, skipped {job.skipped}, failed {job.failed}"
+    log_audit(username, 'UPLOAD_EXCEL', f"{filename}: {message}", ip_address=ip_address)
+    return message
@@ -0,0 +1,110 @@
+"""后台任务 (批量导入等) 的执行与进度记录
+
+任务在本进程的后台线程中执行, 进度和逐行错误写入 jobs 表,
+因此任何 Web worker 都能查询进度。运行中的任务至少每 SAVE_INTERVAL 秒写一次进度,
+超过 STALE_AFTER 秒没有更新的任务 (进程已退出) 查询时报告为 interrupted。
+"""
+import json
+import threading
+import time
+import uuid
+import logging
+from app.db import get_db
+
+logger = logging.getLogger(__name__)
+
+SAVE_INTERVAL = 1.0
+STALE_AFTER = 300
+# 错误明细最多保留的行数, 超出的只计数
+MAX_ERRORS = 1000
+# 已结束的任务保留时长
+JOB_TTL = 7 * 24 * 3600
+
+COLUMNS = ('id', 'kind', 'user_id', 'status', 'total', 'processed', 'succeeded', 'skipped', 'failed',
+           'message', 'created_at', 'updated_at', 'finished_at')
+
+
+class Job:
+    """任务执行函数收到的进度对象, 计数器直接修改后调用 save()"""
+
+    def __init__(self, job_id, kind, user_id):
+        self.id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.status = 'running'
+        self.total = None
+        self.processed = 0
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self.message = None
+        self._saved_at = 0
+
+    def error(self, row, email, reason, skipped=False):
+        """记录一行失败 (skipped=True 表示跳过, 如重复的邮箱)"""
+        if skipped:
+            self.skipped += 1
+        else:
+            self.failed += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'row': row, 'email': email, 'error': reason})
+
+    def save(self, db, force=False):
+        """写入进度并提交; 非 force 时按 SAVE_INTERVAL 节流"""
+        now = time.time()
+        if not force and now - self._saved_at < SAVE_INTERVAL:
+            return
+        self._saved_at = now
+        db.execute(
+            "UPDATE jobs SET status = ?, total = ?, processed = ?, succeeded = ?, skipped = ?, failed = ?, "
+            "errors = ?, message = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+            (self.status, self.total, self.processed, self.succeeded, self.skipped, self.failed,
+             json.dumps(self.errors, ensure_ascii=False), self.message, now,
+             now if self.status in ('done', 'failed') else None, self.id)
+        )
+        db.commit()
+
+
+def start(app, kind, user_id, target, *args):
+    """创建任务并在后台线程中执行 target(job, *args), 返回任务 id
+
+    target 返回的字符串作为任务的结束说明; 抛出异常时任务标记为 failed。
+    """
+    db = get_db()
+    now = time.time()
+    db.execute("DELETE FROM jobs WHERE finished_at < ?", (now - JOB_TTL,))
+    job = Job(uuid.uuid4().hex, kind, user_id)
+    db.execute("INSERT INTO jobs (id, kind, user_id, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+               (job.id, kind, user_id, job.status, now, now))
+    db.commit()
+
+    def run():
+        with app.app_context():
+            db = get_db()
+            try:
+                job.message = target(job, *args)
+                job.status = 'done'
+            except Exception as e:
+                logger.exception(f"Job {job.id} ({kind}) failed")
+                job.status = 'failed'
+                job.message = str(e)
+            try:
+                job.save(db, force=True)
+            except Exception as e:
+                logger.error(f"Job {job.id} status write failed: {e}")
+
+    threading.Thread(target=run, name=f"job-{kind}-{job.id[:8]}", daemon=True).start()
+    return job.id
+
+
+def get(db, job_id):
+    """任务的进度和错误明细, 不存在时返回 None"""
+    row = db.execute(f"SELECT {', '.join(COLUMNS)}, errors FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    result = {column: row[column] for column in COLUMNS}
+    result['errors'] = json.loads(row['errors']) if row['errors'] else []
+    if result['status'] == 'running' and time.time() - result['updated_at'] > STALE_AFTER:
+        result['status'] = 'interrupted'
+    return result
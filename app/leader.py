@@ -0,0 +1,171 @@
+"""在多个 Web worker 之间选出唯一运行内嵌轮询的进程
+
+Gunicorn 等多进程服务器的每个 worker 都会启动一个 PollerElection, 它们竞争 poller_leader
+表中唯一一行的租约: 持有租约的 worker 启动 PollingService, 其余的只定期重试。
+持有者每 RENEW_INTERVAL 秒续约一次; 进程崩溃后最多 LEADER_TTL 秒由其他 worker 接管。
+正常退出时先等待当前批次的检查和写库完成, 再释放租约。
+
+轮询和 IMAP 指标只记录在当选的 worker 中。每个 worker 在本机回环地址上提供指标端点,
+续约时把地址写入 poller_leader; 其他 worker 收到 /metrics 请求时用 metrics_source()
+找到当选者并通过 fetch_metrics() 转发, 抓取落在哪个 worker 上结果都一致。
+"""
+import os
+import socket
+import threading
+import time
+import logging
+import urllib.request
+from app.db import get_db
+from app.leases import default_worker_id
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+LEADER_TTL = 30
+RENEW_INTERVAL = 10
+# 退出时最多等待进行中的轮询多少秒
+DRAIN_TIMEOUT = 30
+# 转发当选 worker 的指标时的超时秒数
+METRICS_PROXY_TIMEOUT = 5
+
+
+def init_app(app):
+    global LEADER_TTL, RENEW_INTERVAL, DRAIN_TIMEOUT, METRICS_PROXY_TIMEOUT
+    LEADER_TTL = app.config.get('POLLER_LEADER_TTL', LEADER_TTL)
+    RENEW_INTERVAL = app.config.get('POLLER_LEADER_RENEW_INTERVAL', RENEW_INTERVAL)
+    DRAIN_TIMEOUT = app.config.get('POLLER_DRAIN_TIMEOUT', DRAIN_TIMEOUT)
+    METRICS_PROXY_TIMEOUT = app.config.get('POLLER_METRICS_PROXY_TIMEOUT', METRICS_PROXY_TIMEOUT)
+
+
+class PollerElection:
+    def __init__(self, app, worker_id=None):
+        self.app = app
+        self.worker_id = worker_id or default_worker_id()
+        self.service = None
+        # 最近一次成功续约的时间; 数据库暂时不可用时, 租约到期前继续运行
+        self.renewed_at = 0
+        self.metrics_server = None
+        self.metrics_address = None
+        self.thread = threading.Thread(target=self._run, name='poller-election', daemon=True)
+        self._stop = threading.Event()
+
+    @property
+    def leading(self):
+        return self.service is not None
+
+    def start(self):
+        try:
+            # 系统分配端口, 同一主机上的多个 worker 互不冲突
+            self.metrics_server = metrics.serve('127.0.0.1', 0)
+            self.metrics_address = '127.0.0.1:%d' % self.metrics_server.server_address[1]
+        except OSError as e:
+            logger.error(f"Could not start the worker metrics endpoint: {e}")
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """停止轮询 (等待进行中的批次) 并释放租约, 返回是否在 timeout 秒内完成"""
+        self._stop.set()
+        if self.thread.is_alive():
+            self.thread.join(DRAIN_TIMEOUT + 5 if timeout is None else timeout)
+        return not self.thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    leading = self._acquire(get_db())
+            except Exception as e:
+                logger.error(f"Poller election error: {e}")
+                leading = self.leading and time.time() - self.renewed_at < LEADER_TTL
+
+            if leading and self.service is None:
+                self._start_service()
+            elif not leading and self.service is not None:
+                logger.warning(f"Worker {self.worker_id} lost the poller lease, stopping polling")
+                self._stop_service()
+            self._stop.wait(RENEW_INTERVAL)
+
+        if self.service is not None:
+            self._stop_service()
+            try:
+                with self.app.app_context():
+                    self._release(get_db())
+            except Exception as e:
+                logger.error(f"Poller lease release error: {e}")
+        # 排空期间仍持有租约, 其他 worker 还会转发过来, 所以释放之后再关闭
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+    def _acquire(self, db):
+        """取得或续约租约, 返回本进程是否持有"""
+        now = time.time()
+        cursor = db.execute(
+            "UPDATE poller_leader SET worker_id = ?, hostname = ?, pid = ?, expires_at = ?, metrics_address = ?, "
+            "acquired_at = CASE WHEN worker_id = ? THEN acquired_at ELSE ? END "
+            "WHERE id = 1 AND (worker_id = ? OR worker_id IS NULL OR expires_at < ?)",
+            (self.worker_id, socket.gethostname(), os.getpid(), now + LEADER_TTL, self.metrics_address,
+             self.worker_id, now, self.worker_id, now)
+        )
+        db.commit()
+        if cursor.rowcount == 1:
+            self.renewed_at = now
+            return True
+        return False
+
+    def _release(self, db):
+        db.execute("UPDATE poller_leader SET worker_id = NULL, expires_at = 0 WHERE id = 1 AND worker_id = ?",
+                   (self.worker_id,))
+        db.commit()
+
+    def _start_service(self):
+        # 轮询模块依赖较多, 只在当选后导入, 不拖慢 create_app()
+        from app.polling import PollingService
+        logger.info(f"Worker {self.worker_id} (pid {os.getpid()}) elected as poller")
+        # 轮询租约沿用同一个标识, 便于在 poll_workers 中对应到这个 worker
+        self.service = PollingService(self.app, worker_id=self.worker_id)
+        self.service.start()
+        metrics.poller_leader.set(1)
+
+    def _stop_service(self):
+        if not self.service.shutdown(DRAIN_TIMEOUT):
+            logger.warning(f"In-flight polls did not finish within {DRAIN_TIMEOUT}s, abandoning them")
+        self.service = None
+        metrics.poller_leader.set(0)
+
+
+def start_embedded(app):
+    """在当前进程参与内嵌轮询的选举; POLLER_EMBEDDED=0 时由独立的 poller.py 进程负责轮询"""
+    if os.environ.get('POLLER_EMBEDDED', '1') == '0':
+        return None
+    election = app.extensions['poller_election'] = PollerElection(app)
+    election.start()
+    return election
+
+
+def stop_embedded(app, timeout=None):
+    """停止本进程的选举和轮询; timeout=0 时只发出停止信号, 不等待排空"""
+    election = app.extensions.get('poller_election')
+    return election.stop(timeout) if election is not None else True
+
+
+def metrics_source(app, db):
+    """返回应转发指标的当选 worker 地址; None 表示直接使用本进程的指标
+
+    本进程不参与选举 (独立 poller.py 模式)、自己正在轮询, 或者当前没有可达的当选者时返回 None。
+    """
+    election = app.extensions.get('poller_election')
+    if election is None or election.leading:
+        return None
+    row = db.execute(
+        "SELECT metrics_address FROM poller_leader "
+        "WHERE id = 1 AND worker_id IS NOT NULL AND worker_id != ? AND expires_at >= ? AND hostname = ?",
+        (election.worker_id, time.time(), socket.gethostname())
+    ).fetchone()
+    return row['metrics_address'] if row else None
+
+
+def fetch_metrics(address, path):
+    """从当选 worker 的指标端点读取 path (/metrics 或 /metrics.json), 失败时抛出 OSError"""
+    with urllib.request.urlopen(f"http://{address}{path}", timeout=METRICS_PROXY_TIMEOUT) as response:
+        return response.read()
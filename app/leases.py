@@ -0,0 +1,113 @@
+import math
+import os
+import socket
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 账号按 id % LEASE_BUCKETS 分桶, 每个桶同一时间只属于一个轮询进程
+LEASE_BUCKETS = 64
+# 租约有效期; 进程崩溃后其持有的桶最多在这么久之后被其他进程接管
+LEASE_TTL = 60
+HEARTBEAT_INTERVAL = 10
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def bucket_filter(buckets, column='id'):
+    """生成只选取指定桶内账号的 SQL 条件和参数"""
+    if not buckets:
+        return "0", []
+    return f"({column} % {LEASE_BUCKETS}) IN ({','.join('?' * len(buckets))})", sorted(buckets)
+
+
+class LeaseManager:
+    """通过 poll_workers / poll_leases 两张表在多个轮询进程之间分配账号
+
+    每个进程定期心跳并续约自己的桶, 按存活进程数计算公平份额:
+    多于份额的桶主动释放, 少于份额时认领空闲或已过期的桶。
+    """
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or default_worker_id()
+        self.buckets = frozenset()
+        self.last_heartbeat = 0
+        self.last_renewal = 0
+
+    def heartbeat(self, db, force=False):
+        """心跳、续约并重新平衡, 返回当前持有的桶集合"""
+        now = time.time()
+        if not force and now - self.last_heartbeat < HEARTBEAT_INTERVAL:
+            return self.buckets
+        self.last_heartbeat = now
+        expires_at = now + LEASE_TTL
+
+        db.execute(
+            "INSERT INTO poll_workers (worker_id, hostname, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (self.worker_id, socket.gethostname(), os.getpid(), now, now)
+        )
+        db.execute("DELETE FROM poll_workers WHERE heartbeat_at < ?", (now - LEASE_TTL,))
+        db.execute("UPDATE poll_leases SET expires_at = ? WHERE worker_id = ? AND expires_at >= ?",
+                   (expires_at, self.worker_id, now))
+
+        live_workers = db.execute("SELECT COUNT(*) FROM poll_workers").fetchone()[0]
+        share = math.ceil(LEASE_BUCKETS / max(1, live_workers))
+        owned = db.execute("SELECT COUNT(*) FROM poll_leases WHERE worker_id = ? AND expires_at >= ?",
+                           (self.worker_id, now)).fetchone()[0]
+
+        if owned > share:
+            db.execute(
+                "UPDATE poll_leases SET worker_id = NULL, expires_at = 0 WHERE bucket IN "
+                "(SELECT bucket FROM poll_leases WHERE worker_id = ? ORDER BY bucket DESC LIMIT ?)",
+                (self.worker_id, owned - share)
+            )
+        elif owned < share:
+            db.execute(
+                "UPDATE poll_leases SET worker_id = ?, expires_at = ? WHERE bucket IN "
+                "(SELECT bucket FROM poll_leases WHERE worker_id IS NULL OR expires_at < ? ORDER BY bucket LIMIT ?)",
+                (self.worker_id, expires_at, now, share - owned)
+            )
+        db.commit()
+
+        buckets = frozenset(row[0] for row in db.execute(
+            "SELECT bucket FROM poll_leases WHERE worker_id = ? AND expires_at >= ?", (self.worker_id, now)))
+        if buckets != self.buckets:
+            logger.info(f"Worker {self.worker_id} now holds {len(buckets)}/{LEASE_BUCKETS} buckets "
+                        f"({live_workers} live workers)")
+        self.buckets = buckets
+        return buckets
+
+    def renew(self, db):
+        """批次进行中定期调用: 只续约已持有的桶, 不重新平衡; 返回仍然持有的桶
+
+        一个批次可能比 LEASE_TTL 更久, 只在批次之间心跳会让租约中途过期、被其他进程接管。
+        """
+        now = time.time()
+        if now - max(self.last_heartbeat, self.last_renewal) < HEARTBEAT_INTERVAL:
+            return self.buckets
+        self.last_renewal = now
+        db.execute("UPDATE poll_workers SET heartbeat_at = ? WHERE worker_id = ?", (now, self.worker_id))
+        db.execute("UPDATE poll_leases SET expires_at = ? WHERE worker_id = ? AND expires_at >= ?",
+                   (now + LEASE_TTL, self.worker_id, now))
+        db.commit()
+        buckets = frozenset(row[0] for row in db.execute(
+            "SELECT bucket FROM poll_leases WHERE worker_id = ? AND expires_at >= ?", (self.worker_id, now)))
+        if buckets != self.buckets:
+            logger.warning(f"Worker {self.worker_id} lost {len(self.buckets - buckets)} buckets during a batch")
+        self.buckets = buckets
+        return buckets
+
+    def owns(self, acc_id):
+        return acc_id % LEASE_BUCKETS in self.buckets
+
+    def release(self, db):
+        """正常退出时立即释放所有租约, 让其他进程无需等待过期"""
+        db.execute("UPDATE poll_leases SET worker_id = NULL, expires_at = 0 WHERE worker_id = ?", (self.worker_id,))
+        db.execute("DELETE FROM poll_workers WHERE worker_id = ?", (self.worker_id,))
+        db.commit()
+        self.buckets = frozenset()
@@ -0,0 +1,248 @@
+"""进程内的轮询与 IMAP 指标
+
+计数器、仪表和直方图都保存在本进程内存中, 由 /metrics 以 Prometheus 文本格式输出,
+管理后台的状态面板读取 snapshot()。独立的 poller.py 进程用 --metrics-port 单独暴露;
+Gunicorn 多 worker 时只有当选的 worker 有轮询指标, 其余 worker 通过 serve() 的
+本机端点转发它的指标 (见 app/leader.py)。
+不依赖 prometheus_client, 只实现这里用到的部分。
+"""
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 秒级耗时的默认分桶 (IMAP 单步耗时从几毫秒到超时的 30 秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            if not self.labelnames:
+                return self._values.get((), 0)
+            return {','.join(key): value for key, value in sorted(self._values.items())}
+
+
+class Gauge(Counter):
+    """可增可减的当前值; 传入 function 时在输出时调用它取值"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(self.labelnames, labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _collect(self):
+        if self._function is not None:
+            self.set(self._function())
+
+    def render(self):
+        self._collect()
+        return super().render()
+
+    def snapshot(self):
+        self._collect()
+        return super().snapshot()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # 每个桶的 (非累计) 计数 + 超出最大桶的计数, 总和, 总数
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total!r}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def _quantile(self, counts, count, q):
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound if bound != math.inf else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """每个标签组合的次数、平均值和 p50/p95 (取分桶上界的近似值)"""
+        with self._lock:
+            items = [(key, [*counts], total, count) for key, (counts, total, count) in self._values.items()]
+        result = {}
+        for key, counts, total, count in sorted(items):
+            result[','.join(key) or 'all'] = {
+                'count': count,
+                'avg': total / count if count else 0,
+                'p50': self._quantile(counts, count, 0.5),
+                'p95': self._quantile(counts, count, 0.95),
+            }
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """只读的指标端点: /metrics 输出 Prometheus 文本格式, /metrics.json 输出 snapshot()"""
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body, content_type = registry.render().encode(), TEXT_CONTENT_TYPE
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(registry.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """在后台线程中提供指标端点; port 为 0 时由系统分配, 实际地址见 server.server_address"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+poll_cycle_seconds = registry.register(Histogram(
+    'mailnest_poll_cycle_seconds', 'Time to poll one batch of due accounts and write the results'))
+poll_cycle_accounts = registry.register(Counter(
+    'mailnest_poll_accounts_total', 'Polled accounts by outcome (unchanged, changed, new_mail, error)', ['result']))
+poll_in_flight = registry.register(Gauge(
+    'mailnest_poll_in_flight', 'Mailbox checks currently running'))
+scheduler_lag_seconds = registry.register(Histogram(
+    'mailnest_scheduler_lag_seconds', 'Delay between an account falling due and being picked up',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)))
+scheduler_queue_size = registry.register(Gauge(
+    'mailnest_scheduler_queue_size', 'Accounts in the in-memory poll schedule'))
+imap_phase_seconds = registry.register(Histogram(
+    'mailnest_imap_phase_seconds', 'IMAP command latency by phase', ['phase']))
+imap_bytes_fetched = registry.register(Counter(
+    'mailnest_imap_bytes_fetched_total', 'Bytes of message data fetched over IMAP', ['kind']))
+imap_errors = registry.register(Counter(
+    'mailnest_imap_errors_total', 'Failed IMAP operations by operation and exception class', ['operation', 'error']))
+db_write_seconds = registry.register(Histogram(
+    'mailnest_poll_db_write_seconds', 'Time to write one batch of poll results'))
+poller_leader = registry.register(Gauge(
+    'mailnest_poller_leader', 'Whether this web worker holds the poller lease and runs the embedded poller'))
+
+
+def response_bytes(data):
+    """imaplib / AsyncIMAP4 响应中字面量 (邮件数据) 的字节数"""
+    return sum(len(item[1]) for item in data or () if isinstance(item, tuple) and isinstance(item[1], bytes))
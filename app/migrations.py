@@ -0,0 +1,306 @@
+"""版本化的数据库迁移
+
+每个迁移只执行一次, 已执行的版本记录在 schema_version 表中。
+引入本模块之前的数据库没有版本记录, 因此早期迁移必须是幂等的
+(CREATE ... IF NOT EXISTS, 加列前先检查列是否存在), 这样旧库会被补齐到最新结构。
+新增迁移只需在 MIGRATIONS 末尾追加, 不要修改已发布的迁移。
+"""
+import time
+import logging
+from app.leases import LEASE_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(db, table):
+    return {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(db, table, column, decl):
+    if column not in _columns(db, table):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _baseline(db):
+    # 用户表
+    db.execute('''CREATE TABLE IF NOT EXISTS users
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   username TEXT NOT NULL UNIQUE,
+                   password_hash TEXT NOT NULL)''')
+
+    # 账号表
+    db.execute('''CREATE TABLE IF NOT EXISTS accounts
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   email TEXT NOT NULL,
+                   auth_code TEXT NOT NULL,
+                   user_id INTEGER,
+                   FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE SET NULL)''')
+    _add_column(db, 'accounts', 'user_id', 'INTEGER')
+    _add_column(db, 'accounts', 'status', "TEXT DEFAULT 'unknown'")
+    _add_column(db, 'accounts', 'has_new_mail', 'INTEGER DEFAULT 0')
+    _add_column(db, 'accounts', 'last_mail_identifier', 'TEXT')
+
+    # 审计日志表
+    db.execute('''CREATE TABLE IF NOT EXISTS audit_logs
+                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   username TEXT NOT NULL,
+                   action TEXT NOT NULL,
+                   details TEXT,
+                   ip_address TEXT,
+                   timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    # 系统设置表 (用于存隔离模式开关)
+    db.execute('''CREATE TABLE IF NOT EXISTS system_settings
+                  (key TEXT PRIMARY KEY,
+                   value TEXT NOT NULL)''')
+
+
+def _push_columns(db):
+    # IDLE push flag and last time new mail was seen (unix epoch)
+    _add_column(db, 'accounts', 'push_enabled', 'INTEGER DEFAULT 0')
+    _add_column(db, 'accounts', 'last_mail_at', 'REAL')
+
+
+def _uid_columns(db):
+    # UID based change detection (replaces last_mail_identifier)
+    _add_column(db, 'accounts', 'uidvalidity', 'INTEGER')
+    _add_column(db, 'accounts', 'last_seen_uid', 'INTEGER')
+
+
+def _message_cache(db):
+    # 邮件缓存表 (content 为 NULL 表示只缓存了邮件头)
+    db.execute('''CREATE TABLE IF NOT EXISTS message_cache
+                  (account_id INTEGER NOT NULL,
+                   uid INTEGER NOT NULL,
+                   uidvalidity INTEGER,
+                   subject TEXT,
+                   sender TEXT,
+                   date TEXT,
+                   content TEXT,
+                   truncated INTEGER DEFAULT 0,
+                   size INTEGER,
+                   bytes INTEGER NOT NULL DEFAULT 0,
+                   cached_at REAL NOT NULL,
+                   PRIMARY KEY (account_id, uid))''')
+
+
+def _schedule_columns(db):
+    # per-account adaptive schedule (unix epoch / seconds)
+    _add_column(db, 'accounts', 'next_poll_at', 'REAL')
+    _add_column(db, 'accounts', 'poll_interval', 'REAL')
+
+
+def _poll_leases(db):
+    # 轮询进程与账号分桶租约 (多个轮询进程共享同一个数据库)
+    db.execute('''CREATE TABLE IF NOT EXISTS poll_workers
+                  (worker_id TEXT PRIMARY KEY,
+                   hostname TEXT,
+                   pid INTEGER,
+                   started_at REAL,
+                   heartbeat_at REAL NOT NULL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS poll_leases
+                  (bucket INTEGER PRIMARY KEY,
+                   worker_id TEXT,
+                   expires_at REAL NOT NULL DEFAULT 0)''')
+    db.executemany("INSERT OR IGNORE INTO poll_leases (bucket) VALUES (?)",
+                   [(bucket,) for bucket in range(LEASE_BUCKETS)])
+
+
+def _indexes(db):
+    # 账号列表: [WHERE user_id = ?] ORDER BY has_new_mail DESC, id DESC
+    db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_user_new ON accounts (user_id, has_new_mail, id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_new ON accounts (has_new_mail, id)")
+    # 账号分配页: ORDER BY a.email
+    db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_email ON accounts (email)")
+    # 审计日志: ORDER BY timestamp DESC LIMIT 100
+    db.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs (timestamp)")
+    # 邮件缓存淘汰: 按 cached_at 删除过期行
+    db.execute("CREATE INDEX IF NOT EXISTS idx_message_cache_cached_at ON message_cache (cached_at)")
+
+
+def _settings_version(db):
+    # system_settings 的任何写入都递增版本号, 供各进程的设置缓存判断是否需要重新加载
+    db.execute('''CREATE TABLE IF NOT EXISTS settings_version
+                  (id INTEGER PRIMARY KEY CHECK (id = 1),
+                   version INTEGER NOT NULL)''')
+    db.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS system_settings_{event.lower()}
+                       AFTER {event} ON system_settings
+                       BEGIN UPDATE settings_version SET version = version + 1 WHERE id = 1; END''')
+
+
+# 这些列变化时账号列表需要更新 (轮询只改 next_poll_at 等调度列时不算)
+CHANGE_TRACKED_COLUMNS = ('email', 'status', 'has_new_mail', 'push_enabled', 'user_id', 'last_mail_at')
+
+
+def _change_tracking(db):
+    # 全局单调递增的变更版本号; 每次新增/修改账号时把最新版本号写入该行的 change_version,
+    # 删除的账号记入 account_tombstones, 客户端据此只拉取某个版本之后的增量
+    db.execute('''CREATE TABLE IF NOT EXISTS change_counter
+                  (id INTEGER PRIMARY KEY CHECK (id = 1),
+                   version INTEGER NOT NULL,
+                   pruned_version INTEGER NOT NULL DEFAULT 0)''')
+    db.execute("INSERT OR IGNORE INTO change_counter (id, version) VALUES (1, 0)")
+    db.execute('''CREATE TABLE IF NOT EXISTS account_tombstones
+                  (account_id INTEGER PRIMARY KEY,
+                   user_id INTEGER,
+                   change_version INTEGER NOT NULL,
+                   deleted_at REAL NOT NULL)''')
+    _add_column(db, 'accounts', 'change_version', 'INTEGER NOT NULL DEFAULT 0')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_change_version ON accounts (change_version)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_account_tombstones_version ON account_tombstones (change_version)")
+
+    bump = "UPDATE change_counter SET version = version + 1 WHERE id = 1;"
+    stamp = "UPDATE accounts SET change_version = (SELECT version FROM change_counter WHERE id = 1) WHERE id = NEW.id;"
+    changed = ' OR '.join(f"OLD.{column} IS NOT NEW.{column}" for column in CHANGE_TRACKED_COLUMNS)
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS accounts_change_insert AFTER INSERT ON accounts "
+               f"BEGIN {bump} {stamp} END")
+    # 换了归属人时给原归属人留一条墓碑, 隔离模式下该账号会从原归属人的列表中移除
+    disown = ("INSERT OR REPLACE INTO account_tombstones (account_id, user_id, change_version, deleted_at) "
+              "SELECT OLD.id, OLD.user_id, version, strftime('%s', 'now') FROM change_counter "
+              "WHERE id = 1 AND OLD.user_id IS NOT NEW.user_id;")
+    db.execute(f"CREATE TRIGGER IF NOT EXISTS accounts_change_update "
+               f"AFTER UPDATE OF {', '.join(CHANGE_TRACKED_COLUMNS)} ON accounts WHEN {changed} "
+               f"BEGIN {bump} {stamp} {disown} END")
+    db.execute(f"""CREATE TRIGGER IF NOT EXISTS accounts_change_delete AFTER DELETE ON accounts
+                   BEGIN {bump}
+                   INSERT OR REPLACE INTO account_tombstones (account_id, user_id, change_version, deleted_at)
+                   VALUES (OLD.id, OLD.user_id, (SELECT version FROM change_counter WHERE id = 1), strftime('%s', 'now'));
+                   END""")
+
+
+def _jobs(db):
+    # 后台任务 (批量导入等) 的进度; errors 为逐行错误的 JSON 数组
+    db.execute('''CREATE TABLE IF NOT EXISTS jobs
+                  (id TEXT PRIMARY KEY,
+                   kind TEXT NOT NULL,
+                   user_id INTEGER,
+                   status TEXT NOT NULL,
+                   total INTEGER,
+                   processed INTEGER NOT NULL DEFAULT 0,
+                   succeeded INTEGER NOT NULL DEFAULT 0,
+                   skipped INTEGER NOT NULL DEFAULT 0,
+                   failed INTEGER NOT NULL DEFAULT 0,
+                   errors TEXT,
+                   message TEXT,
+                   created_at REAL NOT NULL,
+                   updated_at REAL NOT NULL,
+                   finished_at REAL)''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at)")
+
+
+def _last_error_column(db):
+    # 最近一次登录/检查失败的原因, 只在 status = 'error' 时有意义
+    _add_column(db, 'accounts', 'last_error', 'TEXT')
+
+
+def _audit_indexes(db):
+    # 审计日志按 id 倒序做 keyset 分页, 按操作人 / 操作类型筛选时走对应索引
+    db.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_username ON audit_logs (username, id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_audit_logs_action ON audit_logs (action, id)")
+
+
+def _messages(db):
+    # 每个账号最近 N 封邮件的历史; body 为 zlib 压缩的净化后正文, NULL 表示只有邮件头
+    db.execute('''CREATE TABLE IF NOT EXISTS messages
+                  (account_id INTEGER NOT NULL,
+                   uid INTEGER NOT NULL,
+                   uidvalidity INTEGER,
+                   subject TEXT,
+                   sender TEXT,
+                   date TEXT,
+                   size INTEGER,
+                   body BLOB,
+                   truncated INTEGER NOT NULL DEFAULT 0,
+                   bytes INTEGER NOT NULL DEFAULT 0,
+                   stored_at REAL NOT NULL,
+                   PRIMARY KEY (account_id, uid))''')
+    # 总大小超限时按 stored_at 从旧到新淘汰
+    db.execute("CREATE INDEX IF NOT EXISTS idx_messages_stored_at ON messages (stored_at)")
+
+
+def _poller_leader(db):
+    # 多个 Web worker 中只有持有这一行租约的那个运行内嵌轮询 (见 app/leader.py)
+    db.execute('''CREATE TABLE IF NOT EXISTS poller_leader
+                  (id INTEGER PRIMARY KEY CHECK (id = 1),
+                   worker_id TEXT,
+                   hostname TEXT,
+                   pid INTEGER,
+                   acquired_at REAL,
+                   expires_at REAL NOT NULL DEFAULT 0)''')
+    db.execute("INSERT OR IGNORE INTO poller_leader (id) VALUES (1)")
+
+
+def _lowercase_emails(db):
+    # 导入和手动添加都把邮箱规范为小写并按小写查重; 旧版本手动添加的账号保留了原始大小写
+    db.execute("UPDATE accounts SET email = lower(trim(email)) WHERE email != lower(trim(email))")
+    duplicates = db.execute("SELECT COUNT(*) FROM (SELECT email FROM accounts GROUP BY email "
+                            "HAVING COUNT(*) > 1)").fetchone()[0]
+    if duplicates:
+        # 不自动删除账号, 由管理员在账号列表中处理
+        logger.warning(f"{duplicates} email addresses now belong to more than one account")
+
+
+def _leader_metrics_address(db):
+    # 当选 worker 的本机指标端点, 其他 worker 的 /metrics 转发到这里
+    _add_column(db, 'poller_leader', 'metrics_address', 'TEXT')
+
+
+# (版本号, 名称, 函数), 版本号从 1 开始连续递增
+MIGRATIONS = [
+    (1, 'baseline', _baseline),
+    (2, 'push columns', _push_columns),
+    (3, 'uid columns', _uid_columns),
+    (4, 'message cache', _message_cache),
+    (5, 'schedule columns', _schedule_columns),
+    (6, 'poll leases', _poll_leases),
+    (7, 'indexes', _indexes),
+    (8, 'settings version', _settings_version),
+    (9, 'change tracking', _change_tracking),
+    (10, 'jobs', _jobs),
+    (11, 'last error column', _last_error_column),
+    (12, 'audit indexes', _audit_indexes),
+    (13, 'messages', _messages),
+    (14, 'poller leader', _poller_leader),
+    (15, 'lowercase emails', _lowercase_emails),
+    (16, 'leader metrics address', _leader_metrics_address),
+]
+
+
+def current_version(db):
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(db):
+    """执行所有未执行的迁移, 返回执行后的版本号
+
+    每个迁移在自己的 IMMEDIATE 事务中执行并在事务内重新检查版本,
+    多个进程 (Web + 多个 poller) 同时启动时只有一个会真正执行。
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                  (version INTEGER PRIMARY KEY,
+                   name TEXT NOT NULL,
+                   applied_at REAL NOT NULL)''')
+    db.commit()
+
+    for version, name, apply in MIGRATIONS:
+        if version <= current_version(db):
+            continue
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= current_version(db):
+                db.rollback()
+                continue
+            apply(db)
+            db.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                       (version, name, time.time()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception(f"Migration {version} ({name}) failed")
+            raise
+        logger.info(f"Applied migration {version}: {name}")
+
+    return current_version(db)
@@ -1,125 +1,410 @@
+import asyncio
+import random
 import threading
 import time
 import logging
 import concurrent.futures
 from app.db import get_db
-from app.services.email_service import fetch_latest_mail
+from app.settings import settings
+from app.events import hub as event_hub
+from app.push import IdlePushService
+from app.scheduler import PollScheduler, next_interval, jittered
+from app.leases import LeaseManager, bucket_filter
+from app import audit_archive, metrics
+from app.services.email_service import check_mailbox, check_mailbox_async, async_session_pool
+from app.services.message_cache import message_cache
+from app.services import message_store
 
 logger = logging.getLogger(__name__)
 
+# 多久从数据库重新加载一次调度队列 (新增/删除的账号、状态变化)
+SCHEDULE_REFRESH_INTERVAL = 30
+# 没有到期账号或轮询关闭时, 最长休眠多久再检查配置
+IDLE_SLEEP = 5
+
+# 结果写入数据库的批次大小和最长等待时间
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 1.0
+
+
+class ResultWriter:
+    """在轮询线程中把账号检查结果分批写回数据库
+
+    同类 UPDATE 合并为 executemany, 每批一个事务, 尽量缩短写锁的持有时间。
+    某一批失败时回滚并逐行重试, 只跳过出错的那一行。
+    等待结果期间顺带续约桶租约; 写入前丢弃已不属于本进程的账号, 由新的持有者重新轮询。
+    """
+
+    def __init__(self, db, scheduler, min_interval, max_interval, leases):
+        self.db = db
+        self.scheduler = scheduler
+        self.leases = leases
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.written = 0
+        self.failed = 0
+
+    def add(self, res):
+        if res['status'] != 'success':
+            outcome = 'error'
+        else:
+            outcome = 'new_mail' if res['has_new'] else 'changed' if res['changed'] else 'unchanged'
+        metrics.poll_cycle_accounts.inc(result=outcome)
+        self.pending.append(res)
+        if len(self.pending) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def tick(self):
+        """等待结果的间隙调用, 到时间就续约租约、把已有结果提交"""
+        try:
+            self.leases.renew(self.db)
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Lease renewal error: {e}")
+        if self.pending and time.monotonic() - self.last_flush >= WRITE_FLUSH_INTERVAL:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        try:
+            message_cache.evict(self.db)
+            message_store.evict(self.db)
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Message cache eviction error: {e}")
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        self.last_flush = time.monotonic()
+        owned = [res for res in batch if self.leases.owns(res['id'])]
+        if len(owned) < len(batch):
+            logger.warning(f"Dropping {len(batch) - len(owned)} results for accounts whose lease moved to another worker")
+        batch = owned
+        if not batch:
+            return
+
+        now = time.time()
+        for res in batch:
+            res['poll_interval'] = next_interval(res['poll_interval'], res.get('has_new', False),
+                                                 self.min_interval, self.max_interval)
+            res['next_poll_at'] = now + jittered(res['poll_interval'])
+
+        with metrics.db_write_seconds.time():
+            try:
+                self._write(batch, now)
+                self.db.commit()
+                self.written += len(batch)
+            except Exception as e:
+                self.db.rollback()
+                logger.error(f"Database update error ({len(batch)} rows), retrying row by row: {e}")
+                for res in batch:
+                    try:
+                        self._write([res], now)
+                        self.db.commit()
+                        self.written += 1
+                    except Exception as e_row:
+                        self.db.rollback()
+                        self.failed += 1
+                        logger.error(f"Database update error for account {res['id']}: {e_row}")
+
+        for res in batch:
+            self.scheduler.schedule(res['id'], res['next_poll_at'])
+        # 同进程内的 SSE 事件源立即读取这批变化
+        event_hub.notify()
+
+    def _write(self, batch, now):
+        new_mail, changed, unchanged, errors = [], [], [], []
+        for res in batch:
+            if res['status'] != 'success':
+                # Error accounts leave the queue until they are fixed (next refresh skips them)
+                errors.append((res['status'], res.get('message'), res['next_poll_at'], res['id']))
+            elif res['has_new']:
+                new_mail.append((res['status'], res['uidvalidity'], res['last_seen_uid'], now,
+                                 res['poll_interval'], res['next_poll_at'], res['id']))
+            elif res['changed']:
+                changed.append((res['status'], res['uidvalidity'], res['last_seen_uid'],
+                                res['poll_interval'], res['next_poll_at'], res['id']))
+            else:
+                # Nothing moved: keep has_new_mail whatever it was (1 or 0), only refresh status
+                unchanged.append((res['status'], res['poll_interval'], res['next_poll_at'], res['id']))
+
+        if new_mail:
+            self.db.executemany("UPDATE accounts SET status = ?, has_new_mail = 1, uidvalidity = ?, last_seen_uid = ?, "
+                                "last_mail_at = ?, poll_interval = ?, next_poll_at = ? WHERE id = ?", new_mail)
+        if changed:
+            self.db.executemany("UPDATE accounts SET status = ?, uidvalidity = ?, last_seen_uid = ?, "
+                                "poll_interval = ?, next_poll_at = ? WHERE id = ?", changed)
+        if unchanged:
+            self.db.executemany("UPDATE accounts SET status = ?, poll_interval = ?, next_poll_at = ? WHERE id = ?",
+                                unchanged)
+        if errors:
+            self.db.executemany("UPDATE accounts SET status = ?, last_error = ?, next_poll_at = ? WHERE id = ?", errors)
+
+        for res in batch:
+            if res.get('has_new') and res.get('message'):
+                message_cache.put(self.db, res['id'], res['message'], commit=False)
+                message_store.put(self.db, res['id'], res['message'])
+
+
 class PollingService:
-    def __init__(self, app):
+    def __init__(self, app, worker_id=None):
         self.app = app
         self.thread = threading.Thread(target=self._run_loop, daemon=True)
-        self.last_run_time = 0
+        self._stop = threading.Event()
+        # 设置变化时立即唤醒轮询线程, 而不是等休眠结束
+        self._wake = threading.Event()
+        settings.subscribe(self._wake.set)
+        # 多个轮询进程共享数据库时, 通过租约划分各自负责的账号
+        self.leases = LeaseManager(worker_id)
+        # 按 next_poll_at 排序的账号队列, 定期从数据库重建
+        self.scheduler = PollScheduler()
+        self.last_refresh_time = 0
+        self.last_archive_time = 0
+        # 异步模式使用的事件循环, 只在轮询线程中创建和使用
+        self.loop = None
+        # 线程池模式的执行器, 并发数变化时重建
+        self.executor = None
+        self.executor_size = 0
+        # IDLE 推送服务, 其持有的账号不再参与轮询
+        self.push = IdlePushService(app, self.leases)
 
     def start(self):
+        """在后台线程中运行 (Web 进程内嵌模式)"""
+        settings.watch(self.app)
         self.thread.start()
+        self.push.start()
+
+    def run_forever(self):
+        """在当前线程中运行, 直到 stop() 被调用 (独立轮询进程)"""
+        settings.watch(self.app)
+        self.push.start()
+        self._run_loop()
+
+    def stop(self):
+        settings.unsubscribe(self._wake.set)
+        self._stop.set()
+        self._wake.set()
+        self.push.stop()
+
+    def shutdown(self, timeout=None):
+        """停止并等待当前批次的检查和写库完成、租约释放; 在轮询线程以外调用
+
+        返回是否在 timeout 秒内结束。超时未结束的批次不会写入结果, 这些账号之后会被重新轮询。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.stop()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self.push.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not self.thread.is_alive()
 
     def _run_loop(self):
-        logger.info("Polling service started")
-        while True:
+        logger.info(f"Polling service started (worker {self.leases.worker_id})")
+        while not self._stop.is_set():
+            delay = IDLE_SLEEP
             try:
                 with self.app.app_context():
-                    self._check_and_poll()
+                    delay = self._check_and_poll()
             except Exception as e:
                 logger.error(f"Polling loop error: {e}")
             
-            # Check configuration every 5 seconds
-            time.sleep(5) 
+            if delay > 0:
+                self._wake.wait(delay)
+            self._wake.clear()
+
+        try:
+            with self.app.app_context():
+                self.leases.release(get_db())
+        except Exception as e:
+            logger.error(f"Lease release error: {e}")
+        logger.info(f"Polling service stopped (worker {self.leases.worker_id})")
 
     def _check_and_poll(self):
+        """轮询一批到期账号, 返回到下一次检查前需要休眠的秒数"""
         db = get_db()
         
-        # Get settings
-        enabled_row = db.execute("SELECT value FROM system_settings WHERE key='polling_enabled'").fetchone()
-        interval_row = db.execute("SELECT value FROM system_settings WHERE key='polling_interval'").fetchone()
+        # Get settings (进程内缓存, 其他进程修改后约一秒内生效)
+        config = settings.all(db)
+        enabled = config['polling_enabled']
+        interval = config['polling_interval']
+        min_interval = config['polling_min_interval']
+        max_interval = config['polling_max_interval']
+        mode = config['polling_mode']
+        concurrency = config['polling_concurrency']
+
+        # 审计日志归档与轮询开关无关; 多个轮询进程同时执行时后到的找不到可移动的行
+        if time.time() - self.last_archive_time >= audit_archive.ARCHIVE_INTERVAL:
+            self.last_archive_time = time.time()
+            try:
+                audit_archive.run(self.app.config, config['audit_retention_days'])
+            except Exception as e:
+                logger.error(f"Audit log archiving error: {e}")
 
-        enabled = enabled_row and enabled_row['value'] == '1'
-        interval = int(interval_row['value']) if interval_row else 300
+        # 关闭轮询时也要续约: IDLE 推送按同一组桶选择账号, 租约过期后其他进程会重复建立连接
+        buckets = self.leases.buckets
+        if self.leases.heartbeat(db) != buckets:
+            # 持有的桶发生变化, 立即按新的分片重建队列
+            self.last_refresh_time = 0
 
         if not enabled:
-            return
+            self.last_refresh_time = 0
+            return IDLE_SLEEP
 
         now = time.time()
-        if self.last_run_time > 0 and (now - self.last_run_time) < interval:
-            return
+        if now - self.last_refresh_time >= SCHEDULE_REFRESH_INTERVAL:
+            self._refresh_schedule(db, interval, now)
+            self.last_refresh_time = now
 
-        logger.info("Starting polling cycle...")
-        self.last_run_time = now
-        
-        # Fetch accounts (exclude status='error')
-        query = "SELECT id, email, auth_code, last_mail_identifier FROM accounts WHERE status != 'error' OR status IS NULL"
-        accounts = db.execute(query).fetchall()
+        due_ids = [acc_id for acc_id in self.scheduler.pop_due(now, max(concurrency * 5, 50)) if self.leases.owns(acc_id)]
+        metrics.scheduler_queue_size.set(len(self.scheduler))
+        if not due_ids:
+            next_due = self.scheduler.next_due()
+            return IDLE_SLEEP if next_due is None else min(IDLE_SLEEP, max(0.5, next_due - now))
+
+        # Fetch the due accounts (exclude status='error')
+        accounts = []
+        for i in range(0, len(due_ids), 500):
+            chunk = due_ids[i:i + 500]
+            accounts += db.execute(
+                f"SELECT id, email, auth_code, uidvalidity, last_seen_uid, poll_interval FROM accounts "
+                f"WHERE id IN ({','.join('?' * len(chunk))}) AND (status != 'error' OR status IS NULL)", chunk
+            ).fetchall()
         
         # Prepare data for threads to avoid passing SQLite Row objects across threads
-        account_data_list = [{'id': row['id'], 'email': row['email'], 'auth_code': row['auth_code'], 'last_identifier': row['last_mail_identifier']} for row in accounts]
+        account_data_list = []
+        deferred = []
+        for row in accounts:
+            acc_interval = row['poll_interval'] or interval
+            if row['id'] in self.push.active_ids:
+                # Accounts held in IDLE are notified by push, just push their schedule forward
+                deferred.append((now + jittered(acc_interval), row['id']))
+                continue
+            account_data_list.append({'id': row['id'], 'email': row['email'], 'auth_code': row['auth_code'],
+                                      'uidvalidity': row['uidvalidity'], 'last_seen_uid': row['last_seen_uid'],
+                                      'poll_interval': acc_interval})
+
+        if deferred:
+            db.executemany("UPDATE accounts SET next_poll_at = ? WHERE id = ?", deferred)
+            db.commit()
+            for due, acc_id in deferred:
+                self.scheduler.schedule(acc_id, due)
+
+        if not account_data_list:
+            return 0
+
+        logger.info(f"Polling {len(account_data_list)} due accounts...")
+        # 结果边完成边写入: 按条数或时间分批提交, 界面几秒内就能看到进度
+        writer = ResultWriter(db, self.scheduler, min_interval, max_interval, self.leases)
+        with metrics.poll_cycle_seconds.time():
+            if mode == 'thread':
+                self._poll_threaded(account_data_list, concurrency, writer)
+            else:
+                self._poll_async(account_data_list, concurrency, writer)
+            writer.close()
+        logger.info(f"Updated {writer.written} accounts status"
+                    + (f", {writer.failed} failed." if writer.failed else "."))
 
+        return 0
+
+    def _refresh_schedule(self, db, base_interval, now):
+        """从数据库重建调度队列; 从未调度过的账号在一个基础间隔内均匀铺开"""
+        condition, params = bucket_filter(self.leases.buckets)
+        rows = db.execute(f"SELECT id, next_poll_at FROM accounts WHERE (status != 'error' OR status IS NULL) AND {condition}",
+                          params).fetchall()
+        unscheduled = [(now + random.uniform(0, base_interval), row['id']) for row in rows if row['next_poll_at'] is None]
+        if unscheduled:
+            db.executemany("UPDATE accounts SET next_poll_at = ? WHERE id = ?", unscheduled)
+            db.commit()
+        schedule = {row['id']: row['next_poll_at'] for row in rows}
+        schedule.update({acc_id: due for due, acc_id in unscheduled})
+        self.scheduler.load(schedule.items())
+
+    @staticmethod
+    def _evaluate(acc_info, result):
+        """把 check_mailbox 的结果整理为待写入数据库的记录"""
+        if result['status'] != 'success':
+            return {'id': acc_info['id'], 'status': 'error', 'poll_interval': acc_info['poll_interval'],
+                    'message': result.get('message')}
+
+        return {
+            'id': acc_info['id'],
+            'status': 'success',
+            'poll_interval': acc_info['poll_interval'],
+            'changed': result['changed'],
+            'has_new': result['has_new'],
+            'uidvalidity': result['uidvalidity'],
+            'last_seen_uid': result['last_seen_uid'],
+            # 最新一封的邮件头, 写入邮件缓存
+            'message': {k: result.get(k) for k in ('uid', 'uidvalidity', 'subject', 'sender', 'date', 'size')}
+                       if result.get('uid') is not None else None
+        }
+
+    def _poll_threaded(self, account_data_list, concurrency, writer):
+        """回退模式: 阻塞的 imaplib + 线程池"""
         def poll_task(acc_info):
+            metrics.poll_in_flight.inc()
             try:
                 # 这里的逻辑主要是网络 IO 操作
-                result = fetch_latest_mail(acc_info['email'], acc_info['auth_code'])
-                new_status = 'success' if result['status'] == 'success' else 'error'
-                
-                # Check for new mail
-                has_new = False
-                current_identifier = None
-                if new_status == 'success':
-                    # Create a simple identifier: "subject|sender" (or handle potential None values)
-                    subject = result.get('subject', '')
-                    sender = result.get('sender', '')
-                    current_identifier = f"{subject}|{sender}"
-                    
-                    # If identifier changed and not empty, it's new mail
-                    # Note: First time run (last_identifier is None) -> also counts as new if we want,
-                    # or only if it changes. Let's assume initialized accounts have None.
-                    # If we set has_new=True on first run, all accounts will light up.
-                    # However, "Polling" implies looking for updates.
-                    # If last_identifier is None, maybe we just save it but don't flag as new?
-                    # Or we flag it as new so user sees it? Let's flag as new to be safe.
-                    if current_identifier != acc_info['last_identifier']:
-                        has_new = True
-                
-                return {
-                    'id': acc_info['id'], 
-                    'status': new_status, 
-                    'has_new': has_new,
-                    'identifier': current_identifier
-                }
+                result = check_mailbox(acc_info['email'], acc_info['auth_code'],
+                                       acc_info['uidvalidity'], acc_info['last_seen_uid'])
+                return self._evaluate(acc_info, result)
             except Exception as e_poll:
                 logger.error(f"Thread error polling {acc_info['email']}: {e_poll}")
                 return None
+            finally:
+                metrics.poll_in_flight.dec()
 
-        # 使用线程池并发执行，例如最多 10 个并发
-        results_to_update = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            # 提交任务
-            future_to_acc = {executor.submit(poll_task, acc): acc for acc in account_data_list}
-            
-            for future in concurrent.futures.as_completed(future_to_acc):
+        if self.executor is None or self.executor_size != concurrency:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency))
+            self.executor_size = concurrency
+
+        # 提交任务, 完成一个写入一个; 回到本线程写库 (避免 SQLite 多线程写锁问题)
+        pending = {self.executor.submit(poll_task, acc) for acc in account_data_list}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=WRITE_FLUSH_INTERVAL,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
                 res = future.result()
                 if res:
-                    results_to_update.append(res)
-        
-        # 回到主循环线程统一更新数据库 (避免 SQLite 多线程写锁问题)
-        if results_to_update:
-            try:
-                for res in results_to_update:
-                    if res['status'] == 'success':
-                         if res['has_new']:
-                            db.execute("UPDATE accounts SET status = ?, has_new_mail = 1, last_mail_identifier = ? WHERE id = ?", 
-                                       (res['status'], res['identifier'], res['id']))
-                         else:
-                            # Just update status (keep has_new_mail as is, usually)
-                            # Or if it's the SAME email, has_new_mail should stay whatever it was (1 or 0).
-                            # So we don't touch has_new_mail unless it's new.
-                            db.execute("UPDATE accounts SET status = ? WHERE id = ?", (res['status'], res['id']))
-                    else:
-                         db.execute("UPDATE accounts SET status = ? WHERE id = ?", (res['status'], res['id']))
-                         
-                db.commit()
-                logger.info(f"Updated {len(results_to_update)} accounts status.")
-            except Exception as e:
-                logger.error(f"Database update error: {e}")
+                    writer.add(res)
+            writer.tick()
+
+    def _poll_async(self, account_data_list, concurrency, writer):
+        """默认模式: 单线程事件循环, 同时保持数百个 IMAP 连接"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+
+        async def poll_task(acc_info, semaphore):
+            async with semaphore:
+                metrics.poll_in_flight.inc()
+                try:
+                    result = await check_mailbox_async(acc_info['email'], acc_info['auth_code'],
+                                                       acc_info['uidvalidity'], acc_info['last_seen_uid'])
+                    return self._evaluate(acc_info, result)
+                except Exception as e_poll:
+                    logger.error(f"Async error polling {acc_info['email']}: {e_poll}")
+                    return None
+                finally:
+                    metrics.poll_in_flight.dec()
+
+        async def poll_all():
+            # 先回收超时的空闲会话, 并给其余会话发 NOOP 保活
+            await async_session_pool.sweep()
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+            # 写库在事件循环所在的线程中同步执行, 单批很短, 不会明显阻塞其它连接
+            pending = {asyncio.ensure_future(poll_task(acc, semaphore)) for acc in account_data_list}
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=WRITE_FLUSH_INTERVAL,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    res = task.result()
+                    if res:
+                        writer.add(res)
+                writer.tick()
 
-        logger.info("Polling cycle completed")
+        self.loop.run_until_complete(poll_all())
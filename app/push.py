@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+import logging
+from app.db import get_db
+from app.settings import settings
+from app.services.async_imap import IMAPError
+from app.services.email_service import open_imap_session_async
+from app.services.imap_pool import budget
+from app.leases import bucket_filter
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177: 客户端应至少每 29 分钟重新发起一次 IDLE
+IDLE_REISSUE_INTERVAL = 29 * 60
+# 多久重新计算一次需要保持 IDLE 的账号集合
+SELECTION_REFRESH_INTERVAL = 30
+RETRY_BACKOFF_MAX = 600
+
+
+class IdlePushService:
+    """为选定账号保持 IMAP IDLE 连接, 服务器推送 EXISTS 时立即标记新邮件。
+
+    选中的账号: 手动标记 push_enabled 的账号优先, 其次是最近收到过邮件的账号,
+    总数受 push_max_connections 限制。超出额度或连接失败的账号继续由轮询处理,
+    active_ids 中的账号会被 PollingService 跳过。
+    """
+
+    def __init__(self, app, leases):
+        self.app = app
+        # 只为本进程租约内的账号保持 IDLE
+        self.leases = leases
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.active_ids = set()
+        self._tasks = {}
+        self._loop = None
+        self._wake = None
+        self._stopping = threading.Event()
+        # 推送开关或额度变化时立即重新选择账号
+        settings.subscribe(self._on_settings_changed)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """断开所有 IDLE 连接并结束后台线程 (可在其他线程中调用)"""
+        settings.unsubscribe(self._on_settings_changed)
+        self._stopping.set()
+        self._on_settings_changed()
+
+    def join(self, timeout=None):
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def _run(self):
+        logger.info("IDLE push service started")
+        self._loop = asyncio.new_event_loop()
+        with self.app.app_context():
+            self._loop.run_until_complete(self._supervise())
+
+    def _on_settings_changed(self):
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _supervise(self):
+        self._wake = asyncio.Event()
+        if not self.leases.buckets:
+            # 轮询线程的第一次心跳可能还没完成; 先认领租约, 否则要等下一次重新选择 (约 30 秒) 才有账号
+            try:
+                await self._loop.run_in_executor(None, self._claim_leases)
+            except Exception as e:
+                logger.error(f"IDLE lease claim error: {e}")
+        while not self._stopping.is_set():
+            try:
+                self._reconcile()
+            except Exception as e:
+                logger.error(f"IDLE supervisor error: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), SELECTION_REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+        tasks = [task for task, _ in self._tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        logger.info("IDLE push service stopped")
+
+    def _select_accounts(self):
+        db = get_db()
+        config = settings.all(db)
+        if not config['push_enabled']:
+            return {}
+
+        max_connections = config['push_max_connections']
+        recent_since = time.time() - 3600 * config['push_recent_hours']
+
+        condition, params = bucket_filter(self.leases.buckets)
+        rows = db.execute(
+            f"""SELECT id, email, auth_code FROM accounts
+               WHERE (status != 'error' OR status IS NULL)
+                 AND (push_enabled = 1 OR last_mail_at >= ?)
+                 AND {condition}
+               ORDER BY push_enabled DESC, last_mail_at DESC
+               LIMIT ?""",
+            [recent_since] + params + [max_connections]
+        ).fetchall()
+        return {row['id']: (row['email'], row['auth_code']) for row in rows}
+
+    def _reconcile(self):
+        wanted = self._select_accounts()
+
+        for acc_id in list(self._tasks):
+            task, credentials = self._tasks[acc_id]
+            if wanted.get(acc_id) != credentials:
+                task.cancel()
+                del self._tasks[acc_id]
+
+        for acc_id, credentials in wanted.items():
+            if acc_id not in self._tasks:
+                task = asyncio.ensure_future(self._watch(acc_id, *credentials))
+                self._tasks[acc_id] = (task, credentials)
+
+    async def _watch(self, acc_id, username, password):
+        backoff = 5
+        while True:
+            if not budget.try_acquire(background=True):
+                # 全局连接额度已满, 该账号留给轮询处理
+                await asyncio.sleep(SELECTION_REFRESH_INTERVAL)
+                continue
+
+            server = None
+            try:
+                server = await open_imap_session_async(username, password)
+                typ, capabilities = await server.capability()
+                if b'IDLE' not in (capabilities[0] or b'').upper().split():
+                    logger.info(f"{username} 服务器不支持 IDLE, 回退到轮询")
+                    return
+
+                typ, data = await server.select('INBOX')
+                exists = int(data[-1]) if data and data[-1] else 0
+                self.active_ids.add(acc_id)
+                backoff = 5
+                logger.debug(f"{username} 进入 IDLE, 当前 {exists} 封邮件")
+
+                while True:
+                    exists = await self._idle_once(server, acc_id, exists)
+
+            except asyncio.CancelledError:
+                raise
+            except (IMAPError, OSError, asyncio.TimeoutError) as e:
+                logger.info(f"IDLE 连接中断: {username} ({e!r}), {backoff} 秒后重试")
+            except Exception as e:
+                logger.error(f"IDLE 未知错误: {username} ({e!r})")
+            finally:
+                self.active_ids.discard(acc_id)
+                if server is not None:
+                    server.shutdown()
+                budget.release()
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    async def _idle_once(self, server, acc_id, exists):
+        """执行一轮 IDLE, 返回最新的邮件数"""
+        await server.idle_start()
+        deadline = time.monotonic() + IDLE_REISSUE_INTERVAL
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await server.idle_wait(remaining):
+                break
+
+            responses = server.untagged_responses
+            server.untagged_responses = {}
+            exists -= len(responses.get('EXPUNGE', []))
+            latest = responses.get('EXISTS')
+            if latest:
+                count = int(latest[-1])
+                if count > exists:
+                    await self._mark_new_mail(acc_id)
+                exists = count
+
+        await server.idle_done()
+        return exists
+
+    def _claim_leases(self):
+        with self.app.app_context():
+            self.leases.heartbeat(get_db(), force=True)
+
+    async def _mark_new_mail(self, acc_id):
+        # 写库可能等待写锁 (最长 busy_timeout), 放到线程池中执行, 不阻塞其他 IDLE 连接
+        await self._loop.run_in_executor(None, self._write_new_mail, acc_id, time.time())
+        logger.info(f"IDLE 推送: 账号 {acc_id} 收到新邮件")
+
+    def _write_new_mail(self, acc_id, mail_at):
+        with self.app.app_context():
+            db = get_db()
+            db.execute("UPDATE accounts SET has_new_mail = 1, last_mail_at = ? WHERE id = ?", (mail_at, acc_id))
+            db.commit()
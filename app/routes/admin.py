@@ -1,11 +1,15 @@
 from flask import (
-    Blueprint, render_template, request, redirect, url_for, flash, g, jsonify
+    Blueprint, render_template, request, redirect, url_for, flash, g, jsonify, current_app
 )
 import sqlite3
 import re
+from datetime import date, timedelta
+from werkzeug.exceptions import BadRequest
 from werkzeug.security import generate_password_hash
-from app.auth import login_required
+from app.auth import login_required, user_cache
 from app.db import get_db
+from app.settings import settings
+from app import changes, audit_archive, leader, metrics
 from app.audit import log_audit
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -26,19 +30,16 @@ def dashboard():
     users = db.execute("SELECT * FROM users WHERE username != 'renjie'").fetchall()
     
     # Isolation Status
-    setting = db.execute("SELECT value FROM system_settings WHERE key='isolation_mode'").fetchone()
-    isolation_mode = setting['value'] == '1' if setting else False
+    isolation_mode = settings.get(db, 'isolation_mode')
     
     # Admin Permission Status
-    perm_setting = db.execute("SELECT value FROM system_settings WHERE key='allow_admin_dashboard'").fetchone()
-    allow_admin_dashboard = perm_setting['value'] == '1' if perm_setting else False
+    allow_admin_dashboard = settings.get(db, 'allow_admin_dashboard')
 
     # Default Ownership Mode (CHECK THIS: '1' = Self, '0' = Admin)
     # Default is '1' (Self) if not set, to match previous behavior? 
     # User request: "当开启后...默认归属权是添加人 (Self), 关闭后...默认归属权为admin"
     # So '1' = Self (Creator), '0' = Admin.
-    own_setting = db.execute("SELECT value FROM system_settings WHERE key='default_ownership_self'").fetchone()
-    default_ownership_self = own_setting['value'] == '1' if own_setting else True # Default to True (old behavior)
+    default_ownership_self = settings.get(db, 'default_ownership_self') # Default to True (old behavior)
 
     return render_template('admin_dashboard.html', 
                             users=users, 
@@ -46,14 +47,25 @@ def dashboard():
                             allow_admin_dashboard=allow_admin_dashboard,
                             default_ownership_self=default_ownership_self)
 
+@bp.route('/metrics.json')
+def metrics_snapshot():
+    """控制台状态面板: 轮询与 IMAP 指标摘要, 多 worker 时取自当选的 worker"""
+    address = leader.metrics_source(current_app, get_db())
+    if address is None:
+        return jsonify(metrics.registry.snapshot())
+    try:
+        return current_app.response_class(leader.fetch_metrics(address, '/metrics.json'),
+                                          mimetype='application/json')
+    except OSError as e:
+        return jsonify({"status": "error", "message": f"Poller metrics unavailable: {e}"}), 502
+
 @bp.route('/toggle_ownership_mode', methods=['POST'])
 def toggle_ownership_mode():
     mode = request.form.get('mode') # 'on' (Self) or 'off' (Admin)
     val = '1' if mode == 'on' else '0'
     
     db = get_db()
-    db.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('default_ownership_self', ?)", (val,))
-    db.commit()
+    settings.update(db, {'default_ownership_self': val == '1'})
     
     log_audit(g.user['username'], 'TOGGLE_OWNERSHIP', f"Set default ownership to {'Creator' if val=='1' else 'Admin'}")
     flash(f"已设置新账号默认归属为: {'添加人' if val=='1' else 'Admin 账户'}", "success")
@@ -68,8 +80,7 @@ def toggle_admin_access():
     val = '1' if mode == 'on' else '0'
     
     db = get_db()
-    db.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('allow_admin_dashboard', ?)", (val,))
-    db.commit()
+    settings.update(db, {'allow_admin_dashboard': val == '1'})
     
     log_audit(g.user['username'], 'TOGGLE_ADMIN_ACCESS', f"Set admin dashboard access to {val}")
     flash(f"已{'授权' if val=='1' else '禁止'} Admin 账号访问控制台", "success")
@@ -81,8 +92,7 @@ def toggle_isolation():
     val = '1' if mode == 'on' else '0'
     
     db = get_db()
-    db.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('isolation_mode', ?)", (val,))
-    db.commit()
+    settings.update(db, {'isolation_mode': val == '1'})
     
     log_audit(g.user['username'], 'TOGGLE_ISOLATION', f"Set isolation to {val}")
     flash(f"Data Isolation Mode turned {'ON' if val=='1' else 'OFF'}")
@@ -97,26 +107,98 @@ def users_list():
     users = db.execute(query).fetchall()
     return render_template('admin_users.html', users=users)
 
+# 审计日志分页: 每页默认条数与上限
+AUDIT_PAGE_SIZE = 100
+AUDIT_PAGE_MAX = 500
+
+def _query_audit_logs(db, args, schema='main'):
+    """按 id DESC 做 keyset 分页, 支持 user / action / since / until (YYYY-MM-DD, UTC) / q (详情包含) 筛选
+
+    schema 为 'archive' 时查询已归档的日志 (db 需挂载归档库, 见 app/audit_archive.py)。
+    """
+    conditions = []
+    params = []
+
+    # [STEALTH MODE] - Renjie's activities are hidden from all other admins.
+    # Renjie sees everything, including themselves.
+    if g.user['username'] != 'renjie':
+        conditions.append("username != 'renjie'")
+
+    if args.get('user'):
+        conditions.append("username = ?")
+        params.append(args['user'])
+    if args.get('action'):
+        conditions.append("action = ?")
+        params.append(args['action'])
+    try:
+        if args.get('since'):
+            conditions.append("timestamp >= ?")
+            params.append(f"{date.fromisoformat(args['since'])} 00:00:00")
+        if args.get('until'):
+            # until 当天也包含在内
+            conditions.append("timestamp < ?")
+            params.append(f"{date.fromisoformat(args['until']) + timedelta(days=1)} 00:00:00")
+    except ValueError:
+        raise BadRequest("Dates must be YYYY-MM-DD")
+    if args.get('q'):
+        conditions.append("details LIKE ?")
+        params.append(f"%{args['q']}%")
+    if args.get('cursor', '').isdigit():
+        conditions.append("id < ?")
+        params.append(int(args['cursor']))
+
+    try:
+        limit = min(max(int(args.get('limit', AUDIT_PAGE_SIZE)), 1), AUDIT_PAGE_MAX)
+    except ValueError:
+        limit = AUDIT_PAGE_SIZE
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = db.execute(f"SELECT id, username, action, details, ip_address, timestamp FROM {schema}.audit_logs{where} "
+                      f"ORDER BY id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    logs = [dict(row) for row in rows[:limit]]
+    next_cursor = logs[-1]['id'] if len(rows) > limit else None
+    return {'logs': logs, 'next_cursor': next_cursor}
+
 @bp.route('/audit_logs')
 def audit_logs():
-    db = get_db()
-    # [STEALTH MODE] - Renjie's activities are hidden from all other admins.
-    # Only 'renjie' can see 'renjie's logs (if necessary), or strictly hidden.
-    # Logic: Filter out 'renjie' for everyone.
-    
-    query = "SELECT * FROM audit_logs WHERE username != 'renjie' ORDER BY timestamp DESC LIMIT 100"
-    
-    # If the user asks to see their own logs specifically, we might allow it, 
-    # but for "invisible to others", excluding from the general list is key.
-    if g.user['username'] == 'renjie':
-         # Renjie sees everything, including themselves? 
-         # Or excluding themselves to maintain "Stealth"?
-         # Usually stealth means "hidden from OTHERS". 
-         # Let's let Renjie see everything.
-         query = "SELECT * FROM audit_logs ORDER BY timestamp DESC LIMIT 100"
+    archived = request.args.get('archived') == '1'
+    if archived:
+        conn = audit_archive.connect(current_app.config)
+        try:
+            page = _query_audit_logs(conn, request.args, schema='archive')
+        finally:
+            conn.close()
+    else:
+        page = _query_audit_logs(get_db(), request.args)
+
+    if request.args.get('format') == 'json':
+        return jsonify(page)
+
+    # 下一页链接保留当前的筛选条件
+    next_url = None
+    if page['next_cursor'] is not None:
+        next_args = {k: v for k, v in request.args.items() if k != 'cursor'}
+        next_url = url_for('admin.audit_logs', cursor=page['next_cursor'], **next_args)
+    return render_template('audit_logs.html', logs=page['logs'], next_url=next_url, filters=request.args,
+                           retention_days=settings.get(get_db(), 'audit_retention_days'))
+
+@bp.route('/audit_retention', methods=['POST'])
+def audit_retention():
+    if not g.is_super_admin:
+        return "Access Denied", 403
+
+    try:
+        days = int(request.form.get('days', '0'))
+        if days < 0:
+            raise ValueError
+    except ValueError:
+        flash("保留天数必须是非负整数", "error")
+        return redirect(url_for('admin.audit_logs'))
 
-    logs = db.execute(query).fetchall()
-    return render_template('audit_logs.html', logs=logs)
+    settings.update(get_db(), {'audit_retention_days': days})
+    log_audit(g.user['username'], 'UPDATE_AUDIT_RETENTION', f"Set audit retention to {days} days")
+    flash(f"审计日志保留天数已设置为 {days} 天" if days else "已关闭审计日志归档", "success")
+    return redirect(url_for('admin.audit_logs'))
 
 @bp.route('/bulk_assign', methods=['POST'])
 def bulk_assign():
@@ -227,9 +309,13 @@ def delete_user(user_id):
     if target_user['username'] in ['admin', 'renjie']:
         return "无法删除特殊账户", 403
 
+    db.execute("DELETE FROM message_cache WHERE account_id IN (SELECT id FROM accounts WHERE user_id=?)", (user_id,))
+    db.execute("DELETE FROM messages WHERE account_id IN (SELECT id FROM accounts WHERE user_id=?)", (user_id,))
     db.execute("DELETE FROM accounts WHERE user_id=?", (user_id,))
     db.execute("DELETE FROM users WHERE id=?", (user_id,))
+    changes.prune_tombstones(db)
     db.commit()
+    user_cache.invalidate(user_id)
     
     log_audit(g.user['username'], 'DELETE_USER', f'Deleted user ID: {user_id}')
     return redirect(url_for('admin.users_list'))
@@ -247,6 +333,7 @@ def reset_password(user_id):
 
     db.execute("UPDATE users SET password_hash=? WHERE id=?", (generate_password_hash('123456'), user_id))
     db.commit()
+    user_cache.invalidate(user_id)
     log_audit(g.user['username'], 'RESET_PASSWORD', f'Reset password for user ID: {user_id}')
     flash(f"已重置用户 {target_user['username']} 的密码为 123456")
     return redirect(url_for('admin.users_list'))
@@ -1,11 +1,19 @@
 from flask import (
-    Blueprint, render_template, request, jsonify, redirect, url_for, session, current_app, flash, g, send_file
+    Blueprint, render_template, request, jsonify, redirect, url_for, session, current_app, flash, g, send_file,
+    Response, stream_with_context
 )
-import pandas as pd
+import hmac
 import io
-from app.auth import login_required
+import os
+import tempfile
+import time
+from app.auth import login_required, user_cache
 from app.db import get_db
+from app.settings import settings
+from app import changes, events, importer, jobs, leader, metrics, validation
 from app.services.email_service import fetch_latest_mail
+from app.services.message_cache import message_cache
+from app.services import message_store
 from app.audit import log_audit
 from werkzeug.security import generate_password_hash 
 
@@ -17,45 +25,187 @@ def index():
     db = get_db()
     
     # Check Isolation Mode
-    isolation_setting = db.execute("SELECT value FROM system_settings WHERE key='isolation_mode'").fetchone()
-    is_isolated = isolation_setting and isolation_setting['value'] == '1'
+    config = settings.all(db)
+    is_isolated = config['isolation_mode']
     
     # Get Polling Settings
-    polling_enabled_row = db.execute("SELECT value FROM system_settings WHERE key='polling_enabled'").fetchone()
-    polling_interval_row = db.execute("SELECT value FROM system_settings WHERE key='polling_interval'").fetchone()
     polling_config = {
-        'enabled': polling_enabled_row and polling_enabled_row['value'] == '1',
-        'interval': polling_interval_row['value'] if polling_interval_row else '300'
+        'enabled': config['polling_enabled'],
+        'interval': config['polling_interval'],
+        'min_interval': config['polling_min_interval'],
+        'max_interval': config['polling_max_interval'],
+        'mode': config['polling_mode'],
+        'concurrency': config['polling_concurrency'],
+        'push_enabled': config['push_enabled'],
+        'push_max_connections': config['push_max_connections']
     }
 
-    query = "SELECT * FROM accounts"
-    params = []
-    
-    # Data Isolation Logic
-    if is_isolated:
-        if g.user['username'] not in ['admin', 'renjie']:
-            query += " WHERE user_id = ?"
-            params.append(g.user['id'])
-    
-    # Search logic
     search_query = request.args.get('search', '')
-    if search_query:
-        if 'WHERE' in query:
-            query += " AND email LIKE ?"
-        else:
-            query += " WHERE email LIKE ?"
-        params.append(f'%{search_query}%')
-
-    # Sorting: New Mail first, then ID desc
-    query += " ORDER BY has_new_mail DESC, id DESC"
-        
-    accounts = db.execute(query, params).fetchall()
+    page = _list_accounts(db, is_isolated, request.args)
     
     # Return JSON for AJAX requests (Auto-refresh)
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.args.get('format') == 'json':
-         return jsonify([dict(row) for row in accounts])
+         return jsonify(page)
+
+    return render_template('index.html', accounts=page['accounts'], total=page['total'], next_cursor=page['next_cursor'],
+                           change_version=page['version'], page_size=ACCOUNT_PAGE_SIZE,
+                           search_query=search_query, polling_config=polling_config)
+
+# 账号列表分页: 每页默认条数与上限
+ACCOUNT_PAGE_SIZE = 100
+ACCOUNT_PAGE_MAX = 500
+
+def _list_accounts(db, is_isolated, args):
+    """按 (has_new_mail DESC, id DESC) 做 keyset 分页
+
+    args: limit, cursor (上一页返回的 next_cursor), search, status, new ('1'/'0'), owner (用户 id, 仅管理员)
+    首页 (无 cursor) 额外返回符合条件的总数。version 为查询前的变更版本号, 用于之后拉取增量。
+    """
+    conditions = []
+    params = []
+    version = changes.current_version(db)
+
+    # Data Isolation Logic
+    owner_id = _isolated_owner(is_isolated)
+    if owner_id is not None:
+        conditions.append("user_id = ?")
+        params.append(owner_id)
+    elif args.get('owner', '').isdigit():
+        conditions.append("user_id = ?")
+        params.append(int(args['owner']))
+
+    # Search logic
+    if args.get('search'):
+        conditions.append("email LIKE ?")
+        params.append(f"%{args['search']}%")
+
+    if args.get('status') in ('success', 'error'):
+        conditions.append("status = ?")
+        params.append(args['status'])
+    elif args.get('status') == 'unknown':
+        conditions.append("(status IS NULL OR status NOT IN ('success', 'error'))")
 
-    return render_template('index.html', accounts=accounts, search_query=search_query, polling_config=polling_config)
+    if args.get('new') in ('0', '1'):
+        conditions.append("has_new_mail = ?")
+        params.append(int(args['new']))
+
+    try:
+        limit = min(max(int(args.get('limit', ACCOUNT_PAGE_SIZE)), 1), ACCOUNT_PAGE_MAX)
+    except ValueError:
+        limit = ACCOUNT_PAGE_SIZE
+
+    # cursor 格式: "<has_new_mail>:<id>", 取排在它之后的行
+    try:
+        has_new, last_id = (int(part) for part in args['cursor'].split(':'))
+    except (KeyError, ValueError):
+        has_new = last_id = None
+
+    # Sorting: New Mail first, then ID desc (多取一行判断是否还有下一页)
+    total = None
+    if last_id is None:
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = db.execute(f"SELECT COUNT(*) FROM accounts{where}", params).fetchone()[0]
+        rows = db.execute(f"SELECT {changes.ACCOUNT_COLUMNS} FROM accounts{where} "
+                          f"ORDER BY has_new_mail DESC, id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    else:
+        # 拆成 "同一 has_new_mail 内 id 更小" 和 "has_new_mail 更小" 两段,
+        # 两段都能直接在 (has_new_mail, id) 索引上定位, 翻到多深都不需要扫描前面的行
+        prefix = ''.join(f"{condition} AND " for condition in conditions)
+        rows = db.execute(
+            f"""SELECT * FROM (SELECT {changes.ACCOUNT_COLUMNS} FROM accounts
+                               WHERE {prefix}has_new_mail = ? AND id < ? ORDER BY id DESC LIMIT ?)
+                UNION ALL
+                SELECT * FROM (SELECT {changes.ACCOUNT_COLUMNS} FROM accounts
+                               WHERE {prefix}has_new_mail < ? ORDER BY has_new_mail DESC, id DESC LIMIT ?)
+                ORDER BY has_new_mail DESC, id DESC LIMIT ?""",
+            params + [has_new, last_id, limit + 1] + params + [has_new, limit + 1, limit + 1]
+        ).fetchall()
+
+    accounts = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = accounts[-1]
+        next_cursor = f"{last['has_new_mail'] or 0}:{last['id']}"
+    return {'accounts': accounts, 'next_cursor': next_cursor, 'total': total, 'version': version}
+
+def _isolated_owner(is_isolated):
+    """隔离模式下普通用户只能看到自己的账号, 返回需要限定的 user_id"""
+    if is_isolated and g.user['username'] not in ['admin', 'renjie']:
+        return g.user['id']
+    return None
+
+@bp.route('/api/accounts')
+@login_required
+def list_accounts():
+    db = get_db()
+    return jsonify(_list_accounts(db, settings.get(db, 'isolation_mode'), request.args))
+
+@bp.route('/api/accounts/changes')
+@login_required
+def account_changes():
+    """返回 since 版本之后变化或删除的账号; 没有变化时返回 304"""
+    db = get_db()
+    since = request.args.get('since', 0, type=int)
+    owner_id = _isolated_owner(settings.get(db, 'isolation_mode'))
+
+    version, changed, removed, reset = changes.changes_since(db, since, changes.ACCOUNT_COLUMNS, owner_id)
+    etag = str(version)
+    if not reset and (since == version or request.if_none_match.contains(etag)):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify({'version': version, 'changed': changed, 'removed': removed, 'reset': reset})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@bp.route('/events')
+@login_required
+def account_events():
+    """SSE: 推送账号状态 / 新邮件变化, 支持 Last-Event-ID (或 ?since=) 断线补发"""
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('since', type=int)
+    user_id = g.user['id']
+    is_admin = g.user['username'] in ['admin', 'renjie']
+    events.hub.ensure_started(current_app._get_current_object())
+    # 名额已满: EventSource 收到非 200 响应后不再重连, 页面改为轮询 /api/accounts/changes
+    if not events.hub.open_stream():
+        response = jsonify({"status": "error", "message": "Too many event streams"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(events.STREAM_MAX_AGE)
+        return response
+
+    def stream():
+        yield "retry: 3000\n\n"
+        cursor = last_id
+        # 到期后结束响应, 浏览器带 Last-Event-ID 重连, 释放的线程可以处理其他请求
+        deadline = time.monotonic() + events.STREAM_MAX_AGE
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            pending, cursor, reset = events.hub.wait(cursor, min(events.HEARTBEAT_INTERVAL, remaining))
+            if reset:
+                yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+                continue
+            # 每批重新读取隔离开关 (进程内缓存), 切换后对已连接的客户端立即生效
+            isolated = settings.get(get_db(), 'isolation_mode') and not is_admin
+            sent = False
+            for event in pending:
+                if isolated and event.user_id != user_id:
+                    continue
+                if event.owner_only and not isolated:
+                    continue
+                yield event.encode()
+                sent = True
+            if not sent:
+                yield ": keepalive\n\n"
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 响应关闭时 (正常结束或客户端断开) 归还名额; 生成器未开始执行时 finally 不会运行, 因此不放在生成器里
+    response.call_on_close(events.hub.close_stream)
+    return response
 
 @bp.route('/polling/config', methods=['POST'])
 @login_required
@@ -65,6 +215,12 @@ def polling_config():
     
     enabled = request.form.get('enabled') == 'true'
     interval = request.form.get('interval')
+    min_interval = request.form.get('min_interval', '30')
+    max_interval = request.form.get('max_interval', '3600')
+    mode = request.form.get('mode', 'async')
+    concurrency = request.form.get('concurrency', '200')
+    push_enabled = request.form.get('push_enabled') == 'true'
+    push_max_connections = request.form.get('push_max_connections', '100')
     
     try:
         interval_val = int(interval)
@@ -73,36 +229,72 @@ def polling_config():
     except:
         return jsonify({"status": "error", "message": "Invalid interval"}), 400
 
+    try:
+        min_interval_val = int(min_interval)
+        max_interval_val = int(max_interval)
+        if min_interval_val < 10 or max_interval_val < min_interval_val:
+             return jsonify({"status": "error", "message": "Interval bounds must satisfy 10 <= min <= max"}), 400
+    except:
+        return jsonify({"status": "error", "message": "Invalid interval bounds"}), 400
+
+    if mode not in ('async', 'thread'):
+        return jsonify({"status": "error", "message": "Invalid mode"}), 400
+
+    try:
+        concurrency_val = int(concurrency)
+        if not 1 <= concurrency_val <= 2000:
+             return jsonify({"status": "error", "message": "Concurrency must be between 1 and 2000"}), 400
+    except:
+        return jsonify({"status": "error", "message": "Invalid concurrency"}), 400
+
+    try:
+        push_max_val = int(push_max_connections)
+        if not 0 <= push_max_val <= 2000:
+             return jsonify({"status": "error", "message": "IDLE connections must be between 0 and 2000"}), 400
+    except:
+        return jsonify({"status": "error", "message": "Invalid IDLE connection budget"}), 400
+
     db = get_db()
-    db.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('polling_enabled', ?)", ('1' if enabled else '0',))
-    db.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('polling_interval', ?)", (str(interval_val),))
-    db.commit()
+    settings.update(db, {
+        'polling_enabled': enabled,
+        'polling_interval': interval_val,
+        'polling_min_interval': min_interval_val,
+        'polling_max_interval': max_interval_val,
+        'polling_mode': mode,
+        'polling_concurrency': concurrency_val,
+        'push_enabled': push_enabled,
+        'push_max_connections': push_max_val,
+    })
     
-    log_audit(g.user['username'], 'UPDATE_POLLING', f"Enabled: {enabled}, Interval: {interval_val}")
+    log_audit(g.user['username'], 'UPDATE_POLLING', f"Enabled: {enabled}, Interval: {interval_val} ({min_interval_val}-{max_interval_val}), Mode: {mode}, Concurrency: {concurrency_val}, "
+                                                     f"Push: {push_enabled}, Push connections: {push_max_val}")
     return jsonify({"status": "ok"})
 
 @bp.route('/add', methods=['POST'])
 @login_required
 def add_account():
-    email_addr = request.form['email']
-    auth_code = request.form['auth_code']
+    # 与批量导入相同的规范化 (邮箱小写) 和校验, 同一邮箱不会因大小写不同重复添加
+    email_addr, auth_code, error = importer.normalise(request.form['email'], request.form['auth_code'])
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
     
     db = get_db()
     
     # Ownership Logic
-    own_setting = db.execute("SELECT value FROM system_settings WHERE key='default_ownership_self'").fetchone()
-    default_ownership_self = own_setting['value'] == '1' if own_setting else True
-    
-    if default_ownership_self:
+    if settings.get(db, 'default_ownership_self'):
         user_id = g.user['id']
     else:
         admin_user = db.execute("SELECT id FROM users WHERE username='admin'").fetchone()
         user_id = admin_user['id'] if admin_user else g.user['id'] # Fallback to current if admin not found
     
     try:
-        db.execute("INSERT INTO accounts (email, auth_code, user_id) VALUES (?, ?, ?)", 
-                   (email_addr, auth_code, user_id))
+        # 查重和插入在同一条语句中完成, 并发添加同一邮箱时只有一个成功
+        cursor = db.execute("INSERT INTO accounts (email, auth_code, user_id) SELECT ?, ?, ? "
+                            "WHERE NOT EXISTS (SELECT 1 FROM accounts WHERE email = ?)",
+                            (email_addr, auth_code, user_id, email_addr))
         db.commit()
+        if cursor.rowcount == 0:
+            return jsonify({"status": "error", "message": "账号已存在"}), 409
         log_audit(g.user['username'], 'ADD_ACCOUNT', f"Added {email_addr}")
         return jsonify({"status": "ok"})
     except Exception as e:
@@ -114,70 +306,155 @@ def delete_account(acc_id):
     db = get_db()
     
     # Check permissions if isolated
-    isolation_setting = db.execute("SELECT value FROM system_settings WHERE key='isolation_mode'").fetchone()
-    is_isolated = isolation_setting and isolation_setting['value'] == '1'
+    is_isolated = settings.get(db, 'isolation_mode')
     
     if is_isolated and g.user['username'] not in ['admin', 'renjie']:
         acc = db.execute("SELECT user_id FROM accounts WHERE id = ?", (acc_id,)).fetchone()
         if not acc or acc['user_id'] != g.user['id']:
              return jsonify({"status": "error", "message": "Permission denied"}), 403
 
+    message_cache.invalidate(db, acc_id)
+    message_store.invalidate(db, acc_id)
     db.execute("DELETE FROM accounts WHERE id = ?", (acc_id,))
+    changes.prune_tombstones(db)
     db.commit()
     log_audit(g.user['username'], 'DELETE_ACCOUNT', f"Deleted account ID {acc_id}")
     return jsonify({"status": "ok"})
 
+@bp.route('/push/<int:acc_id>', methods=['POST'])
+@login_required
+def toggle_push(acc_id):
+    """标记/取消标记账号使用 IDLE 推送"""
+    db = get_db()
+
+    is_isolated = settings.get(db, 'isolation_mode')
+
+    acc = db.execute("SELECT user_id, push_enabled FROM accounts WHERE id = ?", (acc_id,)).fetchone()
+    if not acc:
+        return jsonify({"status": "error", "message": "Account not found"}), 404
+    if is_isolated and g.user['username'] not in ['admin', 'renjie'] and acc['user_id'] != g.user['id']:
+        return jsonify({"status": "error", "message": "Permission denied"}), 403
+
+    enabled = 0 if acc['push_enabled'] else 1
+    db.execute("UPDATE accounts SET push_enabled = ? WHERE id = ?", (enabled, acc_id))
+    db.commit()
+    log_audit(g.user['username'], 'TOGGLE_PUSH', f"Set push for account ID {acc_id} to {enabled}")
+    return jsonify({"status": "ok", "push_enabled": enabled})
+
 @bp.route('/check/<int:acc_id>')
 @login_required
 def view_mail(acc_id):
     db = get_db()
-    account = db.execute("SELECT email, auth_code FROM accounts WHERE id = ?", (acc_id,)).fetchone()
+    account = db.execute("SELECT email, auth_code, uidvalidity, last_mail_at FROM accounts WHERE id = ?", (acc_id,)).fetchone()
     
     if account:
-        result = fetch_latest_mail(account['email'], account['auth_code'])
+        # 缓存命中: 最新一封已有正文, 未过期, 且之后没有检测到新邮件 (?refresh=1 强制实时拉取)
+        if request.args.get('refresh') != '1':
+            cached = message_cache.get_latest(db, acc_id)
+            if (cached and cached['content'] is not None
+                    and cached['uidvalidity'] == account['uidvalidity']
+                    and (account['last_mail_at'] or 0) <= cached['cached_at']):
+                db.execute("UPDATE accounts SET status = 'success', has_new_mail = 0 WHERE id = ?", (acc_id,))
+                db.commit()
+                return jsonify({
+                    "status": "success",
+                    "sender": cached['sender'],
+                    "subject": cached['subject'],
+                    "content": cached['content'],
+                    "truncated": bool(cached['truncated']),
+                    "size": cached['size'],
+                    "uid": cached['uid'],
+                    "uidvalidity": cached['uidvalidity'],
+                    "cached": True
+                })
+
+        result = fetch_latest_mail(account['email'], account['auth_code'], settings.get(db, 'mail_body_max_bytes'))
         
         new_status = 'success' if result['status'] == 'success' else 'error'
         
-        # When user checks mail, clear "new mail" flag and update identifier
-        if new_status == 'success':
-             subject = result.get('subject', '')
-             sender = result.get('sender', '')
-             current_identifier = f"{subject}|{sender}"
-             
-             db.execute("UPDATE accounts SET status = ?, has_new_mail = 0, last_mail_identifier = ? WHERE id = ?", 
-                        (new_status, current_identifier, acc_id))
+        # When user checks mail, clear "new mail" flag and remember the newest UID
+        if new_status == 'success' and result.get('uid') is not None:
+             # SET 表达式中的 uidvalidity 取的是更新前的值
+             db.execute("UPDATE accounts SET status = ?, has_new_mail = 0, "
+                        "last_seen_uid = CASE WHEN uidvalidity = ? THEN MAX(COALESCE(last_seen_uid, 0), ?) ELSE ? END, "
+                        "uidvalidity = ? WHERE id = ?",
+                        (new_status, result['uidvalidity'], result['uid'], result['uid'], result['uidvalidity'], acc_id))
+             message_cache.put(db, acc_id, result, commit=False)
+             message_store.put(db, acc_id, result)
+             message_store.evict(db)
+        elif new_status == 'success':
+             db.execute("UPDATE accounts SET status = ?, has_new_mail = 0 WHERE id = ?", (new_status, acc_id))
         else:
-             db.execute("UPDATE accounts SET status = ? WHERE id = ?", (new_status, acc_id))
+             db.execute("UPDATE accounts SET status = ?, last_error = ? WHERE id = ?", (new_status, result.get('message'), acc_id))
 
         db.commit()
         
         return jsonify(result)
     return jsonify({"status": "error", "message": "Account not found"})
 
+def _accessible_account(db, acc_id):
+    """返回账号行; 不存在或隔离模式下不属于当前用户时返回 (None, 错误响应)"""
+    acc = db.execute("SELECT id, email, user_id FROM accounts WHERE id = ?", (acc_id,)).fetchone()
+    if not acc:
+        return None, (jsonify({"status": "error", "message": "Account not found"}), 404)
+    if (settings.get(db, 'isolation_mode') and g.user['username'] not in ['admin', 'renjie']
+            and acc['user_id'] != g.user['id']):
+        return None, (jsonify({"status": "error", "message": "Permission denied"}), 403)
+    return acc, None
+
+@bp.route('/accounts/<int:acc_id>/messages')
+@login_required
+def message_history(acc_id):
+    """本地保存的最近邮件 (邮件头), 按 UID 倒序; ?before=<uid> 翻页"""
+    db = get_db()
+    acc, error = _accessible_account(db, acc_id)
+    if error:
+        return error
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', message_store.PAGE_SIZE, type=int)
+    items, next_cursor = message_store.page(db, acc_id, before, limit)
+    return jsonify({"status": "success", "email": acc['email'], "messages": items, "next_cursor": next_cursor})
+
+@bp.route('/accounts/<int:acc_id>/messages/<int:uid>')
+@login_required
+def stored_message(acc_id, uid):
+    db = get_db()
+    acc, error = _accessible_account(db, acc_id)
+    if error:
+        return error
+    message = message_store.get(db, acc_id, uid)
+    if message is None:
+        return jsonify({"status": "error", "message": "Message not found"}), 404
+    return jsonify({"status": "success", **message})
+
+# 导入模版只生成一次; openpyxl 在第一次下载时才导入, 不拖慢进程启动
+_template_bytes = None
+
 @bp.route('/download_template')
 @login_required
 def download_template():
-    data = {
-        'QQ邮箱': ['123456@qq.com', 'test@qq.com'],
-        '授权码': ['abcd1234efgh5678', 'your_auth_code_here']
-    }
-    df = pd.DataFrame(data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='账号列表')
-    output.seek(0)
-    return send_file(output, download_name='account_template.xlsx', as_attachment=True)
+    global _template_bytes
+    if _template_bytes is None:
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('账号列表')
+        sheet.append(list(importer.REQUIRED_COLUMNS))
+        sheet.append(['123456@qq.com', 'abcd1234efgh5678'])
+        sheet.append(['test@qq.com', 'your_auth_code_here'])
+        output = io.BytesIO()
+        workbook.save(output)
+        _template_bytes = output.getvalue()
+    return send_file(io.BytesIO(_template_bytes), download_name='account_template.xlsx', as_attachment=True)
 
 @bp.route('/upload_excel', methods=['POST'])
 @login_required
 def upload_excel():
+    """保存上传的 .xlsx / .csv 并启动后台导入任务, 进度通过 /jobs/<job_id> 查询"""
     db = get_db()
     
     # Ownership Logic
-    own_setting = db.execute("SELECT value FROM system_settings WHERE key='default_ownership_self'").fetchone()
-    default_ownership_self = own_setting['value'] == '1' if own_setting else True
-    
-    if default_ownership_self:
+    if settings.get(db, 'default_ownership_self'):
         user_id = g.user['id']
     else:
         admin_user = db.execute("SELECT id FROM users WHERE username='admin'").fetchone()
@@ -189,32 +466,79 @@ def upload_excel():
     file = request.files['file']
     if file.filename == '':
         return jsonify({"status": "error", "message": "No selected file"})
-        
+
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in importer.SUPPORTED_EXTENSIONS:
+        return jsonify({"status": "error", "message": "仅支持 .xlsx 或 .csv 文件"})
+
+    # 上传内容按块写入临时文件, 导入线程读完后删除
+    fd, path = tempfile.mkstemp(suffix=extension, prefix='import-')
+    with os.fdopen(fd, 'wb') as f:
+        file.save(f)
+
+    job_id = jobs.start(current_app._get_current_object(), 'import', g.user['id'], importer.run_import,
+                        path, file.filename, user_id, g.user['username'], request.remote_addr)
+    return jsonify({"status": "accepted", "job_id": job_id}), 202
+
+@bp.route('/accounts/validate', methods=['POST'])
+@login_required
+def validate_accounts():
+    """启动后台凭据校验: 指定 ids, 或默认校验所有尚未检查过 (unknown) 的账号"""
+    db = get_db()
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids') or request.form.getlist('ids')
+
+    conditions = []
+    params = []
+    owner_id = _isolated_owner(settings.get(db, 'isolation_mode'))
+    if owner_id is not None:
+        conditions.append("user_id = ?")
+        params.append(owner_id)
+    if ids:
+        ids = [int(acc_id) for acc_id in ids if str(acc_id).isdigit()][:ACCOUNT_PAGE_MAX]
+        conditions.append(f"id IN ({','.join('?' * len(ids))})")
+        params += ids
+    else:
+        conditions.append("(status IS NULL OR status NOT IN ('success', 'error'))")
+
+    account_ids = [row[0] for row in db.execute(
+        f"SELECT id FROM accounts WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+        params + [validation.MAX_ACCOUNTS])]
+    if not account_ids:
+        return jsonify({"status": "error", "message": "No accounts to validate"})
+
+    job_id = jobs.start(current_app._get_current_object(), 'validate', g.user['id'],
+                        validation.run_validation, account_ids)
+    log_audit(g.user['username'], 'VALIDATE_ACCOUNTS', f"Started validation of {len(account_ids)} accounts")
+    return jsonify({"status": "accepted", "job_id": job_id, "count": len(account_ids)}), 202
+
+@bp.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """后台任务的进度与逐行错误; 只有发起人和管理员可以查看"""
+    job = jobs.get(get_db(), job_id)
+    if job is None or (job['user_id'] != g.user['id'] and g.user['username'] not in ['admin', 'renjie']):
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify(job)
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 抓取入口; 配置 METRICS_TOKEN 时用 Bearer 令牌认证, 否则只允许已登录的管理员"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    elif g.user is None or g.user['username'] not in ['admin', 'renjie']:
+        return Response("Access Denied\n", status=403, mimetype='text/plain')
+    # 多 worker 时轮询指标只在当选的 worker 中, 转发给它
+    address = leader.metrics_source(current_app, get_db())
+    if address is None:
+        return Response(metrics.registry.render(), content_type=metrics.TEXT_CONTENT_TYPE)
     try:
-        df = pd.read_excel(file)
-        required_columns = ['QQ邮箱', '授权码']
-        if not all(col in df.columns for col in required_columns):
-            return jsonify({"status": "error", "message": "Columns must include: QQ邮箱, 授权码"})
-            
-        success_count = 0
-        for _, row in df.iterrows():
-            email_addr = str(row['QQ邮箱']).strip()
-            auth_code = str(row['授权码']).strip()
-            
-            if email_addr and auth_code and email_addr != 'nan':
-                 try:
-                    db.execute("INSERT INTO accounts (email, auth_code, user_id) VALUES (?, ?, ?)", 
-                            (email_addr, auth_code, user_id))
-                    success_count += 1
-                 except Exception:
-                    pass 
-        
-        db.commit()
-        log_audit(g.user['username'], 'UPLOAD_EXCEL', f"Imported {success_count} accounts")
-        return jsonify({"status": "success", "count": success_count})
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        return Response(leader.fetch_metrics(address, '/metrics'), content_type=metrics.TEXT_CONTENT_TYPE)
+    except OSError as e:
+        return Response(f"Poller metrics unavailable: {e}\n", status=502, mimetype='text/plain')
 
 @bp.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -240,7 +564,8 @@ def profile():
                  db.execute("UPDATE users SET password_hash=? WHERE id=?", (generate_password_hash(new_password), user_id))
             
              db.commit()
-             g.user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+             user_cache.invalidate(user_id)
+             g.user = user_cache.get(db, user_id)
              return render_template('profile.html', user=g.user, success="个人信息更新成功")
 
         except Exception as e:
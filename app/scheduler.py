@@ -0,0 +1,66 @@
+import heapq
+import random
+from app import metrics
+
+# 每次轮询后按结果调整间隔: 有新邮件缩短, 没有则逐步放宽
+SPEEDUP_FACTOR = 0.5
+BACKOFF_FACTOR = 1.5
+# ±10% 随机抖动, 避免大量账号在同一秒登录
+JITTER = 0.1
+
+
+def next_interval(current, has_new, min_interval, max_interval):
+    """根据本次是否收到新邮件计算下一次的轮询间隔"""
+    interval = current * (SPEEDUP_FACTOR if has_new else BACKOFF_FACTOR)
+    return max(min_interval, min(max_interval, interval))
+
+
+def jittered(interval):
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+class PollScheduler:
+    """按 next_poll_at 排序的账号优先队列
+
+    数据库中的 accounts.next_poll_at 是唯一可信来源, 这里只是它在内存中的索引:
+    load() 整体重建, schedule() 在写回数据库后同步更新。
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def load(self, rows):
+        """rows: [(account_id, next_poll_at), ...]"""
+        self._due = {acc_id: due for acc_id, due in rows}
+        self._heap = [(due, acc_id) for acc_id, due in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def schedule(self, acc_id, due):
+        self._due[acc_id] = due
+        heapq.heappush(self._heap, (due, acc_id))
+
+    def next_due(self):
+        """最早到期的时间, 队列为空时返回 None"""
+        while self._heap:
+            due, acc_id = self._heap[0]
+            if self._due.get(acc_id) == due:
+                return due
+            heapq.heappop(self._heap)  # 已被重新调度的旧条目
+        return None
+
+    def pop_due(self, now, limit):
+        """取出最多 limit 个已到期的账号 id, 按到期时间排序"""
+        due_ids = []
+        while len(due_ids) < limit:
+            due = self.next_due()
+            if due is None or due > now:
+                break
+            _, acc_id = heapq.heappop(self._heap)
+            del self._due[acc_id]
+            due_ids.append(acc_id)
+            metrics.scheduler_lag_seconds.observe(now - due)
+        return due_ids
@@ -0,0 +1,218 @@
+"""基于 asyncio 的非阻塞 IMAP 客户端
+
+只实现轮询需要的少量命令。返回值的结构与 imaplib 保持一致
+(typ, data)，这样解析逻辑可以在线程模式和异步模式之间共用。
+"""
+import asyncio
+import re
+import ssl
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMAP4_SSL_PORT = 993
+
+# 与 imaplib 中的正则保持一致
+Untagged_response = re.compile(rb'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+Untagged_status = re.compile(rb'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
+Response_code = re.compile(rb'\[(?P<type>[A-Z-]+)( (?P<data>.*))?\]')
+Literal = re.compile(rb'.*{(?P<size>\d+)}$')
+
+
+class IMAPError(Exception):
+    """服务器返回 NO/BAD"""
+
+
+class IMAPAbort(IMAPError):
+    """连接被服务器关闭或协议状态异常, 需要重新连接"""
+
+
+class AsyncIMAP4:
+    """最小化的异步 IMAP4 over SSL 客户端 (use_ssl=False 时为明文连接, 仅用于本地测试服务器)"""
+
+    def __init__(self, host, port=IMAP4_SSL_PORT, timeout=30, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.use_ssl = use_ssl
+        self.reader = None
+        self.writer = None
+        self.untagged_responses = {}
+        self._tagnum = 0
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context),
+            self.timeout,
+        )
+        greeting = await self._get_line()
+        if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+            raise IMAPAbort(f"unexpected greeting: {greeting!r}")
+        return self
+
+    async def _get_line(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise IMAPAbort("socket closed by server")
+        return line.rstrip(b'\r\n')
+
+    async def _read_literal(self, size):
+        return await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+
+    def _append_untagged(self, typ, dat):
+        self.untagged_responses.setdefault(typ, []).append(dat)
+
+    async def _handle_untagged(self, resp):
+        mo = Untagged_response.match(resp)
+        dat2 = None
+        if mo is None:
+            mo = Untagged_status.match(resp)
+            if mo is None:
+                raise IMAPAbort(f"unexpected response: {resp!r}")
+            dat2 = mo.group('data2')
+
+        typ = mo.group('type').decode('ascii')
+        dat = mo.group('data') or b''
+        if dat2:
+            dat = dat + b' ' + dat2
+
+        # 字面量 {n} 紧跟在行尾, 读取后继续读取剩余部分
+        while Literal.match(dat):
+            size = int(Literal.match(dat).group('size'))
+            data = await self._read_literal(size)
+            self._append_untagged(typ, (dat, data))
+            dat = await self._get_line()
+        self._append_untagged(typ, dat)
+
+        if typ in ('OK', 'NO', 'BAD'):
+            code = Response_code.match(dat)
+            if code:
+                self._append_untagged(code.group('type').decode('ascii'), code.group('data'))
+
+    async def _command(self, name, *args):
+        self._tagnum += 1
+        tag = b'A%04d' % self._tagnum
+        line = tag + b' ' + name.encode('ascii')
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            line += b' ' + arg
+        self.untagged_responses = {}
+        self.writer.write(line + b'\r\n')
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+        while True:
+            resp = await self._get_line()
+            if resp.startswith(tag + b' '):
+                typ, _, dat = resp[len(tag) + 1:].partition(b' ')
+                typ = typ.decode('ascii')
+                if typ == 'BAD':
+                    raise IMAPError(f"{name} command error: {typ} {dat!r}")
+                return typ, [dat]
+            if resp.startswith(b'* '):
+                await self._handle_untagged(resp)
+                if name != 'LOGOUT' and 'BYE' in self.untagged_responses:
+                    raise IMAPAbort(self.untagged_responses['BYE'][-1].decode('utf-8', 'replace'))
+            # '+' 续行只在 IDLE/AUTHENTICATE 中使用, 这里忽略
+
+    def _untagged_response(self, typ, dat, name):
+        if typ == 'NO':
+            return typ, dat
+        return typ, self.untagged_responses.pop(name, [None])
+
+    @staticmethod
+    def _quote(arg):
+        arg = arg.replace('\\', '\\\\').replace('"', '\\"')
+        return '"' + arg + '"'
+
+    async def login(self, user, password):
+        typ, dat = await self._command('LOGIN', self._quote(user), self._quote(password))
+        if typ != 'OK':
+            raise IMAPError(dat[-1].decode('utf-8', 'replace'))
+        return typ, dat
+
+    async def select(self, mailbox='INBOX', readonly=False):
+        typ, dat = await self._command('EXAMINE' if readonly else 'SELECT', mailbox)
+        if typ != 'OK':
+            return typ, dat
+        return typ, self.untagged_responses.get('EXISTS', [None])
+
+    async def status(self, mailbox, names):
+        typ, dat = await self._command('STATUS', mailbox, names)
+        return self._untagged_response(typ, dat, 'STATUS')
+
+    async def search(self, charset, *criteria):
+        typ, dat = await self._command('SEARCH', *criteria)
+        return self._untagged_response(typ, dat, 'SEARCH')
+
+    async def fetch(self, message_set, message_parts):
+        if isinstance(message_set, bytes):
+            message_set = message_set.decode('ascii')
+        typ, dat = await self._command('FETCH', message_set, message_parts)
+        return self._untagged_response(typ, dat, 'FETCH')
+
+    async def noop(self):
+        return await self._command('NOOP')
+
+    async def capability(self):
+        typ, dat = await self._command('CAPABILITY')
+        return self._untagged_response(typ, dat, 'CAPABILITY')
+
+    async def idle_start(self):
+        """发送 IDLE 并等待服务器的 '+' 续行应答"""
+        self._tagnum += 1
+        self._idle_tag = b'A%04d' % self._tagnum
+        self.untagged_responses = {}
+        self.writer.write(self._idle_tag + b' IDLE\r\n')
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        while True:
+            resp = await self._get_line()
+            if resp.startswith(b'+'):
+                return
+            if resp.startswith(self._idle_tag + b' '):
+                raise IMAPError(f"IDLE rejected: {resp!r}")
+            if resp.startswith(b'* '):
+                await self._handle_untagged(resp)
+
+    async def idle_wait(self, timeout):
+        """等待 IDLE 期间的推送, 超时返回 False, 收到推送返回 True"""
+        try:
+            resp = await asyncio.wait_for(self.reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not resp:
+            raise IMAPAbort("socket closed by server")
+        resp = resp.rstrip(b'\r\n')
+        if resp.startswith(b'* '):
+            await self._handle_untagged(resp)
+            if 'BYE' in self.untagged_responses:
+                raise IMAPAbort(self.untagged_responses['BYE'][-1].decode('utf-8', 'replace'))
+        return True
+
+    async def idle_done(self):
+        """发送 DONE 结束 IDLE, 读取到对应的完成应答"""
+        self.writer.write(b'DONE\r\n')
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        while True:
+            resp = await self._get_line()
+            if resp.startswith(self._idle_tag + b' '):
+                return resp[len(self._idle_tag) + 1:].partition(b' ')[0].decode('ascii')
+            if resp.startswith(b'* '):
+                await self._handle_untagged(resp)
+
+    async def close(self):
+        return await self._command('CLOSE')
+
+    async def logout(self):
+        try:
+            typ, dat = await self._command('LOGOUT')
+        except (IMAPError, OSError, asyncio.TimeoutError):
+            typ, dat = 'NO', [None]
+        self.shutdown()
+        return typ, dat
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
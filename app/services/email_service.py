@@ -1,87 +1,237 @@
 import imaplib
 import email
-from email.header import decode_header
 import logging
+from app import metrics
+from app.services.async_imap import AsyncIMAP4, IMAPError
+from app.services.imap_pool import IMAPSessionPool, AsyncIMAPSessionPool
+from app.services.imap_response import parse_fetch_response, find_text_part
+from app.services.mail_parser import decode_header_value, decode_text, cap_preview, parse_preview
 
 logger = logging.getLogger(__name__)
 
-def fetch_latest_mail(username, password):
-    """连接 IMAP 获取最新一封邮件"""
-    mail_host = "imap.qq.com"
-    logger.info(f"开始获取邮件: {username}")
-    
+MAIL_HOST = "imap.qq.com"
+MAIL_PORT = 993
+# 关闭后使用明文 IMAP, 只用于本地的模拟服务器 (benchmarks/fake_imap.py)
+MAIL_SSL = True
+IMAP_TIMEOUT = 30
+# 查看邮件时正文最多下载的字节数 (可在 system_settings.mail_body_max_bytes 中调整)
+DEFAULT_BODY_MAX_BYTES = 256 * 1024
+
+def init_app(app):
+    """从 app.config 读取 IMAP 服务器地址"""
+    global MAIL_HOST, MAIL_PORT, MAIL_SSL
+    MAIL_HOST = app.config.get('IMAP_HOST', MAIL_HOST)
+    MAIL_PORT = app.config.get('IMAP_PORT', MAIL_PORT)
+    MAIL_SSL = app.config.get('IMAP_SSL', MAIL_SSL)
+
+def open_imap_session(username, password):
+    """建立 IMAP 会话: TLS 握手并登录 (停留在已认证状态, 不选择邮箱)"""
+    with metrics.imap_phase_seconds.time(phase='connect'):
+        if MAIL_SSL:
+            server = imaplib.IMAP4_SSL(MAIL_HOST, MAIL_PORT, timeout=IMAP_TIMEOUT)
+        else:
+            server = imaplib.IMAP4(MAIL_HOST, MAIL_PORT, timeout=IMAP_TIMEOUT)
     try:
-        # 1. 连接 IMAP (SSL)
-        server = imaplib.IMAP4_SSL(mail_host)
-        server.login(username, password)
+        with metrics.imap_phase_seconds.time(phase='login'):
+            server.login(username, password)
         logger.debug(f"{username} 登录 IMAP 成功")
-        
-        # 2. 选择收件箱
-        server.select('INBOX')
-        
-        # 3. 搜索邮件 (ALL 或 UNSEEN)
-        status, messages = server.search(None, 'ALL')
-        mail_ids = messages[0].split()
-        
-        if not mail_ids:
-            logger.info(f"账号 {username} 收件箱为空")
-            return {"status": "success", "subject": "无邮件", "content": "收件箱是空的"}
-            
-        # 4. 获取最新一封邮件
-        latest_email_id = mail_ids[-1]
-        status, msg_data = server.fetch(latest_email_id, '(RFC822)')
-        
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
-        
-        # 5. 解析标题
-        subject, encoding = decode_header(msg["Subject"])[0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(encoding if encoding else "utf-8")
-        
-        logger.info(f"获取最新邮件标题: {subject}")
-            
-        # 6. 解析发件人
-        sender, encoding = decode_header(msg.get("From"))[0]
-        if isinstance(sender, bytes):
-            sender = sender.decode(encoding if encoding else "utf-8")
-
-        # 7. 解析正文 (优先取 HTML，其次纯文本)
-        content = ""
-        html_content = ""
-        text_content = ""
-        
-        def decode_part(part):
-            charset = part.get_content_charset() or 'utf-8'
-            try:
-                return part.get_payload(decode=True).decode(charset)
-            except:
-                try: return part.get_payload(decode=True).decode('gbk') # 尝试 GBK
-                except: return None
-
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/html":
-                    html_content = decode_part(part)
-                elif content_type == "text/plain":
-                    text_content = decode_part(part)
-            
-            content = html_content if html_content else text_content
-            if not content: content = "无法解析正文 (格式不支持)"
-        else:
-            content = decode_part(msg) or "无法解析正文"
+    except Exception:
+        server.shutdown()
+        raise
+    return server
 
-        server.close()
-        server.logout()
-        
+async def open_imap_session_async(username, password):
+    server = AsyncIMAP4(MAIL_HOST, MAIL_PORT, timeout=IMAP_TIMEOUT, use_ssl=MAIL_SSL)
+    with metrics.imap_phase_seconds.time(phase='connect'):
+        await server.connect()
+    try:
+        with metrics.imap_phase_seconds.time(phase='login'):
+            await server.login(username, password)
+        logger.debug(f"{username} 登录 IMAP 成功")
+    except Exception:
+        server.shutdown()
+        raise
+    return server
+
+session_pool = IMAPSessionPool(open_imap_session)
+async_session_pool = AsyncIMAPSessionPool(open_imap_session_async)
+
+STATUS_ITEMS = '(MESSAGES UIDNEXT UIDVALIDITY)'
+# 轮询和列表只需要邮件头和结构, 不下载正文与附件
+HEADER_ITEMS = '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])'
+
+def _parse_status(data):
+    """b'"INBOX" (MESSAGES 3 UIDNEXT 4 UIDVALIDITY 1)' -> {'MESSAGES': 3, ...}"""
+    line = data[0] if data and data[0] else b''
+    items = line[line.rfind(b'(') + 1:line.rfind(b')')].split()
+    return {items[i].decode().upper(): int(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+
+def _parse_header_fetch(msg_data):
+    """解析 HEADER_ITEMS 的响应, 返回最新一封邮件的摘要"""
+    for seq, fields in parse_fetch_response(msg_data):
+        header_bytes = next((v for k, v in fields.items() if k.startswith('BODY[HEADER')), None) or b''
+        headers = email.message_from_bytes(header_bytes)
         return {
+            "uid": int(fields['UID']) if fields.get('UID') else None,
+            "size": int(fields['RFC822.SIZE']) if fields.get('RFC822.SIZE') else None,
+            "subject": decode_header_value(headers["Subject"]),
+            "sender": decode_header_value(headers.get("From")),
+            "date": headers.get("Date", ""),
+            "structure": fields.get('BODYSTRUCTURE'),
+        }
+    return None
+
+def _status_unchanged(status, uidvalidity, last_seen_uid):
+    return (last_seen_uid is not None
+            and status['UIDVALIDITY'] == uidvalidity
+            and status['UIDNEXT'] - 1 <= last_seen_uid)
+
+def _evaluate_change(status, latest, uidvalidity, last_seen_uid):
+    """根据 STATUS 和最新邮件的 UID 判断是否有新邮件"""
+    result = {
+        "status": "success",
+        "changed": True,
+        "has_new": False,
+        "uidvalidity": status['UIDVALIDITY'],
+        # 已扫描到 UIDNEXT - 1, 期间被删除的邮件不会导致重复检查
+        "last_seen_uid": status['UIDNEXT'] - 1,
+    }
+    if latest and latest['uid'] is not None:
+        result.update({k: v for k, v in latest.items() if k != 'structure'})
+        result['last_seen_uid'] = max(result['last_seen_uid'], latest['uid'])
+        # 首次检查或 UIDVALIDITY 变化 (邮箱被重建) 时同样视为新邮件
+        if last_seen_uid is None or status['UIDVALIDITY'] != uidvalidity or latest['uid'] > last_seen_uid:
+            result['has_new'] = True
+    return result
+
+def _check_mailbox(server, uidvalidity, last_seen_uid):
+    # 1. STATUS 只返回几十个字节, 绝大多数轮询到这里就结束了
+    with metrics.imap_phase_seconds.time(phase='status'):
+        typ, data = server.status('INBOX', STATUS_ITEMS)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"STATUS failed: {data}")
+    status = _parse_status(data)
+    if _status_unchanged(status, uidvalidity, last_seen_uid):
+        return {"status": "success", "changed": False, "has_new": False,
+                "uidvalidity": uidvalidity, "last_seen_uid": last_seen_uid}
+
+    # 2. UID 变化后才以只读方式打开收件箱, 只取最新一封的邮件头
+    latest = None
+    with metrics.imap_phase_seconds.time(phase='select'):
+        typ, data = server.select('INBOX', readonly=True)
+    exists = int(data[0]) if typ == 'OK' and data and data[0] else 0
+    if exists:
+        with metrics.imap_phase_seconds.time(phase='fetch_headers'):
+            typ, msg_data = server.fetch(str(exists), HEADER_ITEMS)
+        metrics.imap_bytes_fetched.inc(metrics.response_bytes(msg_data), kind='headers')
+        latest = _parse_header_fetch(msg_data)
+    server.close()
+    return _evaluate_change(status, latest, uidvalidity, last_seen_uid)
+
+async def _check_mailbox_async(server, uidvalidity, last_seen_uid):
+    with metrics.imap_phase_seconds.time(phase='status'):
+        typ, data = await server.status('INBOX', STATUS_ITEMS)
+    if typ != 'OK':
+        raise IMAPError(f"STATUS failed: {data}")
+    status = _parse_status(data)
+    if _status_unchanged(status, uidvalidity, last_seen_uid):
+        return {"status": "success", "changed": False, "has_new": False,
+                "uidvalidity": uidvalidity, "last_seen_uid": last_seen_uid}
+
+    latest = None
+    with metrics.imap_phase_seconds.time(phase='select'):
+        typ, data = await server.select('INBOX', readonly=True)
+    exists = int(data[0]) if typ == 'OK' and data and data[0] else 0
+    if exists:
+        with metrics.imap_phase_seconds.time(phase='fetch_headers'):
+            typ, msg_data = await server.fetch(str(exists), HEADER_ITEMS)
+        metrics.imap_bytes_fetched.inc(metrics.response_bytes(msg_data), kind='headers')
+        latest = _parse_header_fetch(msg_data)
+    await server.close()
+    return _evaluate_change(status, latest, uidvalidity, last_seen_uid)
+
+def check_mailbox(username, password, uidvalidity=None, last_seen_uid=None):
+    """轮询用的变化检测: STATUS 比较 UIDVALIDITY/UIDNEXT, 仅在 UID 变化时拉取邮件头"""
+    try:
+        return session_pool.run(username, password,
+                                lambda server: _check_mailbox(server, uidvalidity, last_seen_uid))
+    except Exception as e:
+        metrics.imap_errors.inc(operation='check', error=e.__class__.__name__)
+        logger.error(f"检查邮箱失败: {username}, 错误: {e}")
+        return {"status": "error", "message": str(e)}
+
+async def check_mailbox_async(username, password, uidvalidity=None, last_seen_uid=None):
+    """check_mailbox 的 asyncio 版本, 供异步轮询引擎使用"""
+    try:
+        return await async_session_pool.run(username, password,
+                                            lambda server: _check_mailbox_async(server, uidvalidity, last_seen_uid))
+    except Exception as e:
+        metrics.imap_errors.inc(operation='check', error=e.__class__.__name__)
+        logger.error(f"检查邮箱失败: {username}, 错误: {e!r}")
+        return {"status": "error", "message": str(e) or e.__class__.__name__}
+
+def _fetch_latest(server, username, max_bytes):
+    with metrics.imap_phase_seconds.time(phase='select'):
+        typ, data = server.select('INBOX')
+    exists = int(data[0]) if typ == 'OK' and data and data[0] else 0
+    uidvalidity = server.untagged_responses.get('UIDVALIDITY', [None])[-1]
+
+    if not exists:
+        logger.info(f"账号 {username} 收件箱为空")
+        server.close()
+        return {"status": "success", "subject": "无邮件", "content": "收件箱是空的"}
+
+    # 1. 最新一封邮件的头和结构 (序号等于邮件总数, 无需 SEARCH ALL)
+    with metrics.imap_phase_seconds.time(phase='fetch_headers'):
+        typ, msg_data = server.fetch(str(exists), HEADER_ITEMS)
+    metrics.imap_bytes_fetched.inc(metrics.response_bytes(msg_data), kind='headers')
+    latest = _parse_header_fetch(msg_data)
+    logger.info(f"获取最新邮件标题: {latest['subject']}")
+
+    # 2. 只下载要展示的正文部分, 并限制最大字节数
+    part = find_text_part(latest['structure'])
+    if part is not None:
+        with metrics.imap_phase_seconds.time(phase='fetch_body'):
+            typ, body_data = server.uid('FETCH', str(latest['uid']), f"(BODY.PEEK[{part['section']}]<0.{max_bytes}>)")
+        metrics.imap_bytes_fetched.inc(metrics.response_bytes(body_data), kind='body')
+        fields = parse_fetch_response(body_data)
+        raw = next((v for k, v in fields[0][1].items() if k.startswith('BODY[')), None) if fields else None
+        truncated = part['size'] > max_bytes
+        content = decode_text(raw or b'', part['params'].get('charset'), part['encoding'], truncated)
+        content, capped = cap_preview(content)
+        truncated = truncated or capped
+        result = {
             "status": "success",
-            "sender": sender,
-            "subject": subject,
-            "content": content # 返回完整内容，不再截断
+            "sender": latest['sender'],
+            "subject": latest['subject'],
+            "date": latest['date'],
+            "content": content,
+            "content_type": f"text/{part['subtype']}",
         }
-        
+    else:
+        # 无法识别结构时退回到整封邮件, 同样限制下载大小
+        with metrics.imap_phase_seconds.time(phase='fetch_body'):
+            typ, body_data = server.uid('FETCH', str(latest['uid']), f"(BODY.PEEK[]<0.{max_bytes}>)")
+        metrics.imap_bytes_fetched.inc(metrics.response_bytes(body_data), kind='body')
+        fields = parse_fetch_response(body_data)
+        raw = next((v for k, v in fields[0][1].items() if k.startswith('BODY[')), None) if fields else None
+        result = parse_preview(raw or b'', max_bytes, truncated=(latest['size'] or 0) > max_bytes)
+        truncated = result['truncated']
+    server.close()
+
+    result['truncated'] = truncated
+    result['size'] = part['size'] if part is not None else latest['size']
+    result['uid'] = latest['uid']
+    result['uidvalidity'] = int(uidvalidity) if uidvalidity else None
+    return result
+
+def fetch_latest_mail(username, password, max_bytes=DEFAULT_BODY_MAX_BYTES):
+    """获取最新一封邮件 (复用连接池中的 IMAP 会话), 正文超过 max_bytes 时截断"""
+    logger.info(f"开始获取邮件: {username}")
+
+    try:
+        return session_pool.run(username, password, lambda server: _fetch_latest(server, username, max_bytes))
     except Exception as e:
+        metrics.imap_errors.inc(operation='fetch', error=e.__class__.__name__)
         logger.error(f"获取邮件失败: {username}, 错误: {e}")
         return {"status": "error", "message": str(e)}
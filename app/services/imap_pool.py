@@ -0,0 +1,374 @@
+"""按账号复用已登录的 IMAP 连接
+
+每次轮询都重新做 TLS 握手 + LOGIN 既慢又容易被 QQ 服务器限流。
+这里按账号缓存已登录 (authenticated 状态) 的连接, 每次操作自行 SELECT/EXAMINE 并在结束时 CLOSE:
+- 空闲超过 KEEPALIVE_INTERVAL 的连接在复用前先发 NOOP 探活
+- 空闲超过 IDLE_TIMEOUT 的连接被回收
+- 全局 MAX_OPEN_SESSIONS 限制同时打开的连接数, 超出时淘汰最久未用的空闲连接
+- 服务器断开连接时自动重连并重试一次
+"""
+import asyncio
+import imaplib
+import threading
+import time
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from app import metrics
+from app.services.async_imap import IMAPAbort
+
+logger = logging.getLogger(__name__)
+
+MAX_OPEN_SESSIONS = 1000
+# 后台连接 (异步轮询、IDLE 推送、凭据校验) 不能占用的额度, 留给查看邮件等请求线程
+RESERVED_SESSIONS = 50
+IDLE_TIMEOUT = 600
+KEEPALIVE_INTERVAL = 120
+REAPER_INTERVAL = 30
+
+# 认为连接已失效、需要重连的异常
+SYNC_DISCONNECT_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+ASYNC_DISCONNECT_ERRORS = (IMAPAbort, OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+def init_app(app):
+    """从 app.config 读取连接池参数"""
+    global MAX_OPEN_SESSIONS, RESERVED_SESSIONS, IDLE_TIMEOUT, KEEPALIVE_INTERVAL
+    MAX_OPEN_SESSIONS = app.config.get('IMAP_POOL_MAX_OPEN', MAX_OPEN_SESSIONS)
+    RESERVED_SESSIONS = app.config.get('IMAP_POOL_RESERVED', RESERVED_SESSIONS)
+    IDLE_TIMEOUT = app.config.get('IMAP_POOL_IDLE_TIMEOUT', IDLE_TIMEOUT)
+    KEEPALIVE_INTERVAL = app.config.get('IMAP_POOL_KEEPALIVE', KEEPALIVE_INTERVAL)
+
+
+class _SocketBudget:
+    """线程池模式和异步模式共用的全局连接数额度"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+
+    def try_acquire(self, background=False):
+        """background=True 时保留 RESERVED_SESSIONS 个额度: 异步池的空闲连接只能由轮询线程回收,
+        占满额度后请求线程里的 fetch_latest_mail 会一直等不到连接"""
+        limit = MAX_OPEN_SESSIONS - RESERVED_SESSIONS if background else MAX_OPEN_SESSIONS
+        with self._lock:
+            if self.open >= max(1, limit):
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open = max(0, self.open - 1)
+
+
+budget = _SocketBudget()
+metrics.registry.register(metrics.Gauge(
+    'mailnest_imap_sessions_open', 'Open IMAP connections (pooled, IDLE and validation)', function=lambda: budget.open))
+
+
+class _Session:
+    __slots__ = ('conn', 'password', 'last_used', 'in_use')
+
+    def __init__(self, conn, password):
+        self.conn = conn
+        self.password = password
+        self.last_used = time.monotonic()
+        self.in_use = True
+
+
+class IMAPSessionPool:
+    """imaplib 连接池, 供 Flask 请求线程和线程池轮询使用"""
+
+    def __init__(self, connect):
+        # connect(username, password) -> 已登录 (未选择邮箱) 的 imaplib 连接
+        self._connect = connect
+        self._sessions = OrderedDict()
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    def run(self, username, password, operation):
+        """在该账号的会话上执行 operation(conn), 连接断开时重连重试一次"""
+        self._ensure_reaper()
+        for attempt in (1, 2):
+            session = self._checkout(username, password)
+            try:
+                result = operation(session.conn)
+            except SYNC_DISCONNECT_ERRORS as e:
+                self._discard(username, session)
+                if attempt == 2:
+                    raise
+                logger.info(f"IMAP 会话已断开, 重新连接: {username} ({e!r})")
+                continue
+            except Exception:
+                # 协议状态未知, 不再复用
+                self._discard(username, session)
+                raise
+            self._checkin(session)
+            return result
+
+    def _checkout(self, username, password):
+        with self._cond:
+            while True:
+                session = self._sessions.get(username)
+                if session is None:
+                    break
+                if not session.in_use:
+                    session.in_use = True
+                    self._sessions.move_to_end(username)
+                    break
+                # 同一账号同一时间只允许一个使用者
+                self._cond.wait(1)
+
+        if session is not None:
+            if session.password == password and self._is_alive(session):
+                return session
+            self._discard(username, session)
+
+        self._reserve_slot()
+        try:
+            conn = self._connect(username, password)
+        except Exception:
+            budget.release()
+            raise
+        session = _Session(conn, password)
+        with self._cond:
+            self._sessions[username] = session
+        return session
+
+    def _is_alive(self, session):
+        if time.monotonic() - session.last_used < KEEPALIVE_INTERVAL:
+            return True
+        try:
+            session.conn.noop()
+            return True
+        except Exception:
+            return False
+
+    def _reserve_slot(self):
+        while not budget.try_acquire():
+            if not self._evict_lru():
+                # 本池没有可淘汰的空闲连接, 等待其他使用者归还
+                with self._cond:
+                    self._cond.wait(0.1)
+
+    def _evict_lru(self):
+        with self._cond:
+            for username, session in self._sessions.items():
+                if not session.in_use:
+                    del self._sessions[username]
+                    break
+            else:
+                return False
+        self._close(session)
+        return True
+
+    def _checkin(self, session):
+        with self._cond:
+            session.last_used = time.monotonic()
+            session.in_use = False
+            self._cond.notify_all()
+
+    def _discard(self, username, session):
+        with self._cond:
+            if self._sessions.get(username) is session:
+                del self._sessions[username]
+            self._cond.notify_all()
+        self._close(session)
+
+    @staticmethod
+    def _close(session):
+        budget.release()
+        try:
+            session.conn.logout()
+        except Exception:
+            try:
+                session.conn.shutdown()
+            except Exception:
+                pass
+
+    def _ensure_reaper(self):
+        if self._reaper is None:
+            with self._cond:
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+                    self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"IMAP session reaper error: {e}")
+
+    def sweep(self):
+        """回收超时空闲连接, 对其余空闲连接发送 NOOP 保活"""
+        now = time.monotonic()
+        expired, keepalive = [], []
+        with self._cond:
+            for username, session in list(self._sessions.items()):
+                if session.in_use:
+                    continue
+                idle = now - session.last_used
+                if idle >= IDLE_TIMEOUT:
+                    del self._sessions[username]
+                    expired.append(session)
+                elif idle >= KEEPALIVE_INTERVAL:
+                    session.in_use = True
+                    keepalive.append((username, session))
+
+        for session in expired:
+            self._close(session)
+        for username, session in keepalive:
+            try:
+                session.conn.noop()
+            except Exception:
+                self._discard(username, session)
+            else:
+                # 保活不刷新 last_used, 以免连接永远不过期
+                with self._cond:
+                    session.in_use = False
+                    self._cond.notify_all()
+
+    def close_all(self):
+        with self._cond:
+            sessions = [s for s in self._sessions.values() if not s.in_use]
+            for username in [u for u, s in self._sessions.items() if not s.in_use]:
+                del self._sessions[username]
+        for session in sessions:
+            self._close(session)
+
+
+class AsyncIMAPSessionPool:
+    """AsyncIMAP4 连接池, 只能在同一个事件循环中使用 (轮询线程)"""
+
+    def __init__(self, connect):
+        # connect(username, password) -> 协程, 返回已登录 (未选择邮箱) 的 AsyncIMAP4
+        self._connect = connect
+        self._sessions = OrderedDict()
+        # username -> [锁, 正在使用或等待该锁的协程数]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def _account_lock(self, username):
+        """同一账号同一时间只允许一个使用者; 会话不存在且无人使用时删除锁, 避免字典无限增长"""
+        entry = self._locks.get(username)
+        if entry is None:
+            entry = self._locks[username] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            self._forget_lock(username)
+
+    def _forget_lock(self, username):
+        entry = self._locks.get(username)
+        if entry is not None and entry[1] == 0 and username not in self._sessions:
+            del self._locks[username]
+
+    async def run(self, username, password, operation):
+        """在该账号的会话上执行 await operation(conn), 连接断开时重连重试一次"""
+        async with self._account_lock(username):
+            for attempt in (1, 2):
+                session = await self._checkout(username, password)
+                try:
+                    result = await operation(session.conn)
+                except ASYNC_DISCONNECT_ERRORS as e:
+                    self._discard(username, session)
+                    if attempt == 2:
+                        raise
+                    logger.info(f"IMAP 会话已断开, 重新连接: {username} ({e!r})")
+                    continue
+                except Exception:
+                    self._discard(username, session)
+                    raise
+                session.last_used = time.monotonic()
+                session.in_use = False
+                return result
+
+    async def _checkout(self, username, password):
+        session = self._sessions.get(username)
+        if session is not None:
+            session.in_use = True
+            self._sessions.move_to_end(username)
+            if session.password == password and await self._is_alive(session):
+                return session
+            self._discard(username, session)
+
+        while not budget.try_acquire(background=True):
+            if not self._evict_lru():
+                await asyncio.sleep(0.05)
+        try:
+            conn = await self._connect(username, password)
+        except BaseException:
+            budget.release()
+            raise
+        session = _Session(conn, password)
+        self._sessions[username] = session
+        return session
+
+    async def _is_alive(self, session):
+        if time.monotonic() - session.last_used < KEEPALIVE_INTERVAL:
+            return True
+        try:
+            await session.conn.noop()
+            return True
+        except Exception:
+            return False
+
+    def _evict_lru(self):
+        for username, session in self._sessions.items():
+            if not session.in_use:
+                del self._sessions[username]
+                self._forget_lock(username)
+                self._close(session)
+                return True
+        return False
+
+    def _discard(self, username, session):
+        if self._sessions.get(username) is session:
+            del self._sessions[username]
+            self._forget_lock(username)
+        self._close(session)
+
+    @staticmethod
+    def _close(session):
+        budget.release()
+        # 不等待 LOGOUT 应答, 直接关闭套接字
+        session.conn.shutdown()
+
+    async def sweep(self):
+        """回收超时空闲连接, 对其余空闲连接发送 NOOP 保活"""
+        now = time.monotonic()
+        keepalive = []
+        for username, session in list(self._sessions.items()):
+            if session.in_use:
+                continue
+            idle = now - session.last_used
+            if idle >= IDLE_TIMEOUT:
+                self._discard(username, session)
+            elif idle >= KEEPALIVE_INTERVAL:
+                keepalive.append((username, session))
+
+        async def ping(username, session):
+            entry = self._locks.get(username)
+            if entry is not None and entry[0].locked():
+                return
+            async with self._account_lock(username):
+                if self._sessions.get(username) is not session:
+                    return
+                try:
+                    await session.conn.noop()
+                except Exception:
+                    self._discard(username, session)
+
+        if keepalive:
+            await asyncio.gather(*(ping(u, s) for u, s in keepalive))
+
+    def close_all(self):
+        for username, session in list(self._sessions.items()):
+            if not session.in_use:
+                self._discard(username, session)
@@ -0,0 +1,146 @@
+"""IMAP FETCH 响应与 BODYSTRUCTURE 解析
+
+输入是 imaplib / AsyncIMAP4 返回的 FETCH data 列表:
+字面量以 (前缀, 内容) 元组出现, 其余为 bytes。
+"""
+import re
+
+_TOKEN = re.compile(rb'''
+    (?P<open>\()
+  | (?P<close>\))
+  | "(?P<quoted>(?:[^"\\]|\\.)*)"
+  | (?P<atom>(?:[^\s()"\[\]]|\[[^\]]*\])+)
+''', re.VERBOSE)
+_LITERAL_MARKER = re.compile(rb'\{\d+\}$')
+
+
+class _Literal(bytes):
+    """字面量字符串, 与普通 atom 区分"""
+
+
+def _tokens(data):
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            yield from _scan(_LITERAL_MARKER.sub(b'', prefix))
+            yield _Literal(literal)
+        elif item:
+            yield from _scan(item)
+
+
+def _scan(text):
+    for match in _TOKEN.finditer(text):
+        if match.group('open'):
+            yield '('
+        elif match.group('close'):
+            yield ')'
+        elif match.group('quoted') is not None:
+            yield _Literal(re.sub(rb'\\(.)', rb'\1', match.group('quoted')))
+        else:
+            atom = match.group('atom')
+            yield None if atom.upper() == b'NIL' else atom
+
+
+def _build(tokens):
+    """把扁平的 token 流组装成嵌套列表"""
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                continue
+            finished = stack.pop()
+            stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+    while len(stack) > 1:
+        finished = stack.pop()
+        stack[-1].append(finished)
+    return stack[0]
+
+
+def parse_fetch_response(data):
+    """解析 FETCH 响应, 返回 [(序号, {数据项名称: 值}), ...]
+
+    名称统一大写并去掉 .PEEK, 如 'UID', 'BODYSTRUCTURE', 'BODY[1]<0>'。
+    """
+    if not data or data == [None]:
+        return []
+    items = _build(_tokens(data))
+    messages = []
+    for i in range(0, len(items) - 1, 2):
+        seq, attrs = items[i], items[i + 1]
+        if not isinstance(attrs, list):
+            continue
+        fields = {}
+        for j in range(0, len(attrs) - 1, 2):
+            name = attrs[j]
+            if isinstance(name, bytes):
+                fields[name.decode('ascii', 'replace').upper().replace('.PEEK', '')] = attrs[j + 1]
+        messages.append((int(seq), fields))
+    return messages
+
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def iter_parts(structure, prefix=''):
+    """遍历 BODYSTRUCTURE 的叶子节点, 产出 dict(section, type, subtype, ...)
+
+    附带的邮件 (message/rfc822) 整体作为一个叶子, 不再向下展开。
+    """
+    if not isinstance(structure, list) or not structure:
+        return
+    if isinstance(structure[0], list):
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            yield from iter_parts(child, f"{prefix}{index}.")
+        return
+
+    section = prefix[:-1] if prefix else '1'
+    ctype = _text(structure[0] or b'').lower()
+    subtype = _text(structure[1] or b'').lower()
+    size = int(structure[6]) if len(structure) > 6 and structure[6] else 0
+
+    # 扩展字段的位置取决于类型: text 多一个 lines, message/rfc822 多 envelope/body/lines
+    if ctype == 'text':
+        ext = 8
+    elif ctype == 'message' and subtype == 'rfc822':
+        ext = 10
+    else:
+        ext = 7
+    disposition = structure[ext + 1] if len(structure) > ext + 1 else None
+    disposition_type = _text(disposition[0]).lower() if isinstance(disposition, list) and disposition[0] else None
+
+    yield {
+        'section': section,
+        'type': ctype,
+        'subtype': subtype,
+        'params': _params(structure[2]),
+        'encoding': _text(structure[5] or b'7bit').lower(),
+        'size': size,
+        'disposition': disposition_type,
+    }
+
+
+def find_text_part(structure):
+    """选择要展示的正文部分: 优先 text/html, 其次 text/plain, 跳过附件"""
+    candidates = [part for part in iter_parts(structure)
+                  if part['type'] == 'text' and part['disposition'] != 'attachment']
+    for subtype in ('html', 'plain'):
+        for part in candidates:
+            if part['subtype'] == subtype:
+                return part
+    return None
+
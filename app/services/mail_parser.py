@@ -0,0 +1,219 @@
+"""有界内存的邮件正文解析
+
+原文按块送入 BytesFeedParser, 最多处理 max_bytes 字节; 非正文部分 (附件、附带的邮件、
+图片等) 在解析时就丢弃内容, 不保存也不解码。只解码选中的那一个正文部分, 字符集解析一次,
+结果截断到 PREVIEW_MAX_CHARS 个字符, 并返回是否被截断。
+"""
+import base64
+import binascii
+import codecs
+import html
+import quopri
+import re
+from email.feedparser import BytesFeedParser
+from email.header import decode_header
+from email.message import Message
+from functools import lru_cache
+from html.parser import HTMLParser
+
+FEED_CHUNK_SIZE = 64 * 1024
+# 返回的正文预览最多多少个字符
+PREVIEW_MAX_CHARS = 128 * 1024
+# 未声明字符集时按 UTF-8, 无法识别的字符集按 GB18030 (GBK 的超集)
+DEFAULT_CHARSET = 'utf-8'
+FALLBACK_CHARSET = 'gb18030'
+# 国内邮件常把 GB18030 内容标成 GB2312/GBK
+CHARSET_ALIASES = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'x-gbk': 'gb18030', 'cp936': 'gb18030'}
+
+NO_CONTENT = "无法解析正文 (格式不支持)"
+
+# sanitize_html 的白名单; 不在名单中的标签去掉但保留文字, DROP_CONTENT 中的连同内容一起去掉
+ALLOWED_TAGS = frozenset((
+    'a', 'abbr', 'b', 'big', 'blockquote', 'br', 'caption', 'center', 'code', 'col', 'colgroup', 'dd', 'div',
+    'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p', 'pre',
+    's', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead',
+    'tr', 'u', 'ul',
+))
+DROP_CONTENT = frozenset(('script', 'style', 'iframe', 'object', 'embed', 'frame', 'frameset', 'noscript',
+                          'template', 'svg', 'math', 'head', 'title', 'textarea', 'select'))
+VOID_TAGS = frozenset(('br', 'col', 'hr', 'img'))
+ALLOWED_ATTRS = frozenset((
+    'href', 'src', 'alt', 'title', 'width', 'height', 'align', 'valign', 'colspan', 'rowspan', 'border',
+    'cellpadding', 'cellspacing', 'color', 'bgcolor', 'face', 'size', 'style',
+))
+SAFE_URL = re.compile(r'^(https?:|mailto:|cid:|#)', re.IGNORECASE)
+UNSAFE_STYLE = re.compile(r'expression|javascript:|behavior|url\s*\(', re.IGNORECASE)
+
+
+def init_app(app):
+    global PREVIEW_MAX_CHARS
+    PREVIEW_MAX_CHARS = app.config.get('MAIL_PREVIEW_MAX_CHARS', PREVIEW_MAX_CHARS)
+
+
+@lru_cache(maxsize=128)
+def resolve_charset(name):
+    """把邮件中声明的字符集名称解析为可用的编解码器名称"""
+    name = (name or '').strip().strip('"').lower()
+    if not name:
+        return DEFAULT_CHARSET
+    name = CHARSET_ALIASES.get(name, name)
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return FALLBACK_CHARSET
+
+
+def decode_header_value(value):
+    """解码 RFC 2047 编码的邮件头 (只取第一段, 与原有行为一致)"""
+    if value is None:
+        return ""
+    decoded, encoding = decode_header(value)[0]
+    if isinstance(decoded, bytes):
+        decoded = decoded.decode(resolve_charset(encoding), errors="replace")
+    return decoded
+
+
+def decode_text(raw, charset, encoding, truncated=False):
+    """按传输编码和字符集解码一段正文; truncated 表示 raw 只是开头的一部分"""
+    encoding = (encoding or '7bit').strip().lower()
+    if encoding == 'base64':
+        compact = b''.join(raw.split())
+        if truncated:
+            # 截断的 base64 只解码完整的 4 字节组
+            compact = compact[:len(compact) - len(compact) % 4]
+        try:
+            raw = base64.b64decode(compact)
+        except binascii.Error:
+            pass
+    elif encoding == 'quoted-printable':
+        raw = quopri.decodestring(raw)
+    return raw.decode(resolve_charset(charset), errors='replace')
+
+
+def cap_preview(text, limit=None):
+    """截断到预览长度, 返回 (文本, 是否被截断)"""
+    limit = PREVIEW_MAX_CHARS if limit is None else limit
+    if len(text) <= limit:
+        return text, False
+    return text[:limit], True
+
+
+def _is_body_part(part):
+    return part.get_content_maintype() == 'text' and part.get_content_disposition() != 'attachment'
+
+
+class _PreviewMessage(Message):
+    """只保留正文部分内容的 Message; 其他部分的负载在 feed parser 写入时丢弃"""
+
+    def set_payload(self, payload, charset=None):
+        if isinstance(payload, str) and not _is_body_part(self):
+            payload = ''
+        super().set_payload(payload, charset)
+
+
+def _body_parts(msg):
+    """按顺序产出正文部分, 不进入附带的邮件 (message/*)"""
+    if msg.is_multipart():
+        for part in msg.get_payload():
+            if part.get_content_maintype() != 'message':
+                yield from _body_parts(part)
+    elif _is_body_part(msg):
+        yield msg
+
+
+def parse_preview(raw, max_bytes=None, truncated=False):
+    """解析 RFC822 原文 (可能只是开头部分), 返回标题/发件人/日期/正文预览
+
+    raw 超过 max_bytes 时只解析前 max_bytes 字节。truncated 表示调用方拿到的 raw
+    本身已被截断 (如 IMAP 部分拉取)。优先取 HTML 正文, 其次纯文本。
+    """
+    limit = len(raw) if max_bytes is None else min(len(raw), max_bytes)
+    truncated = truncated or limit < len(raw)
+    parser = BytesFeedParser(_factory=_PreviewMessage)
+    view = memoryview(raw)
+    for start in range(0, limit, FEED_CHUNK_SIZE):
+        parser.feed(bytes(view[start:min(start + FEED_CHUNK_SIZE, limit)]))
+    msg = parser.close()
+
+    parts = list(_body_parts(msg))
+    chosen = parts[0] if parts else None
+    for subtype in ('plain', 'html'):
+        chosen = next((part for part in parts if part.get_content_subtype() == subtype), chosen)
+    content_type = None
+    if chosen is None:
+        content = NO_CONTENT
+    else:
+        content_type = chosen.get_content_type()
+        # 只处理传输编码, 得到原始字节; 字符集在这里解码一次
+        payload = chosen.get_payload(decode=True) or b''
+        content = decode_text(payload, chosen.get_content_charset(), None)
+        content, capped = cap_preview(content)
+        truncated = truncated or capped
+
+    return {
+        "status": "success",
+        "sender": decode_header_value(msg.get("From")),
+        "subject": decode_header_value(msg["Subject"]),
+        "date": msg.get("Date", ""),
+        "content": content,
+        "content_type": content_type,
+        "truncated": truncated,
+    }
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT:
+            if tag not in VOID_TAGS:
+                self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        kept = []
+        for name, value in attrs:
+            value = value or ''
+            if name not in ALLOWED_ATTRS:
+                continue
+            if name in ('href', 'src') and not SAFE_URL.match(value.strip()):
+                continue
+            if name == 'style' and UNSAFE_STYLE.search(value):
+                continue
+            kept.append(f' {name}="{html.escape(value)}"')
+        if tag == 'a':
+            kept.append(' target="_blank" rel="noopener noreferrer"')
+        self.out.append(f"<{tag}{''.join(kept)}>")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in DROP_CONTENT and tag not in VOID_TAGS:
+            self.dropping -= 1
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT:
+            self.dropping = max(0, self.dropping - 1)
+        elif not self.dropping and tag in ALLOWED_TAGS and tag not in VOID_TAGS:
+            self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(html.escape(data, quote=False))
+
+
+def sanitize_html(text):
+    """按白名单清理邮件 HTML: 去掉脚本、事件属性和危险链接, 文字全部转义"""
+    sanitizer = _Sanitizer()
+    sanitizer.feed(text)
+    sanitizer.close()
+    return ''.join(sanitizer.out)
+
+
+def sanitize_body(content, content_type):
+    """把正文转换为可以直接插入页面的 HTML; 纯文本转义后保留换行"""
+    if content_type == 'text/html':
+        return sanitize_html(content)
+    return f'<div style="white-space: pre-wrap">{html.escape(content, quote=False)}</div>'
@@ -0,0 +1,149 @@
+"""本地邮件缓存: 内存 LRU + SQLite 持久化, 按 (账号, UID) 存储
+
+轮询发现新 UID 时写入邮件头 (content 为 NULL), /check 实时拉取后写入正文。
+查看邮件时只有当缓存的最新一封带有正文、未过期、且此后没有新邮件时才直接返回;
+轮询只记录邮件头, 所以轮询发现的新邮件第一次查看时总是实时拉取, 命中的只是重复查看。
+内存层只保存已提交的数据: commit=False 写入时只让该账号的内存条目失效, 下次读取再从 SQLite 加载。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_TTL = 600
+MEMORY_MAX_BYTES = 32 * 1024 * 1024
+DB_MAX_BYTES = 256 * 1024 * 1024
+# 清理需要扫描整张表, 限制执行频率
+EVICT_INTERVAL = 60
+
+FIELDS = ('account_id', 'uid', 'uidvalidity', 'subject', 'sender', 'date',
+          'content', 'truncated', 'size', 'cached_at')
+
+
+def init_app(app):
+    """从 app.config 读取缓存参数"""
+    global CACHE_TTL, MEMORY_MAX_BYTES, DB_MAX_BYTES
+    CACHE_TTL = app.config.get('MESSAGE_CACHE_TTL', CACHE_TTL)
+    MEMORY_MAX_BYTES = app.config.get('MESSAGE_CACHE_MEMORY_BYTES', MEMORY_MAX_BYTES)
+    DB_MAX_BYTES = app.config.get('MESSAGE_CACHE_DB_BYTES', DB_MAX_BYTES)
+
+
+def _entry_bytes(entry):
+    return sum(len(entry.get(k) or '') for k in ('subject', 'sender', 'date', 'content'))
+
+
+class MessageCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()   # (account_id, uid) -> entry
+        self._latest = {}           # account_id -> 最新 uid
+        self._bytes = 0
+        self._last_evict = 0
+
+    # ---- 内存层 ----
+
+    def _remember(self, entry):
+        key = (entry['account_id'], entry['uid'])
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self._bytes -= old['bytes']
+            self._lru[key] = entry
+            self._bytes += entry['bytes']
+            if entry['uid'] >= self._latest.get(entry['account_id'], 0):
+                self._latest[entry['account_id']] = entry['uid']
+            while self._bytes > MEMORY_MAX_BYTES and len(self._lru) > 1:
+                (account_id, uid), evicted = self._lru.popitem(last=False)
+                self._bytes -= evicted['bytes']
+                if self._latest.get(account_id) == uid:
+                    del self._latest[account_id]
+
+    def _forget(self, account_id):
+        with self._lock:
+            for key in [k for k in self._lru if k[0] == account_id]:
+                self._bytes -= self._lru.pop(key)['bytes']
+            self._latest.pop(account_id, None)
+
+    # ---- 对外接口 ----
+
+    def get_latest(self, db, account_id):
+        """返回该账号缓存中最新的一封 (未过期), 否则 None"""
+        entry = None
+        with self._lock:
+            uid = self._latest.get(account_id)
+            if uid is not None:
+                entry = self._lru.get((account_id, uid))
+                if entry is not None:
+                    self._lru.move_to_end((account_id, uid))
+
+        if entry is None:
+            row = db.execute(
+                f"SELECT {', '.join(FIELDS)} FROM message_cache WHERE account_id = ? ORDER BY uid DESC LIMIT 1",
+                (account_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = dict(row)
+            entry['bytes'] = _entry_bytes(entry)
+            self._remember(entry)
+
+        if time.time() - entry['cached_at'] > CACHE_TTL:
+            return None
+        return entry
+
+    def put(self, db, account_id, message, commit=True):
+        """写入一封邮件; message 至少包含 uid, 可选 content (None 表示只有邮件头)"""
+        if message.get('uid') is None:
+            return
+        entry = {
+            'account_id': account_id,
+            'uid': message['uid'],
+            'uidvalidity': message.get('uidvalidity'),
+            'subject': message.get('subject'),
+            'sender': message.get('sender'),
+            'date': message.get('date'),
+            'content': message.get('content'),
+            'truncated': 1 if message.get('truncated') else 0,
+            'size': message.get('size'),
+            'cached_at': time.time(),
+        }
+        entry['bytes'] = _entry_bytes(entry)
+
+        # UIDVALIDITY 变化后旧 UID 失去意义
+        db.execute("DELETE FROM message_cache WHERE account_id = ? AND uidvalidity IS NOT ?",
+                   (account_id, entry['uidvalidity']))
+        db.execute(
+            f"INSERT OR REPLACE INTO message_cache ({', '.join(FIELDS)}, bytes) VALUES ({', '.join('?' * (len(FIELDS) + 1))})",
+            [entry[k] for k in FIELDS] + [entry['bytes']]
+        )
+        if not commit:
+            # 事务由调用方提交, 可能回滚; 内存层等下次读取时从 SQLite 加载
+            with self._lock:
+                self._latest.pop(account_id, None)
+            return
+        self.evict(db)
+        db.commit()
+        self._remember(entry)
+
+    def evict(self, db, force=False):
+        """删除过期行, 并按 cached_at 从旧到新删除直到总大小低于 DB_MAX_BYTES (最多每 EVICT_INTERVAL 秒一次)"""
+        if not force and time.time() - self._last_evict < EVICT_INTERVAL:
+            return
+        self._last_evict = time.time()
+        db.execute("DELETE FROM message_cache WHERE cached_at < ?", (time.time() - CACHE_TTL,))
+        total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM message_cache").fetchone()[0]
+        if total > DB_MAX_BYTES:
+            db.execute(
+                """DELETE FROM message_cache WHERE rowid IN (
+                       SELECT rowid FROM (
+                           SELECT rowid, SUM(bytes) OVER (ORDER BY cached_at DESC) AS running
+                           FROM message_cache)
+                       WHERE running > ?)""",
+                (DB_MAX_BYTES,)
+            )
+
+    def invalidate(self, db, account_id):
+        db.execute("DELETE FROM message_cache WHERE account_id = ?", (account_id,))
+        self._forget(account_id)
+
+
+message_cache = MessageCache()
@@ -0,0 +1,118 @@
+"""每个账号最近的邮件历史 (messages 表)
+
+与 message_cache 不同, 这里的记录不会因过期而删除, 供操作员直接从本地翻看最近的邮件:
+- 轮询发现新邮件时写入邮件头 (body 为 NULL), /check 实时拉取后补上正文
+- 正文先按白名单净化 (见 mail_parser.sanitize_body), 再用 zlib 压缩保存
+- 每个账号只保留 UID 最大的 PER_ACCOUNT 封; 全表超过 MAX_TOTAL_BYTES 时按写入时间从旧到新淘汰
+"""
+import time
+import zlib
+from app.services.mail_parser import sanitize_body
+
+PER_ACCOUNT = 50
+MAX_TOTAL_BYTES = 512 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+# 全表大小检查需要扫描整张表, 限制执行频率
+EVICT_INTERVAL = 60
+PAGE_SIZE = 20
+PAGE_MAX = 100
+
+HEADER_FIELDS = ('uid', 'uidvalidity', 'subject', 'sender', 'date', 'size')
+
+_last_evict = 0
+
+
+def init_app(app):
+    global PER_ACCOUNT, MAX_TOTAL_BYTES
+    PER_ACCOUNT = app.config.get('MESSAGE_HISTORY_PER_ACCOUNT', PER_ACCOUNT)
+    MAX_TOTAL_BYTES = app.config.get('MESSAGE_HISTORY_MAX_BYTES', MAX_TOTAL_BYTES)
+
+
+def _header_bytes(message):
+    return sum(len(message.get(k) or '') for k in ('subject', 'sender', 'date'))
+
+
+def put(db, account_id, message):
+    """记录一封邮件 (由调用方提交事务); message 没有 content 时只记录邮件头, 不覆盖已有正文"""
+    if message.get('uid') is None or PER_ACCOUNT <= 0:
+        return
+    body = None
+    if message.get('content') is not None:
+        sanitized = sanitize_body(message['content'], message.get('content_type'))
+        body = zlib.compress(sanitized.encode('utf-8'), COMPRESSION_LEVEL)
+    stored_bytes = _header_bytes(message) + (len(body) if body is not None else 0)
+
+    # UIDVALIDITY 变化后旧 UID 失去意义
+    db.execute("DELETE FROM messages WHERE account_id = ? AND uidvalidity IS NOT ?",
+               (account_id, message.get('uidvalidity')))
+    db.execute(
+        "INSERT INTO messages (account_id, uid, uidvalidity, subject, sender, date, size, body, truncated, bytes, stored_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(account_id, uid) DO UPDATE SET subject = excluded.subject, sender = excluded.sender, "
+        "date = COALESCE(excluded.date, date), size = COALESCE(excluded.size, size), "
+        "body = COALESCE(excluded.body, body), "
+        "truncated = CASE WHEN excluded.body IS NULL THEN truncated ELSE excluded.truncated END, "
+        "bytes = CASE WHEN excluded.body IS NULL THEN bytes ELSE excluded.bytes END",
+        (account_id, message['uid'], message.get('uidvalidity'), message.get('subject'), message.get('sender'),
+         message.get('date'), message.get('size'), body, 1 if message.get('truncated') else 0,
+         stored_bytes, time.time())
+    )
+    # 按主键索引找到第 PER_ACCOUNT 封之后的 UID
+    db.execute("DELETE FROM messages WHERE account_id = ? AND uid < "
+               "(SELECT uid FROM messages WHERE account_id = ? ORDER BY uid DESC LIMIT 1 OFFSET ?)",
+               (account_id, account_id, PER_ACCOUNT - 1))
+
+
+def evict(db, force=False):
+    """全表超过 MAX_TOTAL_BYTES 时删除最早写入的邮件 (由调用方提交事务)"""
+    global _last_evict
+    if not force and time.time() - _last_evict < EVICT_INTERVAL:
+        return
+    _last_evict = time.time()
+    total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM messages").fetchone()[0]
+    if total > MAX_TOTAL_BYTES:
+        db.execute(
+            """DELETE FROM messages WHERE rowid IN (
+                   SELECT rowid FROM (
+                       SELECT rowid, SUM(bytes) OVER (ORDER BY stored_at DESC) AS running
+                       FROM messages)
+                   WHERE running > ?)""",
+            (MAX_TOTAL_BYTES,)
+        )
+
+
+def page(db, account_id, before_uid=None, limit=PAGE_SIZE):
+    """按 UID 倒序列出邮件头, 返回 (列表, 下一页的 before_uid 或 None)"""
+    limit = max(1, min(limit, PAGE_MAX))
+    condition, params = "account_id = ?", [account_id]
+    if before_uid is not None:
+        condition += " AND uid < ?"
+        params.append(before_uid)
+    rows = db.execute(
+        f"SELECT {', '.join(HEADER_FIELDS)}, body IS NOT NULL AS has_body, truncated, stored_at "
+        f"FROM messages WHERE {condition} ORDER BY uid DESC LIMIT ?", params + [limit + 1]
+    ).fetchall()
+    items = [dict(row) for row in rows[:limit]]
+    for item in items:
+        item['has_body'] = bool(item['has_body'])
+        item['truncated'] = bool(item['truncated'])
+    return items, (items[-1]['uid'] if len(rows) > limit else None)
+
+
+def get(db, account_id, uid):
+    """返回一封邮件 (content 为净化后的正文, 没有正文时为 None), 不存在时返回 None"""
+    row = db.execute(
+        f"SELECT {', '.join(HEADER_FIELDS)}, body, truncated, stored_at FROM messages WHERE account_id = ? AND uid = ?",
+        (account_id, uid)
+    ).fetchone()
+    if row is None:
+        return None
+    message = dict(row)
+    body = message.pop('body')
+    message['content'] = zlib.decompress(body).decode('utf-8') if body is not None else None
+    message['truncated'] = bool(message['truncated'])
+    return message
+
+
+def invalidate(db, account_id):
+    db.execute("DELETE FROM messages WHERE account_id = ?", (account_id,))
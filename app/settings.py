@@ -0,0 +1,156 @@
+"""system_settings 的类型化访问与进程内缓存
+
+所有键值缓存在内存中, 读取时不再访问数据库。写入 system_settings 的触发器
+会递增 settings_version.version, 缓存最多每 CHECK_INTERVAL 秒比较一次版本号,
+因此其他进程 (独立 poller、其他 Web worker) 的修改也会在一秒左右生效。
+本进程通过 update() 写入时立即失效并通知订阅者 (如轮询线程); 有订阅者时 watch()
+启动的后台线程每 CHECK_INTERVAL 秒检查一次版本号, 其他进程的修改同样会立即通知订阅者,
+不必等到订阅者下一次读取设置。
+"""
+import threading
+import time
+import logging
+from app.db import get_db
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1.0
+
+# 键 -> (类型, 默认值); bool 在数据库中存为 '1' / '0'
+SCHEMA = {
+    'isolation_mode': (bool, False),
+    'allow_admin_dashboard': (bool, False),
+    'default_ownership_self': (bool, True),
+    'polling_enabled': (bool, False),
+    'polling_interval': (int, 300),
+    'polling_min_interval': (int, 30),
+    'polling_max_interval': (int, 3600),
+    'polling_mode': (str, 'async'),
+    'polling_concurrency': (int, 200),
+    'push_enabled': (bool, False),
+    'push_max_connections': (int, 100),
+    'push_recent_hours': (int, 24),
+    'mail_body_max_bytes': (int, 256 * 1024),
+    'audit_retention_days': (int, 0),
+}
+
+
+def init_app(app):
+    global CHECK_INTERVAL
+    CHECK_INTERVAL = app.config.get('SETTINGS_CHECK_INTERVAL', CHECK_INTERVAL)
+
+
+def _parse(key, raw):
+    kind, default = SCHEMA.get(key, (str, None))
+    if raw is None:
+        return default
+    if kind is bool:
+        return raw == '1'
+    try:
+        return kind(raw)
+    except ValueError:
+        logger.warning(f"Invalid value for setting {key}: {raw!r}, using default")
+        return default
+
+
+def _serialize(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+class Settings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = None
+        self._version = None
+        self._checked_at = 0
+        self._listeners = []
+        self._watcher = None
+        # 每次观察到设置变化时递增, 供调用方判断配置是否变过
+        self.generation = 0
+
+    def subscribe(self, callback):
+        """设置变化时调用 callback() (在触发变化的线程中执行)"""
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        """取消 subscribe 注册的回调 (服务停止时调用, 避免已停止的对象继续被唤醒)"""
+        try:
+            self._listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def watch(self, app):
+        """启动检查版本号的后台线程 (已在运行时无操作); 所有订阅者取消后线程自行退出"""
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, args=(app,), name='settings-watcher', daemon=True)
+            self._watcher.start()
+
+    def _watch(self, app):
+        with app.app_context():
+            while True:
+                with self._lock:
+                    if not self._listeners:
+                        self._watcher = None
+                        return
+                try:
+                    # 版本号变化且值不同时由 _refresh 通知订阅者
+                    self._refresh(get_db())
+                except Exception as e:
+                    logger.error(f"Settings watcher error: {e}")
+                time.sleep(CHECK_INTERVAL)
+
+    def _notify(self):
+        with self._lock:
+            self.generation += 1
+        for callback in list(self._listeners):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Settings listener error: {e}")
+
+    def _refresh(self, db):
+        now = time.monotonic()
+        if self._values is not None and now - self._checked_at < CHECK_INTERVAL:
+            return
+        version = db.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()[0]
+        self._checked_at = now
+        if self._values is not None and version == self._version:
+            return
+
+        values = {row['key']: row['value'] for row in db.execute("SELECT key, value FROM system_settings")}
+        with self._lock:
+            changed = self._values is not None and values != self._values
+            self._values = values
+            self._version = version
+        if changed:
+            self._notify()
+
+    def get(self, db, key):
+        self._refresh(db)
+        return _parse(key, self._values.get(key))
+
+    def all(self, db):
+        """所有已知设置的类型化快照"""
+        self._refresh(db)
+        return {key: _parse(key, self._values.get(key)) for key in SCHEMA}
+
+    def update(self, db, values):
+        """写入一组设置并提交"""
+        db.executemany("INSERT OR REPLACE INTO system_settings (key, value) VALUES (?, ?)",
+                       [(key, _serialize(value)) for key, value in values.items()])
+        db.commit()
+        # 立即重新加载; 值确实变化时由 _refresh 通知订阅者
+        self.invalidate()
+        self._refresh(db)
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = 0
+            self._version = None
+
+
+settings = Settings()
@@ -0,0 +1,100 @@
+"""批量校验账号凭据 (如批量导入后仍为 unknown 的账号)
+
+只做 TLS 握手 + LOGIN, 不选择邮箱也不拉取邮件, 在任务线程自己的事件循环中以有限并发执行,
+并与轮询共用 imap_pool 的全局连接额度。结果按批写回 accounts.status / last_error,
+进度记录在 jobs 表 (见 app/jobs.py)。
+"""
+import asyncio
+import time
+import logging
+from app.db import get_db
+from app.events import hub as event_hub
+from app.services.email_service import open_imap_session_async
+from app.services.imap_pool import budget
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 20
+# 单个任务最多校验的账号数
+MAX_ACCOUNTS = 50000
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 1.0
+
+
+def init_app(app):
+    global CONCURRENCY
+    CONCURRENCY = app.config.get('VALIDATION_CONCURRENCY', CONCURRENCY)
+
+
+async def _login(username, password):
+    """登录后立即断开, 返回 None 表示成功, 否则返回错误原因"""
+    while not budget.try_acquire(background=True):
+        await asyncio.sleep(0.05)
+    server = None
+    try:
+        server = await open_imap_session_async(username, password)
+        return None
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    finally:
+        if server is not None:
+            server.shutdown()
+        budget.release()
+
+
+def _write(db, results):
+    db.executemany("UPDATE accounts SET status = ?, last_error = ? WHERE id = ?", results)
+    db.commit()
+    event_hub.notify()
+
+
+async def _validate_all(job, db, accounts):
+    semaphore = asyncio.Semaphore(max(1, CONCURRENCY))
+
+    async def check(acc):
+        async with semaphore:
+            return acc, await _login(acc['email'], acc['auth_code'])
+
+    pending = {asyncio.ensure_future(check(acc)) for acc in accounts}
+    results = []
+    last_flush = time.monotonic()
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=WRITE_FLUSH_INTERVAL,
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            acc, error = task.result()
+            job.processed += 1
+            if error is None:
+                job.succeeded += 1
+                results.append(('success', None, acc['id']))
+            else:
+                job.error(acc['id'], acc['email'], error)
+                results.append(('error', error, acc['id']))
+
+        if results and (not pending or len(results) >= WRITE_BATCH_SIZE
+                        or time.monotonic() - last_flush >= WRITE_FLUSH_INTERVAL):
+            _write(db, results)
+            results = []
+            last_flush = time.monotonic()
+            job.save(db)
+
+
+def run_validation(job, account_ids):
+    """jobs.start 的任务函数: 逐个登录 account_ids 中的账号并记录结果"""
+    db = get_db()
+    accounts = []
+    for i in range(0, len(account_ids), 500):
+        chunk = account_ids[i:i + 500]
+        accounts += [dict(row) for row in db.execute(
+            f"SELECT id, email, auth_code FROM accounts WHERE id IN ({','.join('?' * len(chunk))})", chunk)]
+    job.total = len(accounts)
+    job.save(db, force=True)
+
+    logger.info(f"Validating {len(accounts)} accounts (concurrency {CONCURRENCY})")
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_validate_all(job, db, accounts))
+    finally:
+        loop.close()
+
+    return f"Validated {job.total} accounts: {job.succeeded} succeeded, {job.failed} failed"
@@ -0,0 +1,270 @@
+"""本地模拟 IMAP 服务器 (明文, 不依赖网络)
+
+只实现 MailNest 用到的命令: CAPABILITY / NOOP / LOGIN / LOGOUT / STATUS / SELECT / EXAMINE /
+FETCH / UID FETCH / CLOSE / IDLE。任意用户名都是一个有效邮箱, 邮件数、邮件大小和
+登录失败都由用户名和 --seed 确定, 同样的参数每次运行得到同样的邮箱。
+
+可调参数: 每条命令的延迟和抖动、邮箱邮件数、邮件大小、每次 STATUS 时到达新邮件的概率、
+登录失败 (按账号固定) / 命令返回 NO / 连接被断开的比例。
+
+单独运行, 再让应用连到它:
+    python benchmarks/fake_imap.py --port 1143 --latency 0.02
+    IMAP_HOST=127.0.0.1 IMAP_PORT=1143 IMAP_SSL=False  (写入 instance/config.py)
+--port 0 时随机选择端口, 启动后在标准输出打印一行 JSON: {"port": ...}
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import sys
+
+BOUNDARY = 'mailnest-bench'
+TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+BODY_SECTION = re.compile(r'BODY(?:\.PEEK)?\[([0-9.]*)\](?:<(\d+)\.(\d+)>)?', re.IGNORECASE)
+HEADER_FIELDS = 'BODY[HEADER.FIELDS (SUBJECT FROM DATE)]'
+FILLER = b'<p>MailNest benchmark filler text, the quick brown fox jumps over the lazy dog.</p>\r\n'
+
+
+def _fraction(*parts):
+    """由参数确定的 [0, 1) 伪随机数, 同样的输入在不同进程中结果相同"""
+    digest = hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def _between(low, high, *parts):
+    return low + int(_fraction(*parts) * (high - low + 1))
+
+
+def _filler(size):
+    return (FILLER * (size // len(FILLER) + 1))[:size]
+
+
+class Message:
+    """一封 multipart/alternative 邮件: 较短的 text/plain 和其余大小的 text/html"""
+
+    def __init__(self, uid, size):
+        self.uid = uid
+        self.header = (f"Subject: Benchmark message {uid}\r\n"
+                       f"From: Benchmark <bench@example.com>\r\n"
+                       f"Date: Mon, 01 Jan 2024 00:00:00 +0000\r\n").encode()
+        html_size = max(64, size - len(self.header) - 256)
+        self.parts = {'1': _filler(max(32, html_size // 8)), '2': _filler(html_size)}
+
+    def raw(self):
+        body = [self.header, f'Content-Type: multipart/alternative; boundary="{BOUNDARY}"\r\n\r\n'.encode()]
+        for section, subtype in (('1', 'plain'), ('2', 'html')):
+            body += [f'--{BOUNDARY}\r\nContent-Type: text/{subtype}; charset=utf-8\r\n\r\n'.encode(),
+                     self.parts[section], b'\r\n']
+        body.append(f'--{BOUNDARY}--\r\n'.encode())
+        return b''.join(body)
+
+    def bodystructure(self):
+        parts = ''
+        for section, subtype in (('1', 'plain'), ('2', 'html')):
+            data = self.parts[section]
+            lines = data.count(b'\n')
+            parts += f'("text" "{subtype}" ("charset" "utf-8") NIL NIL "7bit" {len(data)} {lines} NIL NIL NIL)'
+        return f'({parts} "alternative" ("boundary" "{BOUNDARY}") NIL NIL)'
+
+
+class Mailbox:
+    __slots__ = ('uidvalidity', 'exists', 'uidnext')
+
+    def __init__(self, exists):
+        self.uidvalidity = 1
+        self.exists = exists
+        self.uidnext = exists + 1
+
+
+class FakeIMAPServer:
+    def __init__(self, latency=0.0, jitter=0.0, messages=(0, 200), message_size=(2 * 1024, 64 * 1024),
+                 new_mail_rate=0.05, login_failure_rate=0.0, error_rate=0.0, disconnect_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.messages = messages
+        self.message_size = message_size
+        self.new_mail_rate = new_mail_rate
+        self.login_failure_rate = login_failure_rate
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.mailboxes = {}
+        self.connections = 0
+        self.commands = 0
+
+    def mailbox(self, user):
+        box = self.mailboxes.get(user)
+        if box is None:
+            box = self.mailboxes[user] = Mailbox(_between(*self.messages, self.seed, user, 'messages'))
+        return box
+
+    def message(self, user, uid):
+        return Message(uid, _between(*self.message_size, self.seed, user, uid))
+
+    async def _delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port, backlog=4096)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        session = {'user': None, 'selected': False}
+        try:
+            await self._delay()
+            writer.write(b'* OK [CAPABILITY IMAP4rev1 IDLE] MailNest benchmark IMAP server ready\r\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tag, _, rest = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                self.commands += 1
+                await self._delay()
+                if self.disconnect_rate and self.random.random() < self.disconnect_rate:
+                    break
+                if command == 'LOGOUT':
+                    writer.write(b'* BYE logging out\r\n' + f'{tag} OK LOGOUT completed\r\n'.encode())
+                    break
+                if command == 'IDLE':
+                    writer.write(b'+ idling\r\n')
+                    await writer.drain()
+                    while (await reader.readline()).strip().upper() not in (b'DONE', b''):
+                        pass
+                    writer.write(f'{tag} OK IDLE terminated\r\n'.encode())
+                elif self.error_rate and command not in ('CAPABILITY', 'NOOP') \
+                        and self.random.random() < self.error_rate:
+                    writer.write(f'{tag} NO [UNAVAILABLE] simulated server error\r\n'.encode())
+                else:
+                    writer.write(self._dispatch(session, tag, command, args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def _dispatch(self, session, tag, command, args):
+        if command == 'CAPABILITY':
+            return f'* CAPABILITY IMAP4rev1 IDLE\r\n{tag} OK CAPABILITY completed\r\n'.encode()
+        if command == 'NOOP':
+            return f'{tag} OK NOOP completed\r\n'.encode()
+        if command == 'LOGIN':
+            user = next((quoted or atom for quoted, atom in TOKEN.findall(args)), '')
+            if _fraction(self.seed, user, 'login') < self.login_failure_rate:
+                return f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n'.encode()
+            session['user'] = user
+            return f'{tag} OK LOGIN completed\r\n'.encode()
+        if session['user'] is None:
+            return f'{tag} BAD not authenticated\r\n'.encode()
+
+        box = self.mailbox(session['user'])
+        if command == 'STATUS':
+            if self.new_mail_rate and self.random.random() < self.new_mail_rate:
+                box.exists += 1
+                box.uidnext += 1
+            return (f'* STATUS "INBOX" (MESSAGES {box.exists} UIDNEXT {box.uidnext} UIDVALIDITY {box.uidvalidity})\r\n'
+                    f'{tag} OK STATUS completed\r\n').encode()
+        if command in ('SELECT', 'EXAMINE'):
+            session['selected'] = True
+            access = 'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'
+            return (f'* {box.exists} EXISTS\r\n* 0 RECENT\r\n'
+                    f'* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid\r\n* OK [UIDNEXT {box.uidnext}] Predicted next UID\r\n'
+                    f'{tag} OK [{access}] {command} completed\r\n').encode()
+        if command == 'CLOSE':
+            session['selected'] = False
+            return f'{tag} OK CLOSE completed\r\n'.encode()
+        if command in ('FETCH', 'UID') and session['selected']:
+            by_uid = command == 'UID'
+            if by_uid:
+                _, _, args = args.partition(' ')
+            return self._fetch(session['user'], box, tag, args, by_uid)
+        return f'{tag} BAD unsupported command {command}\r\n'.encode()
+
+    def _fetch(self, user, box, tag, args, by_uid):
+        message_set, _, items = args.partition(' ')
+        # 邮件不会被删除, UID 从 1 连续编号, 与序号相同
+        try:
+            uid = seq = int(message_set)
+        except ValueError:
+            return f'{tag} BAD only single messages are supported\r\n'.encode()
+        if not 1 <= seq <= box.exists:
+            return f'{tag} OK FETCH completed\r\n'.encode()
+
+        message = self.message(user, uid)
+        if 'BODYSTRUCTURE' in items.upper():
+            raw_size = len(message.raw())
+            return b''.join([
+                f'* {seq} FETCH (UID {uid} RFC822.SIZE {raw_size} BODYSTRUCTURE {message.bodystructure()} '
+                f'{HEADER_FIELDS} {{{len(message.header) + 2}}}\r\n'.encode(),
+                message.header, b'\r\n)\r\n', f'{tag} OK FETCH completed\r\n'.encode()])
+
+        match = BODY_SECTION.search(items)
+        if match is None:
+            return f'{tag} BAD unsupported fetch items\r\n'.encode()
+        section, origin, length = match.groups()
+        data = message.parts.get(section, b'') if section else message.raw()
+        if origin is not None:
+            data = data[int(origin):int(origin) + int(length)]
+        name = f'BODY[{section}]' + (f'<{origin}>' if origin is not None else '')
+        return b''.join([f'* {seq} FETCH (UID {uid} {name} {{{len(data)}}}\r\n'.encode(), data,
+                         b')\r\n', f'{tag} OK FETCH completed\r\n'.encode()])
+
+
+def _range(text):
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def add_arguments(parser):
+    """模拟服务器的可调参数, benchmarks/polling.py 使用同样的参数"""
+    parser.add_argument('--latency', type=float, default=0.0, help='每条命令的固定延迟 (秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='在固定延迟上叠加 0~jitter 秒的随机延迟')
+    parser.add_argument('--messages', type=_range, default=(0, 200), help='每个邮箱的邮件数, 如 0-200')
+    parser.add_argument('--message-size', type=_range, default=(2 * 1024, 64 * 1024), help='邮件大小 (字节), 如 2048-65536')
+    parser.add_argument('--new-mail-rate', type=float, default=0.05, help='每次 STATUS 时到达一封新邮件的概率')
+    parser.add_argument('--login-failure-rate', type=float, default=0.0, help='登录总是失败的账号比例')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='命令返回 NO 的概率')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='命令处理前断开连接的概率')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Local fake IMAP server for MailNest benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143, help='0 表示随机端口')
+    add_arguments(parser)
+    return parser
+
+
+def server_from_args(args):
+    return FakeIMAPServer(latency=args.latency, jitter=args.jitter, messages=args.messages,
+                          message_size=args.message_size, new_mail_rate=args.new_mail_rate,
+                          login_failure_rate=args.login_failure_rate, error_rate=args.error_rate,
+                          disconnect_rate=args.disconnect_rate, seed=args.seed)
+
+
+async def serve(args):
+    server = server_from_args(args)
+    port = await server.start(args.host, args.port)
+    print(json.dumps({'port': port}), flush=True)
+    async with server.server:
+        await server.server.serve_forever()
+
+
+def main():
+    args = build_parser().parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
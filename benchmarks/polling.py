@@ -0,0 +1,291 @@
+"""轮询吞吐基准: 在本地模拟 IMAP 服务器 (benchmarks/fake_imap.py) 上驱动 PollingService 和 fetch_latest_mail
+
+模拟服务器在单独的进程中运行; 每个账号规模在全新的解释器和临时数据库中测量, 互不影响峰值内存。
+每个规模依次测量:
+- cold: 所有账号首次检查 (建立连接、登录、STATUS、EXAMINE 并拉取最新邮件头)
+- warm: 紧接着再检查一遍 (复用连接池中的会话, 多数账号只需要一条 STATUS)
+- fetch: 对部分账号调用 fetch_latest_mail (查看邮件时的路径)
+输出整轮耗时、账号/秒、结果写库耗时和峰值 RSS:
+    python benchmarks/polling.py
+    python benchmarks/polling.py --accounts 1000 --latency 0.02 --jitter 0.01 --login-failure-rate 0.01
+    python benchmarks/polling.py --mode thread --concurrency 50
+
+--ci 为离线回归模式: 1000 个账号、无延迟、固定随机种子, 检查每个账号都被正确轮询
+(无失败注入时不能出现错误), 并与 --min-rate / --max-rss-mb 以及 --baseline 保存的结果比较,
+不达标时以非零状态退出。--save-baseline 把本次结果写入基线文件。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_imap import add_arguments as add_server_arguments  # noqa: E402
+
+# 与 fake_imap.py 参数同名, 原样传给模拟服务器
+SERVER_OPTIONS = ('latency', 'jitter', 'messages', 'message_size', 'new_mail_rate',
+                  'login_failure_rate', 'error_rate', 'disconnect_rate', 'seed')
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+def _db_write_total():
+    from app import metrics
+    stats = metrics.db_write_seconds.snapshot().get('all')
+    return (stats['count'], stats['count'] * stats['avg']) if stats else (0, 0.0)
+
+
+def _outcomes():
+    from app import metrics
+    return dict(metrics.poll_cycle_accounts.snapshot())
+
+
+def _run_cycle(app, service):
+    """把所有账号设为到期, 轮询直到没有到期账号为止"""
+    import time
+    from app.db import get_db
+
+    db = get_db()
+    db.execute("UPDATE accounts SET next_poll_at = ? WHERE status IS NULL OR status != 'error'", (time.time() - 1,))
+    db.commit()
+    service.last_refresh_time = 0
+    writes_before, write_seconds_before = _db_write_total()
+    outcomes_before = _outcomes()
+
+    started = time.perf_counter()
+    while service._check_and_poll() == 0:
+        pass
+    elapsed = time.perf_counter() - started
+
+    writes, write_seconds = _db_write_total()
+    outcomes = {key: value - outcomes_before.get(key, 0) for key, value in _outcomes().items()}
+    polled = sum(outcomes.values())
+    return {
+        'seconds': elapsed,
+        'polled': polled,
+        'accounts_per_second': _rate(polled, elapsed),
+        'outcomes': {key: value for key, value in outcomes.items() if value},
+        'db_write_seconds': write_seconds - write_seconds_before,
+        'db_write_batches': writes - writes_before,
+    }
+
+
+def _run_fetch(accounts, concurrency, max_bytes):
+    import concurrent.futures
+    import time
+    from app.services.email_service import fetch_latest_mail
+
+    def fetch(account):
+        started = time.perf_counter()
+        result = fetch_latest_mail(account[0], account[1], max_bytes)
+        return time.perf_counter() - started, result['status'] == 'success'
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(fetch, accounts))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(seconds for seconds, _ in results)
+    return {
+        'calls': len(results),
+        'failed': sum(1 for _, ok in results if not ok),
+        'seconds': elapsed,
+        'calls_per_second': _rate(len(results), elapsed),
+        'p50': latencies[len(latencies) // 2] if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+    }
+
+
+def run_worker(args):
+    """在本进程中测量一个账号规模, 把结果以一行 JSON 输出"""
+    import logging
+    import resource
+    import time
+    from app import create_app, metrics
+    from app.db import get_db
+    from app.polling import PollingService
+    from app.settings import settings
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'DATABASE': os.path.join(tmp, 'accounts.db'),
+            'SECRET_KEY': 'benchmark',
+            'IMAP_HOST': '127.0.0.1',
+            'IMAP_PORT': args.port,
+            'IMAP_SSL': False,
+            'IMAP_POOL_MAX_OPEN': args.pool_size,
+        })
+        with app.app_context():
+            db = get_db()
+            accounts = [(f"bench{i:06d}@example.com", 'secret') for i in range(args.worker_accounts)]
+            started = time.perf_counter()
+            db.executemany("INSERT INTO accounts (email, auth_code) VALUES (?, ?)", accounts)
+            db.commit()
+            insert_seconds = time.perf_counter() - started
+            settings.update(db, {'polling_enabled': True, 'polling_mode': args.mode,
+                                 'polling_concurrency': args.concurrency, 'push_enabled': False})
+
+            service = PollingService(app, worker_id='benchmark')
+            service.leases.heartbeat(db, force=True)
+            result = {'accounts': len(accounts), 'mode': args.mode, 'concurrency': args.concurrency,
+                      'insert_seconds': insert_seconds}
+            result['cold'] = _run_cycle(app, service)
+            result['warm'] = _run_cycle(app, service)
+
+        step = max(1, len(accounts) // max(1, args.fetch_samples))
+        result['fetch'] = _run_fetch(accounts[::step][:args.fetch_samples], min(args.concurrency, 32),
+                                     args.fetch_max_bytes)
+
+    phases = metrics.imap_phase_seconds.snapshot()
+    result['imap_phase_p95'] = {phase: stats['p95'] for phase, stats in phases.items()}
+    result['imap_errors'] = metrics.imap_errors.snapshot()
+    # Linux 上 ru_maxrss 以 KB 为单位, macOS 上以字节为单位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    print(json.dumps(result))
+
+
+def start_server(args):
+    """启动模拟 IMAP 服务器进程, 返回 (进程, 端口)"""
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_imap.py'), '--port', '0']
+    for option in SERVER_OPTIONS:
+        value = getattr(args, option)
+        if isinstance(value, tuple):
+            value = f"{value[0]}-{value[1]}"
+        command += [f"--{option.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise SystemExit(f"fake IMAP server failed to start (exit code {process.returncode})")
+    return process, json.loads(line)['port']
+
+
+def measure(args, port, accounts):
+    command = [sys.executable, os.path.abspath(__file__), '--worker-accounts', str(accounts), '--port', str(port),
+               '--mode', args.mode, '--concurrency', str(args.concurrency), '--pool-size', str(args.pool_size),
+               '--fetch-samples', str(args.fetch_samples), '--fetch-max-bytes', str(args.fetch_max_bytes)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def report(result):
+    print(f"{result['accounts']} accounts ({result['mode']}, concurrency {result['concurrency']}), "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB")
+    for cycle in ('cold', 'warm'):
+        stats = result[cycle]
+        outcomes = ', '.join(f"{key} {value}" for key, value in sorted(stats['outcomes'].items()))
+        print(f"  {cycle:>5}: {stats['seconds']:.2f}s, {stats['accounts_per_second']:.0f} accounts/s, "
+              f"DB writes {stats['db_write_seconds']:.3f}s in {stats['db_write_batches']} batches ({outcomes})")
+    fetch = result['fetch']
+    print(f"  fetch: {fetch['calls']} calls, {fetch['calls_per_second']:.0f}/s, "
+          f"p50 {fetch['p50'] * 1000:.1f} ms, p95 {fetch['p95'] * 1000:.1f} ms, {fetch['failed']} failed")
+    if result['imap_errors']:
+        print(f"  IMAP errors: {result['imap_errors']}")
+
+
+def check(args, results):
+    """--ci 模式下的回归检查, 返回失败原因列表"""
+    failures = []
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = {str(item['accounts']): item for item in json.load(f)}
+    injected = args.login_failure_rate or args.error_rate or args.disconnect_rate
+
+    for result in results:
+        name = f"{result['accounts']} accounts"
+        # 出错的账号不再参与后续轮询
+        expected = {'cold': result['accounts'], 'warm': result['accounts'] - result['cold']['outcomes'].get('error', 0)}
+        for cycle in ('cold', 'warm'):
+            stats = result[cycle]
+            if stats['polled'] != expected[cycle]:
+                failures.append(f"{name}: {cycle} cycle polled {stats['polled']} of {expected[cycle]} accounts")
+            if not injected and stats['outcomes'].get('error'):
+                failures.append(f"{name}: {cycle} cycle reported {stats['outcomes']['error']} errors")
+        if not injected and result['fetch']['failed']:
+            failures.append(f"{name}: {result['fetch']['failed']} fetch_latest_mail calls failed")
+        if result['warm']['accounts_per_second'] < args.min_rate:
+            failures.append(f"{name}: warm cycle {result['warm']['accounts_per_second']:.0f} accounts/s "
+                            f"< {args.min_rate}")
+        if result['peak_rss_mb'] > args.max_rss_mb:
+            failures.append(f"{name}: peak RSS {result['peak_rss_mb']:.1f} MB > {args.max_rss_mb} MB")
+
+        previous = baseline.get(str(result['accounts']))
+        if previous:
+            for cycle in ('cold', 'warm'):
+                floor = previous[cycle]['accounts_per_second'] * (1 - args.tolerance)
+                if result[cycle]['accounts_per_second'] < floor:
+                    failures.append(f"{name}: {cycle} cycle {result[cycle]['accounts_per_second']:.0f} accounts/s "
+                                    f"is more than {args.tolerance:.0%} below the baseline "
+                                    f"({previous[cycle]['accounts_per_second']:.0f})")
+            ceiling = previous['peak_rss_mb'] * (1 + args.tolerance)
+            if result['peak_rss_mb'] > ceiling:
+                failures.append(f"{name}: peak RSS {result['peak_rss_mb']:.1f} MB is more than "
+                                f"{args.tolerance:.0%} above the baseline ({previous['peak_rss_mb']:.1f} MB)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Polling throughput benchmark against a local fake IMAP server')
+    add_server_arguments(parser)
+    parser.add_argument('--accounts', default='1000,10000,50000', help='逗号分隔的账号规模')
+    parser.add_argument('--mode', choices=('async', 'thread'), default='async', help='polling_mode')
+    parser.add_argument('--concurrency', type=int, default=200, help='polling_concurrency')
+    parser.add_argument('--pool-size', type=int, default=1000, help='IMAP_POOL_MAX_OPEN')
+    parser.add_argument('--fetch-samples', type=int, default=200, help='调用 fetch_latest_mail 的账号数')
+    parser.add_argument('--fetch-max-bytes', type=int, default=256 * 1024, help='查看邮件时正文最多下载的字节数')
+    parser.add_argument('--json', help='把结果写入该文件')
+    parser.add_argument('--ci', action='store_true', help='离线回归模式 (1000 个账号, 无延迟, 固定种子)')
+    parser.add_argument('--min-rate', type=float, default=0, help='warm 轮询的最低账号/秒')
+    parser.add_argument('--max-rss-mb', type=float, default=float('inf'), help='峰值常驻内存上限 (MB)')
+    parser.add_argument('--baseline', help='与之比较的基线结果 (--json 或 --save-baseline 的输出)')
+    parser.add_argument('--save-baseline', action='store_true', help='把本次结果写入 --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='相对基线允许的退化比例')
+    # 内部参数: 由 measure() 在子进程中使用
+    parser.add_argument('--worker-accounts', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_accounts is not None:
+        run_worker(args)
+        return
+
+    if args.ci:
+        args.accounts = '1000'
+        args.latency = args.jitter = 0.0
+        args.seed = 0
+
+    server, port = start_server(args)
+    results = []
+    try:
+        for accounts in (int(value) for value in args.accounts.split(',') if value.strip()):
+            result = measure(args, port, accounts)
+            report(result)
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline and args.baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif args.ci:
+        failures = check(args, results)
+        for failure in failures:
+            print(f"FAIL {failure}")
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
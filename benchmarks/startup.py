@@ -0,0 +1,75 @@
+"""启动开销基准: create_app() 的导入耗时、初始化耗时与常驻内存
+
+每次测量都在全新的解释器中进行, 先用空数据库跑一次 (包含建表迁移), 再在同一个库上跑一次
+(Web worker 和 poller 重启时的常见情况)。超出预算或加载了重量级依赖时以非零状态退出:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --max-import 0.5 --max-rss-mb 80
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动路径上不应出现的模块 (只在用到的请求中按需导入)
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl')
+
+PROBE = r"""
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app({'DATABASE': sys.argv[2]})
+finished = time.perf_counter()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'import_seconds': imported - started,
+    'create_app_seconds': finished - imported,
+    # Linux 上 ru_maxrss 以 KB 为单位, macOS 上以字节为单位
+    'peak_rss_mb': rss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    'heavy_modules': [name for name in json.loads(sys.argv[3]) if name in sys.modules],
+}))
+"""
+
+
+def measure(database):
+    output = subprocess.run([sys.executable, '-c', PROBE, ROOT, database, json.dumps(HEAVY_MODULES)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='create_app() startup budget check')
+    parser.add_argument('--max-import', type=float, default=1.0, help='导入 app 包的最长秒数')
+    parser.add_argument('--max-create', type=float, default=0.5, help='已有数据库时 create_app() 的最长秒数')
+    parser.add_argument('--max-rss-mb', type=float, default=100, help='峰值常驻内存上限 (MB)')
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'accounts.db')
+        for run in ('cold', 'warm'):
+            result = measure(database)
+            print(f"{run:>4}: import {result['import_seconds']:.3f}s, create_app {result['create_app_seconds']:.3f}s, "
+                  f"peak RSS {result['peak_rss_mb']:.1f} MB")
+            if result['heavy_modules']:
+                failures.append(f"{run}: heavy modules loaded at startup: {', '.join(result['heavy_modules'])}")
+            if result['import_seconds'] > args.max_import:
+                failures.append(f"{run}: import took {result['import_seconds']:.3f}s > {args.max_import}s")
+            if result['peak_rss_mb'] > args.max_rss_mb:
+                failures.append(f"{run}: peak RSS {result['peak_rss_mb']:.1f} MB > {args.max_rss_mb} MB")
+            # 空库首次启动要建表和生成默认用户的密码哈希, 不计入预算
+            if run == 'warm' and result['create_app_seconds'] > args.max_create:
+                failures.append(f"{run}: create_app took {result['create_app_seconds']:.3f}s > {args.max_create}s")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Gunicorn 生产配置
+
+    gunicorn -c gunicorn.conf.py run:app
+
+多个 worker 进程, 每个 worker 用线程池处理请求; 每个 worker 都参与内嵌轮询的选举
+(app/leader.py), 同一时间只有一个 worker 运行轮询。以下参数均可用环境变量覆盖。
+"""
+import logging
+import multiprocessing
+import os
+import signal
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = 'gthread'
+# /events 的 SSE 长连接会占用一个线程; 每个 worker 最多 EVENT_MAX_STREAMS (默认 8) 个, 其余线程留给普通请求
+threads = int(os.environ.get('WEB_THREADS', 16))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+# 收到 SIGTERM 后等待请求结束和轮询排空的时间, 应大于 POLLER_DRAIN_TIMEOUT (默认 30 秒)
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 45))
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+# 应用自身的日志 (轮询、选举) 与 poller.py 使用相同格式输出到 stderr, worker 从 master 继承
+logging.basicConfig(level=loglevel.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def post_worker_init(worker):
+    from app import leader
+    app = worker.wsgi
+    leader.start_embedded(app)
+
+    # 收到 SIGTERM 时立即开始排空轮询, 与等待进行中的请求同时进行
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def on_term(signum, frame):
+        leader.stop_embedded(app, timeout=0)
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_term)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):
+    # worker 启动失败时没有加载应用
+    app = getattr(worker, 'wsgi', None)
+    if app is not None:
+        from app import leader
+        leader.stop_embedded(app)
@@ -0,0 +1,36 @@
+"""独立轮询进程入口
+
+多个 poller.py 可以共享同一个数据库同时运行, 账号通过租约在进程之间自动分配:
+    python poller.py --worker-id poller-1
+Web 进程设置 POLLER_EMBEDDED=0 后不再内嵌轮询线程。
+"""
+import argparse
+import logging
+import signal
+
+from app import create_app, metrics
+from app.polling import PollingService
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MailNest polling worker')
+    parser.add_argument('--worker-id', help='唯一的进程标识, 默认使用 主机名-pid-随机后缀')
+    parser.add_argument('--metrics-port', type=int, help='在该端口以 Prometheus 文本格式暴露 /metrics')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='指标端点监听的地址 (默认 127.0.0.1)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    app = create_app()
+    if args.metrics_port:
+        metrics.serve(args.metrics_host, args.metrics_port)
+    service = PollingService(app, worker_id=args.worker_id)
+
+    # 收到 SIGTERM/SIGINT 后结束当前批次并释放租约
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: service.stop())
+
+    service.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,21 @@
-from app import create_app
-from app.polling import PollingService
+"""开发服务器入口: python run.py (FLASK_DEBUG=1 开启调试和自动重载)
+
+生产环境使用多进程、多线程的 Gunicorn, 配置见 gunicorn.conf.py:
+    gunicorn -c gunicorn.conf.py run:app
+两种方式下内嵌轮询都通过 app/leader.py 的租约选举, 同一个数据库上只有一个进程运行。
+"""
 import os
+from app import create_app
+from app import leader
 
 app = create_app()
 
-# Initialize Polling Service
-# Only start if not in reloader (or use specific check) to avoid duplicates
-# For simplicity in this environment, valid check is usually:
-if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or __name__ == '__main__':
-    # Actually WERKZEUG_RUN_MAIN is set by the reloader process.
-    # We want to run it in the main process if no reloader, or in the reloader process if reloader is on.
-    # But be careful of duplicates.
-    # Simple approach: Just start it. If debug=True, it might run twice, but that's acceptable for this simple app.
-    # Better: Only start if NOT imported (i.e. if __name__ == '__main__') but create_app calls it? No.
-    # Let's instantiate and start it here.
-    pass
-
 if __name__ == '__main__':
-    # Start polling service
-    # Make sure we don't start it twice if using reloader
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-        polling_service = PollingService(app)
-        polling_service.start()
-        
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    # 自动重载时外层的监视进程不处理请求, 只在实际运行应用的子进程中参与选举
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        leader.start_embedded(app)
+    try:
+        app.run(debug=debug, host='0.0.0.0', port=5000)
+    finally:
+        leader.stop_embedded(app)